@@ -1,40 +1,101 @@
 # In chat/ai_services.py
 
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
+import httpx
 import os
 from chat import state
-from sentence_transformers import SentenceTransformer
+from chat.embedding_cache import embedding_cache
+from chat.embedding_batcher import EmbeddingBatcher
+from chat.embedding_backends import create_embedding_backend, EMBEDDING_BACKEND
 import re # <-- New import added
 
-# This variable will hold our local embedding model. It starts as None.
+# This variable will hold our local embedding backend. It starts as None.
 embedding_model = None
+EMBEDDING_MODEL_NAME = 'TaylorAI/bge-micro-v2'
+# Stored with every vector in unified_memory (metadata "embedding_model"), so vectors made by any
+# other model can be found and re-embedded. Backends of the same model share it, as their vectors agree.
+EMBEDDING_MODEL_VERSION = EMBEDDING_MODEL_NAME
+
+# Concurrent embedding requests are merged into one batch by a dedicated worker thread.
+EMBEDDING_BATCHING_ENABLED = os.getenv("EMBEDDING_BATCHING_ENABLED", "1") == "1"
+EMBEDDING_BATCH_MAX_SIZE = int(os.getenv("EMBEDDING_BATCH_MAX_SIZE", "64"))
+EMBEDDING_BATCH_WINDOW_MS = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "5"))
 
 # This will hold the available models from the selected provider
 available_models_cache = []
 
+# Connection pool settings for the shared async HTTP client.
+ASYNC_HTTP_MAX_CONNECTIONS = int(os.getenv("ASYNC_HTTP_MAX_CONNECTIONS", "100"))
+ASYNC_HTTP_MAX_KEEPALIVE = int(os.getenv("ASYNC_HTTP_MAX_KEEPALIVE", "20"))
+ASYNC_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("ASYNC_HTTP_KEEPALIVE_EXPIRY", "60"))
+ASYNC_HTTP_TIMEOUT = float(os.getenv("ASYNC_HTTP_TIMEOUT", "120"))
+
 # --- [NEW HELPER FUNCTION ADDED] ---
 def _get_context_length(model_id: str) -> int:
     """
-    Parses the context length from a model ID string.
-    Looks for patterns like '8k', '16k', '32k' or numbers like '8192', '16384'.
-    Returns an integer representing the context window size.
+    Parses the context length from a model ID string, for providers that do not report it.
+    Looks for a standalone 'k' size like '32k' or a raw number like '8192'. Version numbers,
+    parameter counts ('8b') and dates are ignored, so most IDs yield 0, meaning unknown.
+
+    >>> _get_context_length("llama3-70b-8192")
+    8192
+    >>> _get_context_length("mistralai/mistral-7b-instruct-32k")
+    32768
+    >>> _get_context_length("meta-llama/llama-3.1-8b-instruct")
+    0
     """
     model_id_lower = model_id.lower()
-    # Check for 'k' notation, e.g., "8k" -> 8 * 1024
-    k_match = re.search(r'(\d+)k', model_id_lower)
+    # 'k' notation as its own name part, e.g. "gpt-4-32k" -> 32 * 1024
+    k_match = re.search(r'(?<![\w.])(\d+)k(?![a-z0-9])', model_id_lower)
     if k_match:
         return int(k_match.group(1)) * 1024
 
-    # Check for raw numbers, prioritizing larger ones (like 8192 over 70 in llama-70b-8192)
-    numbers = re.findall(r'\d+', model_id_lower)
-    if numbers:
-        # Convert to int and find the largest number, assuming it's the context
-        # This correctly handles names like "llama3-70b-8192" -> 8192
-        return max(int(n) for n in numbers)
+    # Raw numbers that look like context sizes (powers of two from 1024), like 8192 in
+    # "llama3-70b-8192". Dates such as 2024 in "gpt-4o-2024-08-06" are not powers of two.
+    numbers = [int(n) for n in re.findall(r'(?<![\w.])(\d+)(?![\w.])', model_id_lower)]
+    contexts = [n for n in numbers if n >= 1024 and n & (n - 1) == 0]
+    if contexts:
+        return max(contexts)
+
+    # Unknown; callers fall back to a default window
+    return 0
 
-    # Return a default low value if no context length is found
+def _reported_context_length(model) -> int:
+    """The context length a provider lists for a model (OpenRouter: context_length, Groq: context_window), or 0."""
+    extra = getattr(model, "model_extra", None) or {}
+    for key in ("context_length", "context_window"):
+        value = extra.get(key, getattr(model, key, None))
+        if isinstance(value, int) and value > 0:
+            return value
     return 0
 
+def _get_async_http_client() -> httpx.AsyncClient:
+    """
+    Returns the shared async HTTP client, creating it on first use.
+    The pool is kept across API key changes so connections stay warm.
+    """
+    if state.async_http_client is None:
+        limits = httpx.Limits(
+            max_connections=ASYNC_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=ASYNC_HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=ASYNC_HTTP_KEEPALIVE_EXPIRY,
+        )
+        timeout = httpx.Timeout(ASYNC_HTTP_TIMEOUT, connect=10.0)
+        try:
+            state.async_http_client = httpx.AsyncClient(http2=True, limits=limits, timeout=timeout)
+        except ImportError:
+            # HTTP/2 needs the optional 'h2' package (httpx[http2]); fall back to HTTP/1.1 keep-alive.
+            print("HTTP/2 support not installed. Using HTTP/1.1 for the async AI client.")
+            state.async_http_client = httpx.AsyncClient(limits=limits, timeout=timeout)
+    return state.async_http_client
+
+async def close_async_client():
+    """Closes the shared async HTTP client. Called on application shutdown."""
+    if state.async_http_client is not None:
+        await state.async_http_client.aclose()
+        state.async_http_client = None
+    state.async_ai_client = None
+
 # --- [EXISTING FUNCTION REPLACED WITH NEW VERSION] ---
 def initialize_client(api_key: str) -> bool:
     """
@@ -44,6 +105,7 @@ def initialize_client(api_key: str) -> bool:
     global available_models_cache
     if not api_key:
         state.ai_client = None
+        state.async_ai_client = None
         available_models_cache = []
         return False
 
@@ -67,12 +129,17 @@ def initialize_client(api_key: str) -> bool:
             base_url=base_url,
             api_key=api_key,
         )
+        state.async_ai_client = AsyncOpenAI(
+            base_url=base_url,
+            api_key=api_key,
+            http_client=_get_async_http_client(),
+        )
         models_response = state.ai_client.models.list()
         
         # Create a list of model objects with context length
         model_details = []
         for model in models_response.data:
-            context_window = _get_context_length(model.id)
+            context_window = _reported_context_length(model) or _get_context_length(model.id)
             model_details.append({"id": model.id, "context_window": context_window})
             
         # Sort the list of models by context_window in descending order
@@ -83,6 +150,7 @@ def initialize_client(api_key: str) -> bool:
     except Exception as e:
         print(f"Failed to initialize client for {provider_name}: {e}")
         state.ai_client = None
+        state.async_ai_client = None
         available_models_cache = []
         return False
 
@@ -91,9 +159,9 @@ def get_available_models() -> list[dict]:
     """Returns the cached list of available models."""
     return available_models_cache
 
-def embed_texts(texts: list[str]) -> list[list[float]]:
+def _load_embedding_model():
     """
-    Creates embeddings using the LOCAL model.
+    Returns the LOCAL embedding backend (see chat/embedding_backends.py).
     Loads the model on the first call if it's not already in memory.
     """
     global embedding_model # We need this to modify the global variable
@@ -101,29 +169,81 @@ def embed_texts(texts: list[str]) -> list[list[float]]:
     # This is the "lazy loading" logic. It only runs if the model is not yet loaded.
     if embedding_model is None:
         try:
-            print("First use of embeddings: loading local model into memory...")
-            embedding_model = SentenceTransformer('TaylorAI/bge-micro-v2') 
+            print(f"First use of embeddings: loading local model into memory ({EMBEDDING_BACKEND} backend)...")
+            embedding_model = create_embedding_backend(EMBEDDING_MODEL_NAME, EMBEDDING_BACKEND)
             print("Successfully loaded local embedding model.")
         except Exception as e:
             print(f"!!! FATAL: Could not load local embedding model. Error: {e}")
             # We raise an exception to stop the process if the model can't be loaded.
-            raise Exception("Failed to load embedding model on first use.")
-    
+            raise Exception(f"Failed to load embedding model on first use: {e}")
+    return embedding_model
+
+def get_embedding_token_starts(text: str) -> list[int]:
+    """Character offsets of the embedding model's tokens in text, loading the model if needed."""
+    return _load_embedding_model().token_starts(text)
+
+def _embedding_cache_namespace() -> str:
+    """
+    The model name embeddings are cached under. Non-torch backends get their own namespace,
+    since their vectors differ slightly (int8 more so) from the torch ones.
+    """
+    if EMBEDDING_BACKEND == "torch":
+        return EMBEDDING_MODEL_NAME
+    return f"{EMBEDDING_MODEL_NAME}#{EMBEDDING_BACKEND}"
+
+def _encode_texts(texts: list[str]) -> list[list[float]]:
+    """Runs the local embedding model on texts, without consulting the cache."""
+    model = _load_embedding_model()
     print(f"Creating local embeddings for {len(texts)} text chunk(s)...")
     try:
-        embeddings = embedding_model.encode(texts, convert_to_tensor=False).tolist()
+        embeddings = model.encode(texts)
         print("Successfully created local embeddings.")
         return embeddings
     except Exception as e:
         print(f"Error creating local embeddings: {e}")
         raise e
 
-def get_ai_response(messages: list[dict], model: str) -> str:
-    """Gets a response from the AI model using the client from the central state."""
-    if not state.ai_client:
+def warm_up_embedding_model() -> list[float]:
+    """Loads the embedding model and runs one inference, bypassing the cache. Returns that embedding."""
+    return _encode_texts(["warm up"])[0]
+
+embedding_batcher = EmbeddingBatcher(
+    _encode_texts, max_batch_size=EMBEDDING_BATCH_MAX_SIZE, max_wait_ms=EMBEDDING_BATCH_WINDOW_MS
+)
+
+def _embed_uncached(texts: list[str], background: bool = False) -> list[list[float]]:
+    """Embeds texts through the batching worker, or directly when batching is disabled."""
+    if EMBEDDING_BATCHING_ENABLED:
+        return embedding_batcher.embed(texts, background)
+    return _encode_texts(texts)
+
+def embed_texts(texts: list[str], background: bool = False) -> list[list[float]]:
+    """
+    Creates embeddings using the LOCAL model.
+    Embeddings are looked up in the persistent cache first, so only texts
+    that have never been embedded before reach the model. Bulk work (imports,
+    uploads) passes background=True so it yields to interactive requests.
+    """
+    if not texts:
+        return []
+    if embedding_cache is None:
+        return _embed_uncached(texts, background)
+
+    cache_namespace = _embedding_cache_namespace()
+    embeddings = embedding_cache.get_many(cache_namespace, texts)
+    missing_texts = list(dict.fromkeys(text for text, embedding in zip(texts, embeddings) if embedding is None))
+    if missing_texts:
+        new_embeddings = dict(zip(missing_texts, _embed_uncached(missing_texts, background)))
+        embedding_cache.put_many(cache_namespace, missing_texts, [new_embeddings[t] for t in missing_texts])
+        embeddings = [embedding if embedding is not None else new_embeddings[text] for text, embedding in zip(texts, embeddings)]
+    return embeddings
+
+async def get_ai_response_async(messages: list[dict], model: str) -> str:
+    """Gets a response from the AI model using the pooled async client from the central state."""
+    if not state.async_ai_client:
         return "AI client not initialized. Please set a valid API key in the options."
     try:
-        completion = state.ai_client.chat.completions.create(
+        completion = await state.async_ai_client.chat.completions.create(
             model=model,
             messages=messages,
         )
@@ -131,3 +251,31 @@ def get_ai_response(messages: list[dict], model: str) -> str:
     except Exception as e:
         print(f"Error getting AI response from model {model}: {e}")
         return f"Sorry, I encountered an error with the AI model: {str(e)}"
+
+def is_error_response(text: str) -> bool:
+    """Checks whether an AI response is one of the error messages returned above."""
+    return "Sorry, I encountered an error" in text or "AI client not initialized" in text
+
+async def stream_ai_response(messages: list[dict], model: str):
+    """
+    Streams a response from the AI model, yielding text deltas as they arrive.
+    Errors are yielded as text in the same form get_ai_response_async returns them.
+    """
+    if not state.async_ai_client:
+        yield "AI client not initialized. Please set a valid API key in the options."
+        return
+    try:
+        stream = await state.async_ai_client.chat.completions.create(
+            model=model,
+            messages=messages,
+            stream=True,
+        )
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+    except Exception as e:
+        print(f"Error streaming AI response from model {model}: {e}")
+        yield f"Sorry, I encountered an error with the AI model: {str(e)}"
@@ -0,0 +1,180 @@
+# chat/chunker.py
+
+import os
+import re
+
+# --- Configuration ---
+# "boundary" packs whole sentences/paragraphs up to the token limit,
+# "tokens" cuts fixed token windows, "chars" cuts fixed character windows.
+CHUNK_MODE = os.getenv("CHUNK_MODE", "boundary")
+# "tiktoken" (cl100k_base) or "embedder" (the local embedding model's own tokenizer).
+CHUNK_TOKENIZER = os.getenv("CHUNK_TOKENIZER", "tiktoken")
+# Chunk size and overlap, in tokens for "boundary"/"tokens" and in characters for "chars".
+# bge-micro-v2 truncates input at 512 tokens, so chunks stay well below that.
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "256"))
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "32"))
+# Incoming text is processed in blocks of roughly this many characters, cut at a
+# paragraph break where possible, so a large document is never chunked all at once.
+CHUNK_BLOCK_CHARS = 64 * 1024
+
+# Sentence ends and paragraph breaks. A unit ends where a match starts and the next begins where it ends.
+_UNIT_BOUNDARY_PATTERN = re.compile(r"\n\s*\n|(?<=[.!?])\s+")
+# Used when no tokenizer can be loaded: a word together with its trailing whitespace.
+_WORD_PATTERN = re.compile(r"\s*\S+\s*")
+
+# --- Tokenizers ---
+_tokenizer = None
+
+class _TiktokenTokenizer:
+    def __init__(self):
+        import tiktoken
+        self.encoding = tiktoken.get_encoding("cl100k_base")
+
+    def token_starts(self, text: str) -> list[int]:
+        tokens = self.encoding.encode(text, disallowed_special=())
+        return self.encoding.decode_with_offsets(tokens)[1]
+
+class _EmbedderTokenizer:
+    def __init__(self):
+        from chat.ai_services import get_embedding_token_starts
+        get_embedding_token_starts("")  # loads the model now, so a failure falls back to word counting
+        self.token_starts = get_embedding_token_starts
+
+class _WordTokenizer:
+    def token_starts(self, text: str) -> list[int]:
+        return [match.start() for match in _WORD_PATTERN.finditer(text)]
+
+def _get_tokenizer():
+    global _tokenizer
+    if _tokenizer is None:
+        try:
+            _tokenizer = _EmbedderTokenizer() if CHUNK_TOKENIZER == "embedder" else _TiktokenTokenizer()
+        except Exception as e:
+            print(f"Could not load the '{CHUNK_TOKENIZER}' tokenizer for chunking, counting words instead: {e}")
+            _tokenizer = _WordTokenizer()
+    return _tokenizer
+
+def _count_tokens(text: str) -> int:
+    return len(_get_tokenizer().token_starts(text))
+
+# --- Chunking ---
+def _iter_blocks(segments):
+    """Regroups incoming text segments into blocks that end on a paragraph, line or word break."""
+    buffer = ""
+    for segment in segments:
+        buffer += segment
+        while len(buffer) >= CHUNK_BLOCK_CHARS:
+            cut = -1
+            for separator in ("\n\n", "\n", " "):
+                position = buffer.rfind(separator, 0, CHUNK_BLOCK_CHARS * 2)
+                if position > 0:
+                    cut = position + len(separator)
+                    break
+            if cut <= 0:
+                cut = len(buffer)
+            yield buffer[:cut], False
+            buffer = buffer[cut:]
+    yield buffer, True
+
+def _window_chunks(text: str, starts: list[int], size: int, overlap: int, final: bool) -> tuple[list[str], str]:
+    """
+    Cuts fixed windows of `size` units (characters or tokens) out of text, where `starts`
+    holds the character offset of each unit. Returns the chunks and the text to carry into the next block.
+    """
+    step = max(1, size - overlap)
+    chunks = []
+    start = 0
+    while start < len(starts):
+        end = start + size
+        if end > len(starts) and not final:
+            break
+        chunk_end = starts[end] if end < len(starts) else len(text)
+        chunks.append(text[starts[start]:chunk_end])
+        if end >= len(starts):
+            return chunks, ""
+        start += step
+    return chunks, text[starts[start]:] if start < len(starts) else ""
+
+def _boundary_chunks(text: str, size: int, overlap: int, final: bool) -> tuple[list[str], str]:
+    """
+    Packs sentences and paragraphs into chunks of up to `size` tokens. The last sentences of
+    each chunk, up to `overlap` tokens, are repeated at the start of the next one.
+    Sentences longer than `size` are cut into token windows.
+    """
+    units = []
+    position = 0
+    for match in _UNIT_BOUNDARY_PATTERN.finditer(text):
+        if match.start() > position:
+            units.append((position, match.start()))
+        position = match.end()
+    if position < len(text) and text[position:].strip():
+        units.append((position, len(text)))
+
+    chunks = []
+    current = []  # (start, end, tokens) of the units in the chunk being built
+    current_tokens = 0
+    for unit_start, unit_end in units:
+        unit_text = text[unit_start:unit_end]
+        unit_tokens = _count_tokens(unit_text)
+        if unit_tokens > size:
+            if current:
+                chunks.append(text[current[0][0]:current[-1][1]])
+                current, current_tokens = [], 0
+            long_chunks, _ = _window_chunks(unit_text, _get_tokenizer().token_starts(unit_text), size, overlap, True)
+            chunks.extend(long_chunks)
+            continue
+        if current and current_tokens + unit_tokens > size:
+            chunks.append(text[current[0][0]:current[-1][1]])
+            carried, carried_tokens = [], 0
+            for unit in reversed(current):
+                if carried_tokens + unit[2] > overlap:
+                    break
+                carried.insert(0, unit)
+                carried_tokens += unit[2]
+            current, current_tokens = carried, carried_tokens
+        current.append((unit_start, unit_end, unit_tokens))
+        current_tokens += unit_tokens
+
+    if not current:
+        return chunks, ""
+    if final:
+        chunks.append(text[current[0][0]:current[-1][1]])
+        return chunks, ""
+    return chunks, text[current[0][0]:]
+
+def iter_text_chunks(segments, mode: str = None, chunk_size: int = None, chunk_overlap: int = None):
+    """
+    Yields chunks from an iterable of text segments (e.g. pieces of a file as they are read).
+    Only a block of text and the current chunk are held in memory at any time.
+    """
+    mode = mode or CHUNK_MODE
+    size = chunk_size or CHUNK_SIZE
+    overlap = CHUNK_OVERLAP if chunk_overlap is None else chunk_overlap
+    overlap = min(overlap, size - 1)
+
+    carry = ""
+    for block, final in _iter_blocks(segments):
+        text = carry + block
+        if not text:
+            continue
+        if mode == "chars":
+            chunks, carry = _window_chunks(text, range(len(text)), size, overlap, final)
+        elif mode == "tokens":
+            chunks, carry = _window_chunks(text, _get_tokenizer().token_starts(text), size, overlap, final)
+        else:
+            chunks, carry = _boundary_chunks(text, size, overlap, final)
+        for chunk in chunks:
+            if not chunk.strip():
+                continue
+            yield chunk if mode == "chars" else chunk.strip()
+
+def iter_chunk_batches(segments, batch_size: int, **chunk_options):
+    """Groups the chunks from iter_text_chunks into lists of up to batch_size, for batched embedding."""
+    batch = []
+    for chunk in iter_text_chunks(segments, **chunk_options):
+        batch.append(chunk)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
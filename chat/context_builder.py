@@ -0,0 +1,122 @@
+# chat/context_builder.py
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from chat.ai_services import get_available_models
+from memory.memory_store import get_message_window
+
+# Share of the model's context window that conversation history may use.
+HISTORY_CONTEXT_FRACTION = float(os.getenv("HISTORY_CONTEXT_FRACTION", "0.5"))
+# Hard cap on history tokens regardless of the context window. 0 disables the cap.
+HISTORY_MAX_TOKENS = int(os.getenv("HISTORY_MAX_TOKENS", "8000"))
+# Used when a model's context window is unknown.
+DEFAULT_CONTEXT_WINDOW = int(os.getenv("DEFAULT_CONTEXT_WINDOW", "8192"))
+# Smaller listed windows are treated as unknown: no chat model has one, so they are parsing mistakes.
+MIN_CONTEXT_WINDOW = 1024
+# How many stored messages to read per step while walking back from the tail of the chat.
+HISTORY_READ_BATCH = 20
+# Approximate per-message overhead of the chat format (role, separators).
+MESSAGE_OVERHEAD_TOKENS = 4
+# Token counts of recently counted texts, keyed by a digest of the text so the texts themselves are not kept.
+TOKEN_COUNT_CACHE_MAX_ENTRIES = 20000
+_token_counts = OrderedDict()
+_token_counts_lock = threading.Lock()
+
+# The tiktoken encoding, loaded on first use. False means it could not be loaded.
+_encoding = None
+
+def _get_encoding():
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            print(f"Could not load tiktoken encoding, estimating token counts instead: {e}")
+            _encoding = False
+    return _encoding
+
+def _count_tokens_uncached(text: str) -> int:
+    encoding = _get_encoding()
+    if encoding:
+        return len(encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+def count_tokens(text: str) -> int:
+    """Counts the tokens in a text. Counts are cached by content digest, so each stored message is only encoded once."""
+    if not text:
+        return 0
+    key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+    with _token_counts_lock:
+        count = _token_counts.get(key)
+        if count is not None:
+            _token_counts.move_to_end(key)
+            return count
+    count = _count_tokens_uncached(text)
+    with _token_counts_lock:
+        _token_counts[key] = count
+        if len(_token_counts) > TOKEN_COUNT_CACHE_MAX_ENTRIES:
+            _token_counts.popitem(last=False)
+    return count
+
+def get_context_window(model: str) -> int:
+    """Looks up the model's context window in the cached model list, falling back to DEFAULT_CONTEXT_WINDOW."""
+    for model_info in get_available_models():
+        if model_info.get("id") == model and (model_info.get("context_window") or 0) >= MIN_CONTEXT_WINDOW:
+            return model_info["context_window"]
+    return DEFAULT_CONTEXT_WINDOW
+
+def get_history_token_budget(model: str, reserved_tokens: int = 0) -> int:
+    """
+    Tokens available for history, after reserving room for the new prompt.
+
+    >>> get_history_token_budget("openai/gpt-4o-mini", reserved_tokens=500) >= 1024
+    True
+    """
+    budget = int(get_context_window(model) * HISTORY_CONTEXT_FRACTION)
+    if HISTORY_MAX_TOKENS > 0:
+        budget = min(budget, HISTORY_MAX_TOKENS)
+    return max(0, budget - reserved_tokens)
+
+def _message_text(message: dict) -> str:
+    """The plain text of a rendered message, including merged messages' text parts."""
+    if message.get("is_merged_message"):
+        return "\n\n".join(part["content"] for part in message.get("content_parts", []) if part.get("type") == "text" and part.get("content"))
+    return message.get("text") or ""
+
+def build_history(chat_id: str, model: str, reserved_tokens: int = 0) -> tuple[list[dict], bool]:
+    """
+    Builds the conversation history for a prompt by reading the chat from its tail
+    and adding messages, newest first, until the token budget is used up.
+    Returns (history in chronological order, whether the chat has no messages yet).
+    """
+    budget = get_history_token_budget(model, reserved_tokens)
+    history = []
+    used_tokens = 0
+    before = None
+    is_first_turn = None
+
+    while True:
+        window = get_message_window(chat_id, limit=HISTORY_READ_BATCH, before=before)
+        if is_first_turn is None:
+            is_first_turn = window["total_messages_in_chat"] == 0
+        for message in reversed(window["messages"]):
+            if message.get("role") not in ("user", "assistant"):
+                continue
+            text = _message_text(message)
+            if not text:
+                continue
+            tokens = count_tokens(text) + MESSAGE_OVERHEAD_TOKENS
+            if used_tokens + tokens > budget:
+                history.reverse()
+                return history, is_first_turn
+            history.append({"role": message["role"], "content": text})
+            used_tokens += tokens
+        if not window["has_more"]:
+            break
+        before = window["next_cursor"]
+
+    history.reverse()
+    return history, is_first_turn
@@ -1,178 +1,303 @@
 # chat/data_processor.py
 import uuid
 import json
-import datetime
+import multiprocessing
+import os
+import codecs
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from chat.ai_services import embed_texts
-from memory.memory_store import save_chunks_to_memory
+from memory.memory_store import save_chunks_to_memory, delete_chunks_for_source
 from chat.chat_manager import add_file_source
+from chat.jobs import job_manager, Job
+from chat.chunker import iter_chunk_batches
+from chat.export_parser import parse_single_conversation, parse_conversation_chunk
 
-# --- Helper Functions (keep _normalize_and_format_timestamp and _get_content_text as they are) ---
-def _normalize_and_format_timestamp(ts: float | None) -> tuple[float | None, str | None]:
-    if ts is None:
-        return None, None
-    normalized_ts = ts
+# Number of worker processes used to parse ChatGPT exports. 0 or 1 parses in the current process.
+IMPORT_PARSE_WORKERS = int(os.getenv("IMPORT_PARSE_WORKERS", "0"))
+# Conversations handed to a worker process at a time.
+IMPORT_PARSE_CHUNK_SIZE = int(os.getenv("IMPORT_PARSE_CHUNK_SIZE", "64"))
+# Number of file chunks embedded and written to memory at a time.
+FILE_EMBED_BATCH_SIZE = int(os.getenv("FILE_EMBED_BATCH_SIZE", "64"))
+# Bytes of an uploaded file decoded at a time.
+FILE_READ_SIZE = 1 << 20
+# Batches allowed to wait between pipeline stages. Bounds memory when one stage is slower than the others.
+FILE_PIPELINE_QUEUE_SIZE = 2
+
+def _parse_pool(workers: int) -> ProcessPoolExecutor:
+    """
+    A process pool for parsing. Workers are spawned rather than forked: the server process runs
+    other threads (the embedding batcher, warm-up, background jobs) whose locks a fork could copy while held.
+    Spawned workers only run functions from chat.export_parser, so they never import this module
+    or the embedding model and storage it pulls in.
+    """
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+def iter_json_array(file_path: str, read_size: int = 1 << 20):
+    """
+    Incrementally parses a file containing a top-level JSON array.
+    Yields (item, bytes_read) for each array element, holding only one element
+    (plus a read buffer) in memory at a time.
+    """
+    json_decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    with open(file_path, 'rb') as f:
+        buffer = ""
+        pos = 0
+        bytes_read = 0
+        eof = False
+        started = False
+
+        def read_more(size: int) -> bool:
+            nonlocal buffer, pos, bytes_read, eof
+            raw = f.read(size)
+            bytes_read += len(raw)
+            if not raw:
+                eof = True
+                buffer = buffer[pos:] + text_decoder.decode(b"", final=True)
+            else:
+                buffer = buffer[pos:] + text_decoder.decode(raw)
+            pos = 0
+            return bool(raw)
+
+        read_more(read_size)
+        while True:
+            # Skip whitespace and separators until the next value.
+            while True:
+                while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                    pos += 1
+                if pos < len(buffer) or eof:
+                    break
+                read_more(read_size)
+
+            if pos >= len(buffer):
+                raise ValueError("Invalid JSON: the file ended before the array was closed.")
+            if not started:
+                if buffer[pos] != "[":
+                    raise ValueError("Invalid JSON: expected a list of conversations.")
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == "]":
+                return
+
+            try:
+                item, end = json_decoder.raw_decode(buffer, pos)
+                # A scalar that touches the end of the buffer may have been cut off mid-value.
+                if end == len(buffer) and not eof and not isinstance(item, (dict, list)):
+                    raise json.JSONDecodeError("Value may be truncated", buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                # Grow the read size with the pending value so huge elements are parsed in linear time.
+                read_more(max(read_size, len(buffer) - pos))
+                continue
+
+            pos = end
+            yield item, bytes_read
+
+def _iter_parsed_in_parallel(items, workers: int, chunk_size: int):
+    """
+    Parses (convo_data, bytes_read) items across a process pool in chunks.
+    Only a bounded number of chunks is in flight at once, so memory stays flat,
+    and results are yielded in input order as (parsed_conversation_or_None, bytes_read).
+    """
+    max_in_flight = workers * 2
+    in_flight = deque()
+
+    def drain_oldest():
+        future, chunk_bytes_read = in_flight.popleft()
+        for parsed_conv, bytes_read in zip(future.result(), chunk_bytes_read):
+            yield parsed_conv, bytes_read
+
+    with _parse_pool(workers) as executor:
+        chunk, chunk_bytes_read = [], []
+        for convo_data, bytes_read in items:
+            chunk.append(convo_data)
+            chunk_bytes_read.append(bytes_read)
+            if len(chunk) >= chunk_size:
+                in_flight.append((executor.submit(parse_conversation_chunk, chunk), chunk_bytes_read))
+                chunk, chunk_bytes_read = [], []
+                if len(in_flight) >= max_in_flight:
+                    yield from drain_oldest()
+        if chunk:
+            in_flight.append((executor.submit(parse_conversation_chunk, chunk), chunk_bytes_read))
+        while in_flight:
+            yield from drain_oldest()
+
+def iter_parse_chatgpt_export(file_path: str, workers: int = IMPORT_PARSE_WORKERS):
+    """
+    Streams a conversations.json export from disk, one conversation at a time.
+    Yields (parsed_conversation, progress) where progress is the fraction of the file read.
+    With workers > 1, conversations are parsed in a process pool, in the same order.
+    """
+    total_bytes = os.path.getsize(file_path) or 1
+    items = iter_json_array(file_path)
+    if workers > 1:
+        parsed_items = _iter_parsed_in_parallel(items, workers, IMPORT_PARSE_CHUNK_SIZE)
+    else:
+        parsed_items = ((parse_single_conversation(convo_data), bytes_read) for convo_data, bytes_read in items)
+
+    parsed_count = 0
+    for parsed_conv, bytes_read in parsed_items:
+        if parsed_conv:
+            parsed_count += 1
+            yield parsed_conv, min(bytes_read / total_bytes, 1.0)
+    print(f"Successfully parsed {parsed_count} conversations with rich metadata.")
+
+# --- File Ingestion Pipeline ---
+# Reading and chunking, embedding, and writing to memory run as three stages connected by
+# small bounded queues, so the file is read while earlier batches are embedded and stored.
+_PIPELINE_DONE = object()
+
+def _iter_file_text(file_path: str, read_state: dict):
+    """Yields a file's text in pieces, decoding UTF-8 incrementally."""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    with open(file_path, "rb") as f:
+        while True:
+            data = f.read(FILE_READ_SIZE)
+            if not data:
+                break
+            read_state["bytes_read"] += len(data)
+            text = decoder.decode(data)
+            if text:
+                yield text
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+def _put_until_stopped(q: queue.Queue, item, stop: threading.Event) -> bool:
+    """Puts an item on a bounded queue, giving up if the pipeline is being stopped."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _get_until_stopped(q: queue.Queue, stop: threading.Event):
+    """Takes the next item from a queue, or _PIPELINE_DONE once the pipeline is being stopped."""
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return _PIPELINE_DONE
+
+def _chunk_stage(file_path: str, file_size: int, out_queue: queue.Queue, stop: threading.Event, errors: list):
+    read_state = {"bytes_read": 0}
+    try:
+        for batch in iter_chunk_batches(_iter_file_text(file_path, read_state), FILE_EMBED_BATCH_SIZE):
+            read_fraction = read_state["bytes_read"] / file_size if file_size else 1.0
+            if not _put_until_stopped(out_queue, (batch, read_fraction), stop):
+                return
+        _put_until_stopped(out_queue, _PIPELINE_DONE, stop)
+    except Exception as e:
+        errors.append(e)
+        stop.set()
+
+def _embed_stage(in_queue: queue.Queue, out_queue: queue.Queue, stop: threading.Event, errors: list):
     try:
-        if ts > (datetime.datetime.now().timestamp() * 100):
-            normalized_ts = ts / 1000.0
-        iso_format = datetime.datetime.fromtimestamp(normalized_ts).isoformat()
-        return normalized_ts, iso_format
-    except (TypeError, ValueError, OSError) as e:
-        print(f"Warning: Could not process timestamp '{ts}'. Error: {e}. Storing as is.")
-        return ts, str(ts)
-
-def _get_content_text(content_obj: dict | None) -> str:
-    # ... (no changes here)
-    if not content_obj:
-        return ""
-    content_type = content_obj.get("content_type")
-    if content_type == "text":
-        parts = content_obj.get("parts", [])
-        return "".join(part for part in parts if isinstance(part, str))
-    if content_type == "code":
-        return content_obj.get("text", "")
-    if content_type == "user_editable_context":
-        return content_obj.get("user_instructions", "")
-    return json.dumps(content_obj)
-
-def _parse_message_node(node: dict) -> dict | None:
-    if not node or "message" not in node or node["message"] is None:
-        return None
-    msg = node["message"]
-    metadata = msg.get("metadata", {})
-    author = msg.get("author", {})
-    content = msg.get("content", {})
-    _, formatted_create_time = _normalize_and_format_timestamp(msg.get("create_time"))
-
-    is_hidden = metadata.get("is_visually_hidden_from_conversation", False)
-    author_role = author.get("role")
-    content_type = content.get("content_type")
-
-    if author_role == "tool": is_hidden = True
-    elif author_role == "assistant" and content_type == "code": is_hidden = True
-
-    final_citations = metadata.get("citations", [])
-
-    parsed_msg = {
-        "message_id": msg.get("id"),
-        "role": author_role,
-        "create_time": formatted_create_time,
-        "content_type": content_type,
-        "text": _get_content_text(content),
-        "status": msg.get("status"),
-        "is_hidden": is_hidden,
-        "model_slug": metadata.get("model_slug"),
-        "finish_details": metadata.get("finish_details"),
-        "citations": final_citations, # Use the preserved list
-        "search_results": [], # This can be kept empty for now
-        "custom_instructions": None
-    }
-    
-    if metadata.get("is_user_system_message", False):
-         user_context = metadata.get("user_context_message_data", {})
-         parsed_msg["custom_instructions"] = user_context.get("about_model_message")
-
-    return parsed_msg
-
-def _parse_single_conversation(convo_data: dict) -> dict | None:
-    mapping = convo_data.get("mapping", {})
-    if not mapping: return None
-    
-    root_id = None
-    for node_id, node in mapping.items():
-        if node.get("parent") is None:
-            root_id = node_id
-            break
-    if not root_id: return None
-
-    ordered_messages = []
-    current_node_id = root_id
-    while current_node_id:
-        node = mapping.get(current_node_id)
-        if not node: break
-        parsed_message = _parse_message_node(node)
-        if parsed_message:
-            ordered_messages.append(parsed_message)
-        children = node.get("children", [])
-        current_node_id = children[0] if children else None
-
-    if not ordered_messages:
-        return None
-
-    custom_instructions_text = None
-    final_messages = []
-    for msg in ordered_messages:
-        if msg.get("content_type") == "user_editable_context":
-            custom_instructions_text = msg.get("custom_instructions")
-        else:
-            final_messages.append(msg)
-
-    if custom_instructions_text and final_messages:
-        for msg in final_messages:
-            if not msg.get("is_hidden"):
-                msg["custom_instructions"] = custom_instructions_text
+        while True:
+            item = _get_until_stopped(in_queue, stop)
+            if item is _PIPELINE_DONE:
                 break
-    
-    if final_messages:
-        normalized_create_time, _ = _normalize_and_format_timestamp(convo_data.get("create_time", 0))
-        normalized_update_time, _ = _normalize_and_format_timestamp(convo_data.get("update_time", 0))
-        return {
-            "title": convo_data.get("title", "Untitled Chat"),
-            "create_time": normalized_create_time,
-            "update_time": normalized_update_time,
-            "messages": final_messages
-        }
-        
-    return None
-
-def parse_chatgpt_export(json_data: list) -> list:
-    all_parsed_conversations = []
-    for convo_data in json_data:
-        parsed_conv = _parse_single_conversation(convo_data)
-        if parsed_conv:
-            all_parsed_conversations.append(parsed_conv)
-    print(f"Successfully parsed {len(all_parsed_conversations)} conversations with rich metadata.")
-    return all_parsed_conversations
+            batch, read_fraction = item
+            embeddings = embed_texts(batch, background=True)
+            if not _put_until_stopped(out_queue, (batch, embeddings, read_fraction), stop):
+                return
+        _put_until_stopped(out_queue, _PIPELINE_DONE, stop)
+    except Exception as e:
+        errors.append(e)
+        stop.set()
 
-def process_and_store_file(file_content: str, filename: str):
+def process_and_store_file(file_path: str, filename: str, job: Job = None, file_id: str | None = None) -> tuple[str | None, int]:
+    """
+    Chunks, embeds and stores a text file, reporting progress to job if given.
+    If any stage fails or the job is cancelled, the chunks already written are removed
+    again and no source is registered. Returns the new source ID (None if the file
+    had no content) and the number of chunks stored. file_id is generated unless given.
+    """
     print(f"Processing file: {filename}")
-    file_id = f"file_{uuid.uuid4().hex}"
-    text_chunks = split_text_into_chunks(file_content)
-    if not text_chunks:
-        print(f"File {filename} has no content to process.")
-        return
-    print(f"Split file into {len(text_chunks)} chunks.")
+    file_id = file_id or f"file_{uuid.uuid4().hex}"
+    file_size = os.path.getsize(file_path)
+    chunk_queue = queue.Queue(maxsize=FILE_PIPELINE_QUEUE_SIZE)
+    embedded_queue = queue.Queue(maxsize=FILE_PIPELINE_QUEUE_SIZE)
+    stop = threading.Event()
+    errors = []
+
+    stages = [
+        threading.Thread(target=_chunk_stage, args=(file_path, file_size, chunk_queue, stop, errors), daemon=True),
+        threading.Thread(target=_embed_stage, args=(chunk_queue, embedded_queue, stop, errors), daemon=True),
+    ]
+    for stage in stages:
+        stage.start()
+
+    total_chunks = 0
     try:
-        chunk_embeddings = embed_texts(text_chunks)
-        print("Successfully created embeddings for all chunks.")
+        while True:
+            item = _get_until_stopped(embedded_queue, stop)
+            if item is _PIPELINE_DONE:
+                break
+            text_chunks, chunk_embeddings, read_fraction = item
+            ids = []
+            metadatas = []
+            for i, chunk in enumerate(text_chunks, start=total_chunks):
+                ids.append(f"{file_id}chunk{i}")
+                metadatas.append({
+                    "source_id": file_id, 
+                    "source_type": "file",
+                    "source_name": filename, 
+                    "chunk_num": i
+                })
+            save_chunks_to_memory(
+                ids=ids, 
+                chunks=text_chunks,
+                embeddings=chunk_embeddings, 
+                metadatas=metadatas
+            )
+            total_chunks += len(text_chunks)
+            if job:
+                job.report(min(int(read_fraction * 100), 99), f"Stored {total_chunks} chunks of {filename}")
+        if errors:
+            raise errors[0]
     except Exception as e:
-        print(f"Error creating embeddings: {e}")
-        return
-    metadatas = []
-    ids = []
-    for i, chunk in enumerate(text_chunks):
-        chunk_id = f"{file_id}chunk{i}"
-        ids.append(chunk_id)
-        metadatas.append({
-            "source_id": file_id, 
-            "source_type": "file",
-            "source_name": filename, 
-            "chunk_num": i
-        })
-    save_chunks_to_memory(
-        ids=ids, 
-        chunks=text_chunks,
-        embeddings=chunk_embeddings, 
-        metadatas=metadatas
-    )
+        stop.set()
+        print(f"Error processing file {filename}: {e}. Rolling back {total_chunks} stored chunks.")
+        if total_chunks:
+            delete_chunks_for_source(file_id)
+        raise
+    finally:
+        for stage in stages:
+            stage.join()
+
+    if not total_chunks:
+        print(f"File {filename} has no content to process.")
+        return None, 0
     add_file_source(file_id, filename)
-    print(f"Successfully processed and stored file {filename} with source_id {file_id}")
-
-def split_text_into_chunks(text: str, chunk_size: int = 1000, chunk_overlap: int = 200) -> list[str]:
-    if not text: return []
-    chunks = []
-    start = 0
-    while start < len(text):
-        end = start + chunk_size
-        chunks.append(text[start:end])
-        start += chunk_size - chunk_overlap
-    return chunks
+    print(f"Successfully processed and stored file {filename} ({total_chunks} chunks) with source_id {file_id}")
+    return file_id, total_chunks
+
+def run_file_upload_job(job: Job) -> str:
+    """
+    Job handler for /sources/upload: ingests the spooled file. The source ID is checkpointed
+    before any chunk is written. If the process died mid-upload, the resumed job deletes that
+    source's chunks and ingests the file again under the same ID, so nothing is left twice.
+    """
+    filename = job.payload["filename"]
+    if job.checkpoint:
+        file_id = job.checkpoint["file_id"]
+        print(f"Resuming upload of {filename}: removing chunks stored by the interrupted run.")
+        delete_chunks_for_source(file_id)
+    else:
+        file_id = f"file_{uuid.uuid4().hex}"
+        job.save_checkpoint({"file_id": file_id})
+    file_id, total_chunks = process_and_store_file(job.payload["spool_path"], filename, job=job, file_id=file_id)
+    if not file_id:
+        return f"'{filename}' has no content to add."
+    return f"✅ Added '{filename}' ({total_chunks} chunks)."
+
+job_manager.register("file_upload", run_file_upload_job)
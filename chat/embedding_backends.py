@@ -0,0 +1,298 @@
+# chat/embedding_backends.py
+
+import json
+import multiprocessing
+import os
+from concurrent.futures import Future, ProcessPoolExecutor
+
+# --- Configuration ---
+# "torch" runs sentence-transformers on PyTorch. "onnx" runs an exported fp32 ONNX model and
+# "onnx-int8" a dynamically quantized copy of it, both on onnxruntime without importing torch.
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+# Threads used for one inference (intra-op) and across independent operators (inter-op). 0 keeps the library default.
+EMBEDDING_NUM_THREADS = int(os.getenv("EMBEDDING_NUM_THREADS", "0"))
+EMBEDDING_INTER_OP_THREADS = int(os.getenv("EMBEDDING_INTER_OP_THREADS", "0"))
+# Exported models are written here, one directory per model.
+EMBEDDING_ONNX_DIR = os.getenv("EMBEDDING_ONNX_DIR", "storage/onnx")
+
+# The parity check fails if any sample's cosine similarity with the torch embedding is below this.
+PARITY_MIN_COSINE = {"onnx": 0.999, "onnx-int8": 0.98}
+PARITY_SAMPLE_TEXTS = [
+    "How do I reset my password?",
+    "The quarterly report shows revenue grew by 12 percent compared to last year.",
+    "Error E_1234: connection refused while contacting the database server.",
+    "def add(a, b):\n    return a + b",
+    "Photosynthesis converts light energy into chemical energy stored in glucose.",
+    "ok",
+]
+
+_ONNX_INSTALL_HINT = "pip install onnxruntime tokenizers numpy"
+
+# --- Backends ---
+class TorchEmbeddingBackend:
+    """The original backend: sentence-transformers on PyTorch."""
+
+    def __init__(self, model_name: str, num_threads: int = EMBEDDING_NUM_THREADS):
+        # Imported here because sentence_transformers pulls in torch, which is slow to import.
+        import torch
+        from sentence_transformers import SentenceTransformer
+        if num_threads > 0:
+            torch.set_num_threads(num_threads)
+        if EMBEDDING_INTER_OP_THREADS > 0:
+            torch.set_num_interop_threads(EMBEDDING_INTER_OP_THREADS)
+        self.name = "torch"
+        self.model = SentenceTransformer(model_name)
+
+    def encode(self, texts: list[str]) -> list[list[float]]:
+        return self.model.encode(texts, convert_to_tensor=False).tolist()
+
+    def token_starts(self, text: str) -> list[int]:
+        encoded = self.model.tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+        return [start for start, _ in encoded["offset_mapping"]]
+
+class OnnxEmbeddingBackend:
+    """
+    The same model exported to ONNX and run by onnxruntime, with the tokenizer from the
+    `tokenizers` package. Pooling and normalization follow the sentence-transformers pipeline
+    recorded at export time, so embeddings match the torch backend.
+    """
+
+    def __init__(self, model_name: str, quantized: bool = False, num_threads: int = EMBEDDING_NUM_THREADS, verify_parity: bool = True):
+        try:
+            import numpy
+            import onnxruntime
+            from tokenizers import Tokenizer
+        except ImportError as e:
+            raise RuntimeError(
+                f"EMBEDDING_BACKEND={'onnx-int8' if quantized else 'onnx'} needs the optional packages "
+                f"onnxruntime, tokenizers and numpy ({_ONNX_INSTALL_HINT}). Missing: {e.name}"
+            ) from e
+        self.name = "onnx-int8" if quantized else "onnx"
+        self._np = numpy
+
+        model_dir = _export_dir(model_name)
+        if not os.path.exists(os.path.join(model_dir, "export_config.json")):
+            print(f"No ONNX export of {model_name} found, exporting it once to {model_dir}...")
+            export_onnx_model(model_name)
+        if verify_parity:
+            _require_parity(model_name, self.name)
+        with open(os.path.join(model_dir, "export_config.json")) as f:
+            self.config = json.load(f)
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        if EMBEDDING_INTER_OP_THREADS > 0:
+            options.inter_op_num_threads = EMBEDDING_INTER_OP_THREADS
+        model_file = "model.int8.onnx" if quantized else "model.onnx"
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(model_dir, model_file), options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+
+        tokenizer_file = os.path.join(model_dir, "tokenizer.json")
+        self.tokenizer = Tokenizer.from_file(tokenizer_file)
+        self.tokenizer.enable_truncation(max_length=self.config["max_seq_length"])
+        self.tokenizer.enable_padding(pad_id=self.config["pad_token_id"], pad_token=self.config["pad_token"])
+        # A second copy without truncation, for counting tokens in whole documents when chunking.
+        self.chunk_tokenizer = Tokenizer.from_file(tokenizer_file)
+        self.chunk_tokenizer.no_truncation()
+        self.chunk_tokenizer.no_padding()
+
+    def encode(self, texts: list[str]) -> list[list[float]]:
+        np = self._np
+        encodings = self.tokenizer.encode_batch(texts)
+        attention_mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+        feeds = {
+            "input_ids": np.array([encoding.ids for encoding in encodings], dtype=np.int64),
+            "attention_mask": attention_mask,
+        }
+        if "token_type_ids" in self.input_names:
+            feeds["token_type_ids"] = np.array([encoding.type_ids for encoding in encodings], dtype=np.int64)
+        hidden = self.session.run(["last_hidden_state"], feeds)[0]
+
+        pooling = self.config["pooling"]
+        if pooling == "cls":
+            embeddings = hidden[:, 0]
+        elif pooling == "max":
+            embeddings = np.where(attention_mask[:, :, None] > 0, hidden, -1e9).max(axis=1)
+        else:
+            mask = attention_mask[:, :, None].astype(hidden.dtype)
+            embeddings = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        if self.config["normalize"]:
+            embeddings = embeddings / np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        return embeddings.astype(np.float32).tolist()
+
+    def token_starts(self, text: str) -> list[int]:
+        return [start for start, _ in self.chunk_tokenizer.encode(text, add_special_tokens=False).offsets]
+
+def create_embedding_backend(model_name: str, backend: str = EMBEDDING_BACKEND, num_threads: int = EMBEDDING_NUM_THREADS):
+    if backend == "torch":
+        return TorchEmbeddingBackend(model_name, num_threads=num_threads)
+    if backend in ("onnx", "onnx-int8"):
+        return OnnxEmbeddingBackend(model_name, quantized=backend == "onnx-int8", num_threads=num_threads)
+    raise ValueError(f"Unknown EMBEDDING_BACKEND '{backend}'. Use 'torch', 'onnx' or 'onnx-int8'.")
+
+# --- Worker processes for bulk embedding ---
+_pool_backend = None
+
+def _init_pool_worker(model_name: str, backend: str, num_threads: int):
+    global _pool_backend
+    _pool_backend = create_embedding_backend(model_name, backend, num_threads=num_threads)
+
+def _encode_in_pool_worker(texts: list[str]) -> list[list[float]]:
+    return _pool_backend.encode(texts)
+
+class EmbeddingProcessPool:
+    """
+    Embeds batches on worker processes that each load their own copy of the model, for bulk jobs
+    like reindexing where one process cannot keep every core busy. The cores are split evenly
+    between the workers. Workers are spawned rather than forked, since forking a process that
+    has already started torch's thread pool can hang.
+    """
+
+    def __init__(self, model_name: str, backend: str = EMBEDDING_BACKEND, workers: int = 2):
+        num_threads = max(1, (os.cpu_count() or workers) // workers)
+        self.workers = workers
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_pool_worker, initargs=(model_name, backend, num_threads)
+        )
+
+    def submit(self, texts: list[str]) -> Future:
+        """Queues a batch. The future's result is the list of embeddings, in order."""
+        return self._executor.submit(_encode_in_pool_worker, texts)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+# --- Export and parity ---
+def _export_dir(model_name: str) -> str:
+    return os.path.join(EMBEDDING_ONNX_DIR, model_name.replace("/", "__"))
+
+def _parity_file(model_name: str) -> str:
+    return os.path.join(_export_dir(model_name), "parity.json")
+
+def _load_parity_results(model_name: str) -> dict:
+    """Parity check results recorded for the current export, by backend."""
+    if not os.path.exists(_parity_file(model_name)):
+        return {}
+    with open(_parity_file(model_name)) as f:
+        return json.load(f)
+
+def _require_parity(model_name: str, backend: str):
+    """
+    Raises unless the export for backend has passed the parity check. The result is recorded in the
+    export directory, so the check (which needs torch) runs once per export, not on every start.
+    """
+    results = _load_parity_results(model_name)
+    if backend in results:
+        passed = results[backend]["passed"]
+    else:
+        try:
+            passed = check_backend_parity(model_name, backend)
+        except ImportError as e:
+            raise RuntimeError(
+                f"The {backend} export of {model_name} has not been checked against torch, and torch is not "
+                f"installed here ({e.name} is missing). Run `python -m chat.embedding_backends {backend}` where "
+                f"it is and copy the export directory, which records the result."
+            ) from e
+    if not passed:
+        raise RuntimeError(
+            f"The {backend} export of {model_name} failed the parity check against torch "
+            f"(min cosine below {PARITY_MIN_COSINE.get(backend, 0.999)}). Use EMBEDDING_BACKEND=torch, "
+            f"or delete {_export_dir(model_name)} to export again."
+        )
+
+def export_onnx_model(model_name: str) -> str:
+    """
+    Exports the sentence-transformers model to ONNX (fp32), writes a dynamically quantized
+    int8 copy, and saves the tokenizer and pooling settings next to them. Needs torch,
+    sentence-transformers and onnxruntime, but only once; the export directory can be copied
+    to hosts without torch. Returns the export directory.
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    model_dir = _export_dir(model_name)
+    os.makedirs(model_dir, exist_ok=True)
+    # Parity results belong to the previous export.
+    if os.path.exists(_parity_file(model_name)):
+        os.remove(_parity_file(model_name))
+    st_model = SentenceTransformer(model_name, device="cpu")
+    tokenizer = st_model.tokenizer
+
+    class _LastHiddenState(torch.nn.Module):
+        def __init__(self, transformer):
+            super().__init__()
+            self.transformer = transformer
+
+        def forward(self, input_ids, attention_mask, token_type_ids=None):
+            return self.transformer(
+                input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids
+            ).last_hidden_state
+
+    sample = tokenizer(["export sample"], return_tensors="pt")
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names + ["last_hidden_state"]}
+    fp32_path = os.path.join(model_dir, "model.onnx")
+    with torch.no_grad():
+        torch.onnx.export(
+            _LastHiddenState(st_model[0].auto_model.eval()),
+            tuple(sample[name] for name in input_names),
+            fp32_path,
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes,
+            opset_version=14,
+        )
+    quantize_dynamic(fp32_path, os.path.join(model_dir, "model.int8.onnx"), weight_type=QuantType.QInt8)
+
+    tokenizer.save_pretrained(model_dir)
+    pooling_module = next(module for module in st_model if type(module).__name__ == "Pooling")
+    with open(os.path.join(model_dir, "export_config.json"), "w") as f:
+        json.dump({
+            "model_name": model_name,
+            "pooling": pooling_module.get_pooling_mode_str(),
+            "normalize": any(type(module).__name__ == "Normalize" for module in st_model),
+            "max_seq_length": st_model.max_seq_length,
+            "pad_token": tokenizer.pad_token,
+            "pad_token_id": tokenizer.pad_token_id,
+        }, f, indent=2)
+    print(f"Exported {model_name} to ONNX (fp32 and int8) in {model_dir}.")
+    return model_dir
+
+def check_backend_parity(model_name: str, backend: str, texts: list[str] = None) -> bool:
+    """
+    Embeds sample texts with the torch backend and the given ONNX backend and compares them.
+    Prints the lowest cosine similarity, records the result next to the export, and returns
+    whether it meets PARITY_MIN_COSINE.
+    """
+    import numpy as np
+    texts = texts or PARITY_SAMPLE_TEXTS
+    reference = np.array(TorchEmbeddingBackend(model_name).encode(texts))
+    candidate = np.array(
+        OnnxEmbeddingBackend(model_name, quantized=backend == "onnx-int8", verify_parity=False).encode(texts)
+    )
+    cosine = (reference * candidate).sum(axis=1) / (
+        np.linalg.norm(reference, axis=1) * np.linalg.norm(candidate, axis=1)
+    )
+    min_cosine = float(cosine.min())
+    passed = min_cosine >= PARITY_MIN_COSINE.get(backend, 0.999)
+    print(f"Parity of '{backend}' against torch for {model_name}: min cosine {min_cosine:.5f} ({'OK' if passed else 'FAILED'}).")
+    results = _load_parity_results(model_name)
+    results[backend] = {"passed": passed, "min_cosine": min_cosine}
+    with open(_parity_file(model_name), "w") as f:
+        json.dump(results, f, indent=2)
+    return passed
+
+if __name__ == "__main__":
+    # python -m chat.embedding_backends [onnx|onnx-int8]: export (if needed) and run the parity check.
+    import sys
+    from chat.ai_services import EMBEDDING_MODEL_NAME
+    backend = sys.argv[1] if len(sys.argv) > 1 else "onnx-int8"
+    if not os.path.exists(os.path.join(_export_dir(EMBEDDING_MODEL_NAME), "export_config.json")):
+        export_onnx_model(EMBEDDING_MODEL_NAME)
+    sys.exit(0 if check_backend_parity(EMBEDDING_MODEL_NAME, backend) else 1)
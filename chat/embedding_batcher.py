@@ -0,0 +1,149 @@
+# chat/embedding_batcher.py
+
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+class _PendingRequest:
+    """One submitted request, encoded max_batch_size texts at most per batch."""
+
+    def __init__(self, texts: list[str], future: Future):
+        self.texts = texts
+        self.future = future
+        self.embeddings = [None] * len(texts)
+        self.next_offset = 0  # First text not yet handed to a batch.
+        self.remaining = len(texts)  # Texts not yet encoded.
+
+class EmbeddingBatcher:
+    """
+    A dedicated embedding worker thread that merges concurrent embedding requests.
+    Requests arriving within a short window are encoded together in one batch
+    (capped at max_batch_size texts), and each caller gets its own Future back.
+    A request larger than the cap is encoded in max_batch_size slices. Slices of
+    background requests take turns with each other, and interactive requests
+    (a search query, a live message) go ahead of them in every batch.
+    """
+
+    def __init__(self, encode_fn, max_batch_size: int = 64, max_wait_ms: float = 5.0):
+        self.encode_fn = encode_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        # Requests with texts still to encode, owned by the worker thread.
+        self._interactive = deque()
+        self._background = deque()
+        self._worker = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_worker(self):
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._start_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self._worker.start()
+
+    def submit(self, texts: list[str], background: bool = False) -> Future:
+        """
+        Queues texts for embedding. The Future resolves to one embedding per text.
+        Background requests (imports, uploads) yield to interactive ones.
+        """
+        future = Future()
+        if not texts:
+            future.set_result([])
+            return future
+        self._ensure_worker()
+        self._queue.put((_PendingRequest(list(texts), future), background))
+        return future
+
+    def embed(self, texts: list[str], background: bool = False) -> list[list[float]]:
+        """Blocking helper: submits texts and waits for their embeddings."""
+        return self.submit(texts, background).result()
+
+    def _accept(self, item: tuple[_PendingRequest, bool]):
+        request, background = item
+        (self._background if background else self._interactive).append(request)
+
+    def _pending_size(self) -> int:
+        return sum(len(r.texts) - r.next_offset for r in self._interactive) + \
+            sum(len(r.texts) - r.next_offset for r in self._background)
+
+    def _take_slices(self) -> list[tuple[_PendingRequest, int, int]]:
+        """
+        Fills one batch with (request, start, end) slices. Interactive requests are taken
+        first, in arrival order. Background requests then get one slice each in turn, and a
+        request with texts left over goes to the back of the line.
+        """
+        slices = []
+        room = self.max_batch_size
+        while room and self._interactive:
+            request = self._interactive[0]
+            end = min(len(request.texts), request.next_offset + room)
+            slices.append((request, request.next_offset, end))
+            room -= end - request.next_offset
+            request.next_offset = end
+            if end == len(request.texts):
+                self._interactive.popleft()
+        while room and self._background:
+            share = max(1, room // len(self._background))
+            request = self._background.popleft()
+            end = min(len(request.texts), request.next_offset + share)
+            slices.append((request, request.next_offset, end))
+            room -= end - request.next_offset
+            request.next_offset = end
+            if end < len(request.texts):
+                self._background.append(request)
+        return slices
+
+    def _collect_batch(self) -> list[tuple[_PendingRequest, int, int]]:
+        """Waits for work, then gathers more requests until the window closes or the batch is full."""
+        if not self._interactive and not self._background:
+            self._accept(self._queue.get())
+        deadline = time.monotonic() + self.max_wait
+
+        while self._pending_size() < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                self._accept(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        # Anything already queued is considered too, so a query that arrives while a large
+        # background request fills the batch still goes ahead of it.
+        while True:
+            try:
+                self._accept(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return self._take_slices()
+
+    def _fail(self, request: _PendingRequest, error: Exception):
+        if request.future.done():
+            return
+        request.future.set_exception(error)
+        for pending in (self._interactive, self._background):
+            if request in pending:
+                pending.remove(request)
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            all_texts = [text for request, start, end in batch for text in request.texts[start:end]]
+            try:
+                embeddings = self.encode_fn(all_texts)
+            except Exception as e:
+                for request, _, _ in batch:
+                    self._fail(request, e)
+                continue
+
+            offset = 0
+            for request, start, end in batch:
+                if not request.future.done():
+                    request.embeddings[start:end] = embeddings[offset:offset + end - start]
+                    request.remaining -= end - start
+                    if not request.remaining:
+                        request.future.set_result(request.embeddings)
+                offset += end - start
@@ -0,0 +1,146 @@
+# chat/embedding_cache.py
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+EMBEDDING_CACHE_FILE = "storage/embedding_cache.sqlite"
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "1") == "1"
+# Size-based eviction: the disk cache keeps at most this many embeddings, dropping the least recently used.
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "500000"))
+# Number of embeddings kept in the in-process LRU in front of the disk cache.
+EMBEDDING_CACHE_MEMORY_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MEMORY_ENTRIES", "20000"))
+
+# SQLite limits the number of parameters in one statement, so lookups are chunked.
+_SQL_BATCH_SIZE = 500
+# Recency updates from lookups are buffered and written at most this often (or once this many
+# are pending, or with the next write), so a cache hit does not cost a write and a commit.
+_TOUCH_FLUSH_INTERVAL_SECONDS = 30
+_TOUCH_FLUSH_MAX_PENDING = 5000
+
+def _cache_key(model_name: str, text: str) -> str:
+    """Content address of an embedding: the model name plus a hash of the text."""
+    digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+    return f"{model_name}:{digest}"
+
+class EmbeddingCache:
+    """
+    A disk-backed (SQLite) embedding cache with an in-process LRU in front of it.
+    Vectors are stored as float32 blobs keyed by model name and text hash.
+    """
+
+    def __init__(self, path: str, max_entries: int, memory_entries: int):
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self._memory = OrderedDict()
+        # key -> last lookup time, not yet written to last_used.
+        self._pending_touches = {}
+        self._last_touch_flush = time.monotonic()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used)")
+        self._conn.commit()
+        # An upper bound on the row count, so we only count rows when eviction may be needed.
+        self._approx_count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def _remember(self, key: str, vector: list[float]):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get_many(self, model_name: str, texts: list[str]) -> list[list[float] | None]:
+        """Returns the cached embedding for each text, or None where it is not cached."""
+        keys = [_cache_key(model_name, text) for text in texts]
+        found = {}
+        with self._lock:
+            disk_keys = []
+            for key in keys:
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[key] = self._memory[key]
+                elif key not in found:
+                    disk_keys.append(key)
+
+            unique_disk_keys = list(dict.fromkeys(disk_keys))
+            for start in range(0, len(unique_disk_keys), _SQL_BATCH_SIZE):
+                batch = unique_disk_keys[start:start + _SQL_BATCH_SIZE]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    vector = array('f')
+                    vector.frombytes(blob)
+                    found[key] = vector.tolist()
+                    self._remember(key, found[key])
+
+            if found:
+                now = time.time()
+                for key in found:
+                    self._pending_touches[key] = now
+                if len(self._pending_touches) >= _TOUCH_FLUSH_MAX_PENDING or \
+                        time.monotonic() - self._last_touch_flush >= _TOUCH_FLUSH_INTERVAL_SECONDS:
+                    self._flush_touches()
+                    self._conn.commit()
+        return [found.get(key) for key in keys]
+
+    def _flush_touches(self):
+        """Writes buffered lookup times to last_used. The caller holds the lock and commits."""
+        if self._pending_touches:
+            self._conn.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                [(now, key) for key, now in self._pending_touches.items()]
+            )
+            self._pending_touches.clear()
+        self._last_touch_flush = time.monotonic()
+
+    def put_many(self, model_name: str, texts: list[str], embeddings: list[list[float]]):
+        """Stores embeddings for the given texts and evicts the oldest entries if the cache is full."""
+        now = time.time()
+        rows = []
+        with self._lock:
+            for text, embedding in zip(texts, embeddings):
+                key = _cache_key(model_name, text)
+                self._remember(key, list(embedding))
+                rows.append((key, array('f', embedding).tobytes(), now))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)", rows
+            )
+            for key, _, _ in rows:
+                self._pending_touches.pop(key, None)
+            # Written with the inserts, so eviction sees up-to-date recency.
+            self._flush_touches()
+            self._approx_count += len(rows)
+            if self._approx_count > self.max_entries:
+                self._evict_if_needed()
+            self._conn.commit()
+
+    def _evict_if_needed(self):
+        count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        self._approx_count = count
+        if count <= self.max_entries:
+            return
+        # Evict a little more than needed so we don't evict on every single insert.
+        to_remove = count - int(self.max_entries * 0.9)
+        self._conn.execute(
+            "DELETE FROM embeddings WHERE key IN "
+            "(SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)", (to_remove,)
+        )
+        self._approx_count = count - to_remove
+        print(f"Embedding cache full. Evicted {to_remove} least recently used embeddings.")
+
+embedding_cache = EmbeddingCache(
+    EMBEDDING_CACHE_FILE, EMBEDDING_CACHE_MAX_ENTRIES, EMBEDDING_CACHE_MEMORY_ENTRIES
+) if EMBEDDING_CACHE_ENABLED else None
@@ -0,0 +1,125 @@
+# chat/export_parser.py
+
+# Parsing of ChatGPT export conversations. Export parsing runs in spawned worker processes,
+# which import this module, so it must stay free of import-time side effects: no model
+# loading, no storage access, nothing beyond the standard library.
+
+import datetime
+import json
+
+# Timestamps above this are treated as milliseconds. Computed once instead of
+# calling datetime.now() for every message; it is 100x "now", so it never goes stale in practice.
+_MILLISECOND_TIMESTAMP_THRESHOLD = datetime.datetime.now().timestamp() * 100
+_fromtimestamp = datetime.datetime.fromtimestamp
+
+# --- Helper Functions ---
+def _normalize_and_format_timestamp(ts: float | None) -> tuple[float | None, str | None]:
+    if ts is None:
+        return None, None
+    normalized_ts = ts
+    try:
+        if ts > _MILLISECOND_TIMESTAMP_THRESHOLD:
+            normalized_ts = ts / 1000.0
+        iso_format = _fromtimestamp(normalized_ts).isoformat()
+        return normalized_ts, iso_format
+    except (TypeError, ValueError, OSError) as e:
+        print(f"Warning: Could not process timestamp '{ts}'. Error: {e}. Storing as is.")
+        return ts, str(ts)
+
+def _get_content_text(content_obj: dict | None) -> str:
+    if not content_obj:
+        return ""
+    content_type = content_obj.get("content_type")
+    if content_type == "text":
+        parts = content_obj.get("parts", [])
+        return "".join(part for part in parts if isinstance(part, str))
+    if content_type == "code":
+        return content_obj.get("text", "")
+    if content_type == "user_editable_context":
+        return content_obj.get("user_instructions", "")
+    return json.dumps(content_obj)
+
+def _parse_message_node(node: dict) -> dict | None:
+    if not node or "message" not in node or node["message"] is None:
+        return None
+    msg = node["message"]
+    metadata = msg.get("metadata", {})
+    author = msg.get("author", {})
+    content = msg.get("content", {})
+    _, formatted_create_time = _normalize_and_format_timestamp(msg.get("create_time"))
+
+    is_hidden = metadata.get("is_visually_hidden_from_conversation", False)
+    author_role = author.get("role")
+    content_type = content.get("content_type")
+
+    if author_role == "tool": is_hidden = True
+    elif author_role == "assistant" and content_type == "code": is_hidden = True
+
+    final_citations = metadata.get("citations", [])
+
+    parsed_msg = {
+        "message_id": msg.get("id"),
+        "role": author_role,
+        "create_time": formatted_create_time,
+        "content_type": content_type,
+        "text": _get_content_text(content),
+        "status": msg.get("status"),
+        "is_hidden": is_hidden,
+        "model_slug": metadata.get("model_slug"),
+        "finish_details": metadata.get("finish_details"),
+        "citations": final_citations, # Use the preserved list
+        "search_results": [], # This can be kept empty for now
+        "custom_instructions": None
+    }
+    
+    if metadata.get("is_user_system_message", False):
+         user_context = metadata.get("user_context_message_data", {})
+         parsed_msg["custom_instructions"] = user_context.get("about_model_message")
+
+    return parsed_msg
+
+def parse_single_conversation(convo_data: dict) -> dict | None:
+    mapping = convo_data.get("mapping", {})
+    if not mapping: return None
+    
+    root_id = next((node_id for node_id, node in mapping.items() if node.get("parent") is None), None)
+    if not root_id: return None
+
+    # Walk the first-child chain once, setting the custom instructions aside as we go.
+    custom_instructions_text = None
+    final_messages = []
+    current_node_id = root_id
+    while current_node_id:
+        node = mapping.get(current_node_id)
+        if not node: break
+        parsed_message = _parse_message_node(node)
+        if parsed_message:
+            if parsed_message["content_type"] == "user_editable_context":
+                custom_instructions_text = parsed_message["custom_instructions"]
+            else:
+                final_messages.append(parsed_message)
+        children = node.get("children")
+        current_node_id = children[0] if children else None
+
+    if custom_instructions_text and final_messages:
+        for msg in final_messages:
+            if not msg["is_hidden"]:
+                msg["custom_instructions"] = custom_instructions_text
+                break
+    
+    if final_messages:
+        normalized_create_time, _ = _normalize_and_format_timestamp(convo_data.get("create_time", 0))
+        normalized_update_time, _ = _normalize_and_format_timestamp(convo_data.get("update_time", 0))
+        return {
+            "title": convo_data.get("title", "Untitled Chat"),
+            "create_time": normalized_create_time,
+            "update_time": normalized_update_time,
+            "messages": final_messages
+        }
+        
+    return None
+
+# --- Worker Entry Point ---
+def parse_conversation_chunk(convo_chunk: list[dict]) -> list[dict | None]:
+    """Worker-process entry point: parses a chunk of conversations, keeping their order."""
+    return [parse_single_conversation(convo_data) for convo_data in convo_chunk]
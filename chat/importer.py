@@ -1,72 +1,112 @@
 # chat/importer.py
 
-import json
+import os
 import uuid
-from fastapi import APIRouter, UploadFile, File, HTTPException, BackgroundTasks
-from chat.data_processor import parse_chatgpt_export
-from chat.chat_manager import import_chat, import_messages_to_chat, generate_chat_id
-from chat.state import task_statuses
+from fastapi import APIRouter, UploadFile, File, HTTPException
+from starlette.concurrency import run_in_threadpool
+from chat.data_processor import iter_parse_chatgpt_export
+from chat.chat_manager import import_chat, record_imported_chat, import_messages_bulk, generate_chat_id
+from chat.jobs import job_manager, Job
 
 router = APIRouter()
 
-def process_conversations_background(task_id: str, json_data: list):
-    try:
-        parsed_conversations = parse_chatgpt_export(json_data)
-        if not parsed_conversations:
-            task_statuses[task_id] = {"status": "completed", "progress": 100, "message": "File processed, no new conversations found."}
-            return
-        
-        parsed_conversations.sort(key=lambda x: x.get('update_time', 0), reverse=True)
-        total_convos = len(parsed_conversations)
-        imported_count = 0
-        skipped_count = 0
+# Uploaded exports are spooled here and parsed from disk, one conversation at a time.
+UPLOAD_SPOOL_DIR = "storage/uploads"
+UPLOAD_READ_SIZE = 1 << 20
+
+# Messages from several conversations are gathered and written together once this many are pending.
+IMPORT_BATCH_MESSAGES = 2000
+
+def _import_pending_conversations(pending_conversations: list[tuple[str, dict]]) -> tuple[int, int]:
+    """
+    Writes the messages of the pending chats together, then records each chat's metadata.
+    The metadata (with last_updated) is what makes a resumed import skip a chat, so it is
+    only written once the chat's messages are stored. Returns (imported, skipped).
+    """
+    to_import = []
+    skipped_count = 0
+    for chat_id, convo in pending_conversations:
+        was_imported_or_updated = import_chat(
+            chat_id=chat_id, 
+            title=convo['title'],
+            create_timestamp=convo['create_time'],
+            update_timestamp=convo['update_time']
+        )
+        if was_imported_or_updated:
+            to_import.append((chat_id, convo))
+        else:
+            skipped_count += 1
+    if to_import:
+        import_messages_bulk([(chat_id, convo['messages']) for chat_id, convo in to_import])
+        for chat_id, convo in to_import:
+            record_imported_chat(chat_id, convo['title'], convo['create_time'], convo['update_time'])
+    return len(to_import), skipped_count
+
+def run_chatgpt_import_job(job: Job) -> str:
+    """Job handler that imports a spooled conversations.json, one conversation at a time."""
+    imported_count = 0
+    skipped_count = 0
+    pending_conversations = []
+    pending_message_count = 0
+    
+    for i, (convo, read_fraction) in enumerate(iter_parse_chatgpt_export(job.payload["spool_path"])):
+        # The total is unknown while streaming, so progress follows how much of the file has been read.
+        job.report(min(int(read_fraction * 100), 99), f"Processing conversation {i + 1}: {convo['title']}")
         
-        for i, convo in enumerate(parsed_conversations):
-            progress = int(((i + 1) / total_convos) * 100)
-            task_statuses[task_id] = {
-                "status": "processing",
-                "progress": progress,
-                "message": f"Processing {i + 1} of {total_convos}: {convo['title']}"
-            }
-            
-            # --- [CRITICAL FIX] ---
-            # Generate a stable chat_id here instead of looking for a non-existent one.
-            chat_id = generate_chat_id(convo['title'], convo['create_time'])
+        # --- [CRITICAL FIX] ---
+        # Generate a stable chat_id here instead of looking for a non-existent one.
+        chat_id = generate_chat_id(convo['title'], convo['create_time'])
+        pending_conversations.append((chat_id, convo))
+        pending_message_count += len(convo['messages'])
 
-            was_imported_or_updated = import_chat(
-                chat_id=chat_id, 
-                title=convo['title'],
-                create_timestamp=convo['create_time'],
-                update_timestamp=convo['update_time']
-            )
-            
-            if was_imported_or_updated:
-                import_messages_to_chat(chat_id=chat_id, messages=convo['messages'])
-                imported_count += 1
-            else:
-                skipped_count += 1
+        if pending_message_count >= IMPORT_BATCH_MESSAGES:
+            imported, skipped = _import_pending_conversations(pending_conversations)
+            imported_count += imported
+            skipped_count += skipped
+            pending_conversations = []
+            pending_message_count = 0
 
-        final_message = f"✅ Import complete. Added {imported_count} new/updated chats. Skipped {skipped_count} duplicates."
-        task_statuses[task_id] = {"status": "completed", "progress": 100, "message": final_message}
-    except Exception as e:
-        print(f"Error during background import (task {task_id}): {e}")
-        task_statuses[task_id] = {"status": "error", "message": f"An error occurred: {e}"}
+    if pending_conversations:
+        imported, skipped = _import_pending_conversations(pending_conversations)
+        imported_count += imported
+        skipped_count += skipped
+
+    if imported_count == 0 and skipped_count == 0:
+        return "File processed, no new conversations found."
+    return f"✅ Import complete. Added {imported_count} new/updated chats. Skipped {skipped_count} duplicates."
+
+job_manager.register("chatgpt_import", run_chatgpt_import_job)
+
+async def spool_upload_to_disk(file: UploadFile, file_path: str):
+    """Copies an upload to disk in fixed-size pieces, so it is never held in memory whole."""
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, "wb") as f:
+        while True:
+            chunk = await file.read(UPLOAD_READ_SIZE)
+            if not chunk:
+                break
+            f.write(chunk)
 
 @router.post("/import/chatgpt-conversations", tags=["Import"])
-async def handle_chatgpt_import(
-    background_tasks: BackgroundTasks,
-    file: UploadFile = File(...)
-):
+async def handle_chatgpt_import(file: UploadFile = File(...)):
     if file.filename != "conversations.json":
         raise HTTPException(status_code=400, detail="Invalid file. Please upload 'conversations.json'.")
+
+    file_path = os.path.join(UPLOAD_SPOOL_DIR, f"{uuid.uuid4().hex}.json")
     try:
-        contents = await file.read()
-        json_data = json.loads(contents)
+        await spool_upload_to_disk(file, file_path)
+        with open(file_path, "rb") as f:
+            head = f.read(64).lstrip(b"\xef\xbb\xbf \t\r\n")
+        if not head.startswith(b"["):
+            raise ValueError("expected a list of conversations")
     except Exception as e:
+        if os.path.exists(file_path):
+            os.remove(file_path)
         raise HTTPException(status_code=400, detail=f"Could not read or parse JSON file: {e}")
 
-    task_id = uuid.uuid4().hex
-    task_statuses[task_id] = {"status": "processing", "progress": 0, "message": "Upload successful, preparing to import."}
-    background_tasks.add_task(process_conversations_background, task_id, json_data)
+    # The job owns the spooled file from here on and removes it once the import has finished.
+    task_id = await run_in_threadpool(
+        job_manager.submit, "chatgpt_import", {"spool_path": file_path}, "Upload successful, preparing to import."
+    )
     
     return {"task_id": task_id, "message": "Import process started in the background."}
@@ -0,0 +1,253 @@
+# chat/jobs.py
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+JOBS_DB_FILE = "storage/jobs.sqlite"
+# Background jobs (imports, uploads, reindexing) run on this many threads at most,
+# so a burst of uploads cannot take over the threads that serve chat requests.
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+# Finished jobs are kept this long so clients can still read their final status.
+JOB_STATUS_TTL_SECONDS = int(os.getenv("JOB_STATUS_TTL_SECONDS", "3600"))
+_EVICTION_INTERVAL_SECONDS = 60
+
+FINAL_STATUSES = ("completed", "error", "cancelled")
+
+class JobCancelled(Exception):
+    """Raised inside a job handler when the job has been cancelled."""
+
+class JobInterrupted(Exception):
+    """Raised inside a job handler when the server is shutting down. The job runs again on the next start."""
+
+class Job:
+    """What a handler sees of its job: the payload, progress reporting and cancellation checks."""
+
+    def __init__(self, manager: "JobManager", job_id: str, kind: str, payload: dict, checkpoint: dict | None = None):
+        self.manager = manager
+        self.id = job_id
+        self.kind = kind
+        self.payload = payload
+        # What the handler saved with save_checkpoint before an interruption, or None on a fresh start.
+        self.checkpoint = checkpoint
+
+    def check_cancelled(self):
+        """Raises JobCancelled or JobInterrupted if the job should stop. Handlers call this between units of work."""
+        if self.manager._stopping.is_set():
+            raise JobInterrupted()
+        if self.manager._is_cancel_requested(self.id):
+            raise JobCancelled()
+
+    def report(self, progress: int | None = None, message: str | None = None):
+        """Records progress (0-99) and a status message, then checks for cancellation."""
+        self.manager._update(self.id, status="processing", progress=progress, message=message)
+        self.check_cancelled()
+
+    def save_checkpoint(self, checkpoint: dict):
+        """Persists how far the handler got, so a resumed run can continue from there instead of starting over."""
+        self.checkpoint = checkpoint
+        self.manager._save_checkpoint(self.id, checkpoint)
+
+class JobManager:
+    """
+    A persistent job queue in SQLite with a bounded worker pool. Jobs are dispatched to handlers
+    registered by kind. Jobs that were queued or running when the process stopped are queued again
+    on start, and continue from their last checkpoint if the handler saved one. A job may own a
+    spooled file (payload["spool_path"]), which is deleted once the job has finished, but kept
+    while it can still be resumed.
+    """
+
+    def __init__(self, db_file: str = JOBS_DB_FILE, workers: int = JOB_WORKERS, status_ttl_seconds: int = JOB_STATUS_TTL_SECONDS):
+        self.db_file = db_file
+        self.workers = workers
+        self.status_ttl_seconds = status_ttl_seconds
+        self._handlers = {}
+        self._executor = None
+        self._stopping = threading.Event()
+        self._last_eviction = 0.0
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(db_file), exist_ok=True)
+        self._connection().executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                progress INTEGER NOT NULL DEFAULT 0,
+                message TEXT NOT NULL DEFAULT '',
+                cancel_requested INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                finished_at REAL,
+                checkpoint TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_jobs_status_finished ON jobs(status, finished_at);
+        """)
+        columns = {row["name"] for row in self._connection().execute("PRAGMA table_info(jobs)")}
+        if "checkpoint" not in columns:
+            self._connection().execute("ALTER TABLE jobs ADD COLUMN checkpoint TEXT")
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, isolation_level=None, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # --- Registration and lifecycle ---
+    def register(self, kind: str, handler):
+        """Registers handler(job) for a job kind. Its return value becomes the final status message."""
+        self._handlers[kind] = handler
+
+    def start(self):
+        """Starts the worker pool and queues every job left unfinished by a previous run."""
+        if self._executor is not None:
+            return
+        self._stopping.clear()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="job")
+        conn = self._connection()
+        now = time.time()
+        rows = conn.execute(
+            "SELECT id, cancel_requested FROM jobs WHERE status IN ('queued', 'processing') ORDER BY created_at"
+        ).fetchall()
+        for row in rows:
+            if row["cancel_requested"]:
+                self._finish(row["id"], "cancelled", "Cancelled.")
+                continue
+            conn.execute("UPDATE jobs SET status = 'queued', updated_at = ? WHERE id = ?", (now, row["id"]))
+            self._executor.submit(self._run, row["id"])
+        if rows:
+            print(f"Resumed {len(rows)} unfinished background job(s).")
+        self._evict_finished(force=True)
+
+    def shutdown(self):
+        """
+        Stops the worker pool. Running handlers see JobInterrupted at their next check and their jobs,
+        like the ones still queued, are picked up again on the next start.
+        """
+        if self._executor is None:
+            return
+        self._stopping.set()
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._executor = None
+
+    # --- Submitting and reading jobs ---
+    def submit(self, kind: str, payload: dict, message: str = "Queued.") -> str:
+        if kind not in self._handlers:
+            raise ValueError(f"No handler registered for job kind '{kind}'.")
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self._connection().execute(
+            "INSERT INTO jobs (id, kind, payload, status, message, created_at, updated_at) VALUES (?, ?, ?, 'queued', ?, ?, ?)",
+            (job_id, kind, json.dumps(payload), message, now, now)
+        )
+        if self._executor is not None:
+            self._executor.submit(self._run, job_id)
+        self._evict_finished()
+        return job_id
+
+    def get(self, job_id: str) -> dict | None:
+        """Returns a job's public status: id, kind, status, progress and message."""
+        self._evict_finished()
+        row = self._connection().execute(
+            "SELECT id, kind, status, progress, message FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def cancel(self, job_id: str) -> dict | None:
+        """Cancels a queued job immediately, or asks a running one to stop at its next check."""
+        job = self.get(job_id)
+        if job is None or job["status"] in FINAL_STATUSES:
+            return job
+        # The flag is set first in every case, so a worker that picks the job up concurrently sees it.
+        self._connection().execute(
+            "UPDATE jobs SET cancel_requested = 1, message = 'Cancelling...', updated_at = ? WHERE id = ?",
+            (time.time(), job_id)
+        )
+        if job["status"] == "queued":
+            self._finish(job_id, "cancelled", "Cancelled before it started.", only_if_status="queued")
+        return self.get(job_id)
+
+    # --- Internals ---
+    def _is_cancel_requested(self, job_id: str) -> bool:
+        row = self._connection().execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return bool(row and row[0])
+
+    def _update(self, job_id: str, status: str, progress: int | None = None, message: str | None = None):
+        self._connection().execute(
+            "UPDATE jobs SET status = ?, progress = COALESCE(?, progress), message = COALESCE(?, message), updated_at = ? WHERE id = ?",
+            (status, progress, message, time.time(), job_id)
+        )
+
+    def _save_checkpoint(self, job_id: str, checkpoint: dict):
+        self._connection().execute(
+            "UPDATE jobs SET checkpoint = ?, updated_at = ? WHERE id = ?", (json.dumps(checkpoint), time.time(), job_id)
+        )
+
+    def _finish(self, job_id: str, status: str, message: str, only_if_status: str | None = None):
+        """Marks a job finished. With only_if_status, does nothing unless the job is still in that status."""
+        conn = self._connection()
+        row = conn.execute("SELECT payload FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        now = time.time()
+        progress_update = ", progress = 100" if status == "completed" else ""
+        status_check = " AND status = ?" if only_if_status else ""
+        updated = conn.execute(
+            f"UPDATE jobs SET status = ?, message = ?, updated_at = ?, finished_at = ?{progress_update} WHERE id = ?{status_check}",
+            (status, message, now, now, job_id) + ((only_if_status,) if only_if_status else ())
+        ).rowcount
+        if not updated:
+            return
+        spool_path = json.loads(row["payload"]).get("spool_path") if row else None
+        if spool_path and os.path.exists(spool_path):
+            os.remove(spool_path)
+
+    def _run(self, job_id: str):
+        conn = self._connection()
+        # Claiming the job is one conditional update, so a job cancelled (or claimed) in the
+        # meantime is never moved back to processing.
+        claimed = conn.execute(
+            "UPDATE jobs SET status = 'processing', message = 'Starting.', updated_at = ? WHERE id = ? AND status = 'queued'",
+            (time.time(), job_id)
+        ).rowcount
+        if not claimed:
+            return
+        row = conn.execute("SELECT kind, payload, checkpoint FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        handler = self._handlers.get(row["kind"])
+        if handler is None:
+            self._finish(job_id, "error", f"No handler registered for job kind '{row['kind']}'.")
+            return
+        checkpoint = json.loads(row["checkpoint"]) if row["checkpoint"] else None
+        job = Job(self, job_id, row["kind"], json.loads(row["payload"]), checkpoint)
+        try:
+            job.check_cancelled()
+            final_message = handler(job)
+            self._finish(job_id, "completed", final_message or "Done.")
+        except JobCancelled:
+            print(f"Background job {job_id} ({row['kind']}) was cancelled.")
+            self._finish(job_id, "cancelled", "Cancelled.")
+        except JobInterrupted:
+            print(f"Background job {job_id} ({row['kind']}) was interrupted by shutdown and will resume on next start.")
+            self._update(job_id, status="queued", message="Interrupted by a restart, waiting to resume.")
+        except Exception as e:
+            print(f"Error in background job {job_id} ({row['kind']}): {e}")
+            self._finish(job_id, "error", f"An error occurred: {e}")
+
+    def _evict_finished(self, force: bool = False):
+        """Deletes finished jobs older than the status TTL. Runs at most once a minute."""
+        now = time.time()
+        if not force and now - self._last_eviction < _EVICTION_INTERVAL_SECONDS:
+            return
+        self._last_eviction = now
+        self._connection().execute(
+            "DELETE FROM jobs WHERE status IN ('completed', 'error', 'cancelled') AND finished_at < ?",
+            (now - self.status_ttl_seconds,)
+        )
+
+job_manager = JobManager()
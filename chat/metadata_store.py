@@ -0,0 +1,492 @@
+# chat/metadata_store.py
+
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+CHAT_STATE_FILE = "storage/chat_state.json"
+SOURCES_META_FILE = "storage/sources_meta.json"
+CHAT_SEQUENCES_FILE = "storage/chat_sequences.json"
+METADATA_DB_FILE = "storage/metadata.sqlite"
+
+# "sqlite" (default) or "json" for the legacy whole-file JSON storage.
+METADATA_BACKEND = os.getenv("METADATA_BACKEND", "sqlite")
+
+CHAT_FIELDS = ("id", "title", "timestamp", "last_updated", "archived", "model")
+SOURCE_FIELDS = ("id", "name", "type", "added_on")
+
+def _load_json_robust(filepath: str, default_value=None):
+    if os.path.exists(filepath):
+        with open(filepath, "r", encoding='utf-8') as f:
+            try:
+                content = json.load(f)
+                return content if content is not None else default_value
+            except json.JSONDecodeError:
+                return default_value
+    return default_value
+
+class MetadataStore:
+    """
+    Interface for the chat and knowledge-source metadata backends.
+    Chats and sources are plain dicts with the keys in CHAT_FIELDS and SOURCE_FIELDS.
+    """
+
+    @contextmanager
+    def transaction(self):
+        """Groups several writes so they are applied together."""
+        raise NotImplementedError
+
+    def get_chat(self, chat_id: str) -> dict | None:
+        raise NotImplementedError
+
+    def upsert_chats(self, chats: list[dict]):
+        raise NotImplementedError
+
+    def update_chat(self, chat_id: str, **fields) -> bool:
+        raise NotImplementedError
+
+    def delete_chat(self, chat_id: str) -> bool:
+        raise NotImplementedError
+
+    def list_chats(self, archived: bool) -> list[dict]:
+        """Lists active or archived chats, most recently updated first."""
+        raise NotImplementedError
+
+    def get_source(self, source_id: str) -> dict | None:
+        raise NotImplementedError
+
+    def upsert_sources(self, sources: list[dict]):
+        raise NotImplementedError
+
+    def update_source(self, source_id: str, **fields) -> bool:
+        raise NotImplementedError
+
+    def delete_source(self, source_id: str) -> bool:
+        raise NotImplementedError
+
+    def list_sources(self) -> list[dict]:
+        """Lists all sources, most recently added first."""
+        raise NotImplementedError
+
+    def get_next_order_index(self, chat_id: str) -> int | None:
+        """Returns the next free message order_index of a chat, or None if it was never recorded."""
+        raise NotImplementedError
+
+    def set_next_order_index(self, chat_id: str, next_index: int):
+        raise NotImplementedError
+
+    def delete_next_order_index(self, chat_id: str):
+        raise NotImplementedError
+
+    # --- Render cache: processed chat messages, ready to send to the frontend ---
+    # Backends without a render cache keep these defaults and every read is a miss.
+    has_render_cache = False
+
+    def get_render_cache_version(self, chat_id: str) -> str | None:
+        return None
+
+    def put_render_cache(self, chat_id: str, version: str, rendered: list[tuple[int, dict]]):
+        """Replaces a chat's cache. rendered is a list of (start_index, message) in chat order."""
+        pass
+
+    def replace_rendered_tail(self, chat_id: str, from_start_index: int, version: str, rendered: list[tuple[int, dict]]):
+        """Replaces the cached messages with start_index >= from_start_index by rendered and sets the version."""
+        pass
+
+    def get_rendered_before(self, chat_id: str, before: int | None, limit: int) -> list[tuple[int, dict]]:
+        """Returns up to limit (start_index, message) pairs with start_index < before, in chat order."""
+        return []
+
+    def get_rendered_page(self, chat_id: str, offset: int, limit: int) -> tuple[list[dict], int]:
+        """Returns (messages, total) for offset-based pages."""
+        return [], 0
+
+    def delete_render_cache(self, chat_id: str):
+        pass
+
+    def upsert_chat(self, chat: dict):
+        self.upsert_chats([chat])
+
+    def upsert_source(self, source: dict):
+        self.upsert_sources([source])
+
+class JsonMetadataStore(MetadataStore):
+    """The original storage: chat_state.json and sources_meta.json, rewritten whole on every change."""
+
+    def __init__(self, chat_state_file: str = CHAT_STATE_FILE, sources_meta_file: str = SOURCES_META_FILE, sequences_file: str = CHAT_SEQUENCES_FILE):
+        self.chat_state_file = chat_state_file
+        self.sources_meta_file = sources_meta_file
+        self.sequences_file = sequences_file
+        os.makedirs(os.path.dirname(chat_state_file), exist_ok=True)
+        os.makedirs(os.path.dirname(sources_meta_file), exist_ok=True)
+        self._lock = threading.RLock()
+        self._pending = None
+
+    def _save(self, filepath: str, data: dict):
+        with open(filepath, "w", encoding='utf-8') as f:
+            json.dump(data, f, indent=4, ensure_ascii=False)
+
+    def _read(self) -> tuple[dict, dict]:
+        """Returns (chats, sources), seeing uncommitted changes of a running transaction."""
+        if self._pending is not None:
+            return self._pending
+        return (
+            _load_json_robust(self.chat_state_file, default_value={}),
+            _load_json_robust(self.sources_meta_file, default_value={})
+        )
+
+    @contextmanager
+    def _state(self):
+        """Yields (chats, sources); writes both back unless a transaction will do it."""
+        with self._lock:
+            if self._pending is not None:
+                yield self._pending
+                return
+            chats = _load_json_robust(self.chat_state_file, default_value={})
+            sources = _load_json_robust(self.sources_meta_file, default_value={})
+            yield chats, sources
+            self._save(self.chat_state_file, chats)
+            self._save(self.sources_meta_file, sources)
+
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            if self._pending is not None:
+                yield
+                return
+            with self._state() as state:
+                self._pending = state
+                try:
+                    yield
+                finally:
+                    self._pending = None
+
+    def get_chat(self, chat_id: str) -> dict | None:
+        return self._read()[0].get(chat_id)
+
+    def upsert_chats(self, chats: list[dict]):
+        with self._state() as (chat_state, _):
+            for chat in chats:
+                chat_state[chat["id"]] = {**chat_state.get(chat["id"], {}), **chat}
+
+    def update_chat(self, chat_id: str, **fields) -> bool:
+        with self._state() as (chat_state, _):
+            if chat_id not in chat_state:
+                return False
+            chat_state[chat_id].update(fields)
+            return True
+
+    def delete_chat(self, chat_id: str) -> bool:
+        with self._state() as (chat_state, _):
+            return chat_state.pop(chat_id, None) is not None
+
+    def list_chats(self, archived: bool) -> list[dict]:
+        chat_state = self._read()[0]
+        chats = [c for c in chat_state.values() if c.get('archived', False) == archived]
+        chats.sort(key=lambda x: x.get('last_updated', 0), reverse=True)
+        return chats
+
+    def get_source(self, source_id: str) -> dict | None:
+        return self._read()[1].get(source_id)
+
+    def upsert_sources(self, sources: list[dict]):
+        with self._state() as (_, sources_meta):
+            for source in sources:
+                sources_meta[source["id"]] = {**sources_meta.get(source["id"], {}), **source}
+
+    def update_source(self, source_id: str, **fields) -> bool:
+        with self._state() as (_, sources_meta):
+            if source_id not in sources_meta:
+                return False
+            sources_meta[source_id].update(fields)
+            return True
+
+    def delete_source(self, source_id: str) -> bool:
+        with self._state() as (_, sources_meta):
+            return sources_meta.pop(source_id, None) is not None
+
+    def list_sources(self) -> list[dict]:
+        sources = self._read()[1]
+        return sorted(list(sources.values()), key=lambda x: x['added_on'], reverse=True)
+
+    def get_next_order_index(self, chat_id: str) -> int | None:
+        with self._lock:
+            return _load_json_robust(self.sequences_file, default_value={}).get(chat_id)
+
+    def set_next_order_index(self, chat_id: str, next_index: int):
+        with self._lock:
+            sequences = _load_json_robust(self.sequences_file, default_value={})
+            sequences[chat_id] = next_index
+            self._save(self.sequences_file, sequences)
+
+    def delete_next_order_index(self, chat_id: str):
+        with self._lock:
+            sequences = _load_json_robust(self.sequences_file, default_value={})
+            if sequences.pop(chat_id, None) is not None:
+                self._save(self.sequences_file, sequences)
+
+class SQLiteMetadataStore(MetadataStore):
+    """
+    Metadata in a single SQLite database in WAL mode. Each thread gets its own
+    connection, rows are indexed for the list queries, and every write is a
+    row-level upsert instead of a whole-file rewrite.
+    """
+
+    has_render_cache = True
+
+    def __init__(self, db_file: str = METADATA_DB_FILE):
+        self.db_file = db_file
+        os.makedirs(os.path.dirname(db_file), exist_ok=True)
+        self._local = threading.local()
+        self._create_schema()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, isolation_level=None, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.depth = 0
+        return conn
+
+    def _create_schema(self):
+        conn = self._connection()
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS chats (
+                id TEXT PRIMARY KEY,
+                title TEXT,
+                timestamp REAL,
+                last_updated REAL,
+                archived INTEGER NOT NULL DEFAULT 0,
+                model TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_chats_archived_updated ON chats(archived, last_updated DESC);
+            CREATE TABLE IF NOT EXISTS sources (
+                id TEXT PRIMARY KEY,
+                name TEXT,
+                type TEXT,
+                added_on REAL
+            );
+            CREATE INDEX IF NOT EXISTS idx_sources_added_on ON sources(added_on DESC);
+            CREATE TABLE IF NOT EXISTS chat_sequences (
+                chat_id TEXT PRIMARY KEY,
+                next_index INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS render_cache (
+                chat_id TEXT PRIMARY KEY,
+                version TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS rendered_messages (
+                chat_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                start_index INTEGER NOT NULL,
+                payload TEXT NOT NULL,
+                PRIMARY KEY (chat_id, position)
+            );
+            CREATE INDEX IF NOT EXISTS idx_rendered_messages_start ON rendered_messages(chat_id, start_index);
+            CREATE TABLE IF NOT EXISTS store_meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+
+    @contextmanager
+    def transaction(self):
+        conn = self._connection()
+        if self._local.depth > 0:
+            # Already inside a transaction on this thread; the outer one commits.
+            self._local.depth += 1
+            try:
+                yield
+            finally:
+                self._local.depth -= 1
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        self._local.depth = 1
+        try:
+            yield
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            self._local.depth = 0
+
+    @staticmethod
+    def _chat_from_row(row: sqlite3.Row) -> dict:
+        chat = dict(row)
+        chat["archived"] = bool(chat["archived"])
+        return chat
+
+    def get_chat(self, chat_id: str) -> dict | None:
+        row = self._connection().execute("SELECT * FROM chats WHERE id = ?", (chat_id,)).fetchone()
+        return self._chat_from_row(row) if row else None
+
+    def upsert_chats(self, chats: list[dict]):
+        rows = [
+            (c["id"], c.get("title"), c.get("timestamp"), c.get("last_updated"), int(bool(c.get("archived", False))), c.get("model"))
+            for c in chats
+        ]
+        with self.transaction():
+            self._connection().executemany(
+                "INSERT INTO chats (id, title, timestamp, last_updated, archived, model) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET title = excluded.title, timestamp = excluded.timestamp, "
+                "last_updated = excluded.last_updated, archived = excluded.archived, model = excluded.model",
+                rows
+            )
+
+    def _update(self, table: str, allowed_fields: tuple, row_id: str, fields: dict) -> bool:
+        fields = {k: v for k, v in fields.items() if k in allowed_fields and k != "id"}
+        if "archived" in fields:
+            fields["archived"] = int(bool(fields["archived"]))
+        if not fields:
+            return self._connection().execute(f"SELECT 1 FROM {table} WHERE id = ?", (row_id,)).fetchone() is not None
+        assignments = ", ".join(f"{k} = ?" for k in fields)
+        cursor = self._connection().execute(
+            f"UPDATE {table} SET {assignments} WHERE id = ?", (*fields.values(), row_id)
+        )
+        return cursor.rowcount > 0
+
+    def update_chat(self, chat_id: str, **fields) -> bool:
+        return self._update("chats", CHAT_FIELDS, chat_id, fields)
+
+    def delete_chat(self, chat_id: str) -> bool:
+        return self._connection().execute("DELETE FROM chats WHERE id = ?", (chat_id,)).rowcount > 0
+
+    def list_chats(self, archived: bool) -> list[dict]:
+        rows = self._connection().execute(
+            "SELECT * FROM chats WHERE archived = ? ORDER BY last_updated DESC", (int(archived),)
+        ).fetchall()
+        return [self._chat_from_row(row) for row in rows]
+
+    def get_source(self, source_id: str) -> dict | None:
+        row = self._connection().execute("SELECT * FROM sources WHERE id = ?", (source_id,)).fetchone()
+        return dict(row) if row else None
+
+    def upsert_sources(self, sources: list[dict]):
+        rows = [(s["id"], s.get("name"), s.get("type"), s.get("added_on")) for s in sources]
+        with self.transaction():
+            self._connection().executemany(
+                "INSERT INTO sources (id, name, type, added_on) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET name = excluded.name, type = excluded.type, added_on = excluded.added_on",
+                rows
+            )
+
+    def update_source(self, source_id: str, **fields) -> bool:
+        return self._update("sources", SOURCE_FIELDS, source_id, fields)
+
+    def delete_source(self, source_id: str) -> bool:
+        return self._connection().execute("DELETE FROM sources WHERE id = ?", (source_id,)).rowcount > 0
+
+    def list_sources(self) -> list[dict]:
+        rows = self._connection().execute("SELECT * FROM sources ORDER BY added_on DESC").fetchall()
+        return [dict(row) for row in rows]
+
+    def get_next_order_index(self, chat_id: str) -> int | None:
+        row = self._connection().execute("SELECT next_index FROM chat_sequences WHERE chat_id = ?", (chat_id,)).fetchone()
+        return row[0] if row else None
+
+    def set_next_order_index(self, chat_id: str, next_index: int):
+        self._connection().execute(
+            "INSERT INTO chat_sequences (chat_id, next_index) VALUES (?, ?) "
+            "ON CONFLICT(chat_id) DO UPDATE SET next_index = excluded.next_index",
+            (chat_id, next_index)
+        )
+
+    def delete_next_order_index(self, chat_id: str):
+        self._connection().execute("DELETE FROM chat_sequences WHERE chat_id = ?", (chat_id,))
+
+    def get_render_cache_version(self, chat_id: str) -> str | None:
+        row = self._connection().execute("SELECT version FROM render_cache WHERE chat_id = ?", (chat_id,)).fetchone()
+        return row[0] if row else None
+
+    def put_render_cache(self, chat_id: str, version: str, rendered: list[tuple[int, dict]]):
+        conn = self._connection()
+        with self.transaction():
+            conn.execute("DELETE FROM rendered_messages WHERE chat_id = ?", (chat_id,))
+            conn.executemany(
+                "INSERT INTO rendered_messages (chat_id, position, start_index, payload) VALUES (?, ?, ?, ?)",
+                [(chat_id, position, start_index, json.dumps(message, ensure_ascii=False))
+                 for position, (start_index, message) in enumerate(rendered)]
+            )
+            conn.execute(
+                "INSERT INTO render_cache (chat_id, version) VALUES (?, ?) "
+                "ON CONFLICT(chat_id) DO UPDATE SET version = excluded.version",
+                (chat_id, version)
+            )
+
+    def replace_rendered_tail(self, chat_id: str, from_start_index: int, version: str, rendered: list[tuple[int, dict]]):
+        conn = self._connection()
+        with self.transaction():
+            conn.execute(
+                "DELETE FROM rendered_messages WHERE chat_id = ? AND start_index >= ?", (chat_id, from_start_index)
+            )
+            # Positions follow start_index, so the rows kept are exactly positions 0..kept-1.
+            kept = conn.execute("SELECT COUNT(*) FROM rendered_messages WHERE chat_id = ?", (chat_id,)).fetchone()[0]
+            conn.executemany(
+                "INSERT INTO rendered_messages (chat_id, position, start_index, payload) VALUES (?, ?, ?, ?)",
+                [(chat_id, kept + offset, start_index, json.dumps(message, ensure_ascii=False))
+                 for offset, (start_index, message) in enumerate(rendered)]
+            )
+            conn.execute(
+                "INSERT INTO render_cache (chat_id, version) VALUES (?, ?) "
+                "ON CONFLICT(chat_id) DO UPDATE SET version = excluded.version",
+                (chat_id, version)
+            )
+
+    def get_rendered_before(self, chat_id: str, before: int | None, limit: int) -> list[tuple[int, dict]]:
+        if before is None:
+            rows = self._connection().execute(
+                "SELECT start_index, payload FROM rendered_messages WHERE chat_id = ? "
+                "ORDER BY start_index DESC LIMIT ?", (chat_id, limit)
+            ).fetchall()
+        else:
+            rows = self._connection().execute(
+                "SELECT start_index, payload FROM rendered_messages WHERE chat_id = ? AND start_index < ? "
+                "ORDER BY start_index DESC LIMIT ?", (chat_id, before, limit)
+            ).fetchall()
+        return [(row[0], json.loads(row[1])) for row in reversed(rows)]
+
+    def get_rendered_page(self, chat_id: str, offset: int, limit: int) -> tuple[list[dict], int]:
+        conn = self._connection()
+        total = conn.execute("SELECT COUNT(*) FROM rendered_messages WHERE chat_id = ?", (chat_id,)).fetchone()[0]
+        rows = conn.execute(
+            "SELECT payload FROM rendered_messages WHERE chat_id = ? ORDER BY position LIMIT ? OFFSET ?",
+            (chat_id, limit, offset)
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows], total
+
+    def delete_render_cache(self, chat_id: str):
+        conn = self._connection()
+        with self.transaction():
+            conn.execute("DELETE FROM rendered_messages WHERE chat_id = ?", (chat_id,))
+            conn.execute("DELETE FROM render_cache WHERE chat_id = ?", (chat_id,))
+
+    def migrate_from_json(self, chat_state_file: str = CHAT_STATE_FILE, sources_meta_file: str = SOURCES_META_FILE):
+        """One-time import of the legacy JSON files. Later calls do nothing."""
+        conn = self._connection()
+        with self.transaction():
+            if conn.execute("SELECT 1 FROM store_meta WHERE key = 'json_migrated'").fetchone():
+                return
+            chats = list(_load_json_robust(chat_state_file, default_value={}).values())
+            sources = list(_load_json_robust(sources_meta_file, default_value={}).values())
+            if chats:
+                self.upsert_chats(chats)
+            if sources:
+                self.upsert_sources(sources)
+            conn.execute("INSERT INTO store_meta (key, value) VALUES ('json_migrated', '1')")
+        if chats or sources:
+            print(f"Migrated {len(chats)} chats and {len(sources)} sources from JSON into {self.db_file}.")
+
+def _create_metadata_store() -> MetadataStore:
+    if METADATA_BACKEND == "json":
+        return JsonMetadataStore()
+    store = SQLiteMetadataStore()
+    store.migrate_from_json()
+    return store
+
+metadata_store = _create_metadata_store()
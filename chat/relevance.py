@@ -0,0 +1,178 @@
+# chat/relevance.py
+
+import asyncio
+import os
+import re
+from chat.ai_services import get_ai_response_async, is_error_response
+
+# --- Screening configuration ---
+# "llm" screens chunks with a chat model, "local" uses vector distances and an
+# optional local cross-encoder, without any network calls.
+RELEVANCE_ENGINE = os.getenv("RELEVANCE_ENGINE", "llm")
+# "per_chunk" asks the screening model about each chunk separately (concurrently),
+# "batched" judges all chunks with a single prompt.
+SCREENING_MODE = os.getenv("SCREENING_MODE", "per_chunk")
+SCREENING_MODEL = os.getenv("SCREENING_MODEL", "llama3-8b-8192") # Use a fast, cheap model
+SCREENING_CONCURRENCY = int(os.getenv("SCREENING_CONCURRENCY", "5"))
+SCREENING_DEADLINE_SECONDS = float(os.getenv("SCREENING_DEADLINE_SECONDS", "8"))
+# What to do with chunks that are still being screened when the deadline passes: "keep" or "drop".
+SCREENING_TIMEOUT_POLICY = os.getenv("SCREENING_TIMEOUT_POLICY", "keep")
+
+# --- Local engine configuration ---
+# Chunks whose Chroma distance is above this are discarded (the collection uses squared L2).
+RELEVANCE_MAX_DISTANCE = float(os.getenv("RELEVANCE_MAX_DISTANCE", "1.0"))
+# Optional CPU cross-encoder, e.g. "cross-encoder/ms-marco-MiniLM-L-6-v2". Disabled when empty.
+RELEVANCE_CROSS_ENCODER_MODEL = os.getenv("RELEVANCE_CROSS_ENCODER_MODEL", "")
+RELEVANCE_MIN_CROSS_ENCODER_SCORE = float(os.getenv("RELEVANCE_MIN_CROSS_ENCODER_SCORE", "0.0"))
+
+# This variable will hold the local cross-encoder. It starts as None and is loaded on first use.
+cross_encoder_model = None
+
+def _source_name(chunk: dict) -> str:
+    return chunk['metadata'].get('source_name', 'N/A')
+
+def _apply_timeout_policy(chunks: list[dict]) -> list[dict]:
+    """Returns the chunks to keep out of those that were not screened in time."""
+    if not chunks:
+        return []
+    if SCREENING_TIMEOUT_POLICY == "keep":
+        print(f"  -> Screening deadline reached. Keeping {len(chunks)} unscreened chunk(s).")
+        return chunks
+    print(f"  -> Screening deadline reached. Dropping {len(chunks)} unscreened chunk(s).")
+    return []
+
+async def _screen_chunk(query: str, chunk: dict, semaphore: asyncio.Semaphore) -> bool:
+    screening_prompt = (
+        f"The user wants to know about: '{query}'.\n\n"
+        f"Is the following text snippet relevant to answering that question? "
+        f"Answer with a single word: YES or NO.\n\n"
+        f"SNIPPET:\n---\n{chunk['document']}\n---"
+    )
+    async with semaphore:
+        response = await get_ai_response_async(
+            messages=[{"role": "user", "content": screening_prompt}],
+            model=SCREENING_MODEL
+        )
+    if is_error_response(response):
+        print(f"  -> Error during relevance screening: {response}")
+        return False
+    if "yes" in response.lower():
+        print(f"  -> Chunk from '{_source_name(chunk)}' is RELEVANT.")
+        return True
+    print(f"  -> Chunk from '{_source_name(chunk)}' is IRRELEVANT. Discarding.")
+    return False
+
+async def _screen_per_chunk(query: str, chunks: list[dict]) -> list[dict]:
+    """Screens every chunk with its own prompt, with bounded concurrency and an overall deadline."""
+    semaphore = asyncio.Semaphore(max(1, SCREENING_CONCURRENCY))
+    tasks = [asyncio.create_task(_screen_chunk(query, chunk, semaphore)) for chunk in chunks]
+    _, pending = await asyncio.wait(tasks, timeout=SCREENING_DEADLINE_SECONDS)
+    for task in pending:
+        task.cancel()
+
+    unscreened_chunks = [chunk for chunk, task in zip(chunks, tasks) if task in pending]
+    kept_unscreened = {id(chunk) for chunk in _apply_timeout_policy(unscreened_chunks)}
+
+    # Keep the retrieval order regardless of which screenings finished first.
+    relevant_chunks = []
+    for chunk, task in zip(chunks, tasks):
+        if task in pending:
+            if id(chunk) in kept_unscreened:
+                relevant_chunks.append(chunk)
+        elif not task.exception() and task.result():
+            relevant_chunks.append(chunk)
+    return relevant_chunks
+
+async def _screen_batched(query: str, chunks: list[dict]) -> list[dict]:
+    """Screens all chunks with a single prompt, so the cost does not grow with n_results."""
+    snippets = "\n\n".join(
+        f"SNIPPET {i + 1}:\n---\n{chunk['document']}\n---" for i, chunk in enumerate(chunks)
+    )
+    screening_prompt = (
+        f"The user wants to know about: '{query}'.\n\n"
+        f"Below are {len(chunks)} numbered text snippets. Which of them are relevant to answering that question? "
+        f"Answer with the numbers of the relevant snippets separated by commas (e.g. 1, 3), or NONE if none are relevant.\n\n"
+        f"{snippets}"
+    )
+    try:
+        response = await asyncio.wait_for(
+            get_ai_response_async(
+                messages=[{"role": "user", "content": screening_prompt}],
+                model=SCREENING_MODEL
+            ),
+            timeout=SCREENING_DEADLINE_SECONDS
+        )
+    except asyncio.TimeoutError:
+        return _apply_timeout_policy(chunks)
+
+    if is_error_response(response):
+        print(f"  -> Error during relevance screening: {response}")
+        return []
+
+    selected = {int(n) - 1 for n in re.findall(r"\d+", response)}
+    relevant_chunks = []
+    for i, chunk in enumerate(chunks):
+        if i in selected:
+            print(f"  -> Chunk from '{_source_name(chunk)}' is RELEVANT.")
+            relevant_chunks.append(chunk)
+        else:
+            print(f"  -> Chunk from '{_source_name(chunk)}' is IRRELEVANT. Discarding.")
+    return relevant_chunks
+
+def _get_cross_encoder():
+    global cross_encoder_model
+    if cross_encoder_model is None:
+        from sentence_transformers import CrossEncoder
+        print(f"First use of the relevance cross-encoder: loading '{RELEVANCE_CROSS_ENCODER_MODEL}'...")
+        cross_encoder_model = CrossEncoder(RELEVANCE_CROSS_ENCODER_MODEL, device="cpu")
+        print("Successfully loaded the relevance cross-encoder.")
+    return cross_encoder_model
+
+def _screen_locally(query: str, chunks: list[dict]) -> list[dict]:
+    """
+    Screens chunks without network calls: first by the vector distance returned by
+    query_unified_memory(include_distances=True), then optionally with a local cross-encoder.
+    """
+    candidates = []
+    for chunk in chunks:
+        distance = chunk.get("distance")
+        if distance is not None and distance > RELEVANCE_MAX_DISTANCE:
+            print(f"  -> Chunk from '{_source_name(chunk)}' is IRRELEVANT (distance {distance:.3f}). Discarding.")
+            continue
+        candidates.append(chunk)
+
+    if not candidates or not RELEVANCE_CROSS_ENCODER_MODEL:
+        return candidates
+
+    try:
+        scores = _get_cross_encoder().predict([(query, chunk['document']) for chunk in candidates])
+    except Exception as e:
+        print(f"  -> Error during cross-encoder screening, keeping distance-screened chunks: {e}")
+        return candidates
+
+    relevant_chunks = []
+    for chunk, score in zip(candidates, scores):
+        if score >= RELEVANCE_MIN_CROSS_ENCODER_SCORE:
+            print(f"  -> Chunk from '{_source_name(chunk)}' is RELEVANT (score {score:.3f}).")
+            relevant_chunks.append(chunk)
+        else:
+            print(f"  -> Chunk from '{_source_name(chunk)}' is IRRELEVANT (score {score:.3f}). Discarding.")
+    return relevant_chunks
+
+async def filter_relevant_chunks(query: str, chunks: list[dict]) -> list[dict]:
+    """
+    Screens chunks for relevance before final generation, either with a fast LLM
+    or with the local, network-free engine (RELEVANCE_ENGINE=local).
+    """
+    if not chunks:
+        return []
+
+    if RELEVANCE_ENGINE == "local":
+        print(f"Screening {len(chunks)} retrieved chunks for relevance (local)...")
+        # The cross-encoder is CPU-bound, so run it off the event loop.
+        return await asyncio.to_thread(_screen_locally, query, chunks)
+
+    print(f"Screening {len(chunks)} retrieved chunks for relevance ({SCREENING_MODE})...")
+    if SCREENING_MODE == "batched":
+        return await _screen_batched(query, chunks)
+    return await _screen_per_chunk(query, chunks)
@@ -0,0 +1,108 @@
+# chat/response_cache.py
+
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Opt-in: answers are reused for near-duplicate questions, which is only safe if users expect that.
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "0") == "1"
+# Minimum cosine similarity between two questions' embeddings for a cached answer to be reused.
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.95"))
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "86400"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "2000"))
+# By default only turns without earlier history (temporary chats, first messages) are cached,
+# since a follow-up answer depends on the conversation before it.
+RESPONSE_CACHE_IGNORE_HISTORY = os.getenv("RESPONSE_CACHE_IGNORE_HISTORY", "0") == "1"
+
+def _normalize(vector: list[float]) -> list[float]:
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+def make_cache_key(model: str, source_ids: list[str] | None, context_chunks: list[dict]) -> str:
+    """
+    The exact part of a cache entry's key: the model, the requested source set and the retrieved
+    context. Any change to the chunks retrieval returns (new or deleted documents) changes the key.
+    """
+    payload = {
+        "model": model,
+        "source_ids": sorted(source_ids) if source_ids else None,
+        "context": [chunk["id"] for chunk in context_chunks],
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """
+    An in-process semantic cache of AI responses. Entries are grouped by their exact key and,
+    within a key, matched by cosine similarity of the question embeddings. Entries expire after
+    ttl_seconds and the least recently used ones are evicted beyond max_entries.
+    """
+
+    def __init__(self, similarity_threshold: float, ttl_seconds: int, max_entries: int):
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # entry_id -> entry, least recently used first
+        self._entries_by_key = {}  # exact key -> set of entry_ids
+        self._next_entry_id = 0
+        self._lock = threading.Lock()
+
+    def _remove(self, entry_id: int):
+        entry = self._entries.pop(entry_id, None)
+        if entry is None:
+            return
+        key_entries = self._entries_by_key.get(entry["key"])
+        if key_entries is not None:
+            key_entries.discard(entry_id)
+            if not key_entries:
+                del self._entries_by_key[entry["key"]]
+
+    def get(self, key: str, query_embedding: list[float]) -> str | None:
+        """Returns the cached response for the most similar question under this key, if close enough."""
+        vector = _normalize(query_embedding)
+        now = time.time()
+        with self._lock:
+            best_id, best_similarity = None, self.similarity_threshold
+            for entry_id in list(self._entries_by_key.get(key, ())):
+                entry = self._entries[entry_id]
+                if now - entry["created_at"] > self.ttl_seconds:
+                    self._remove(entry_id)
+                    continue
+                similarity = sum(a * b for a, b in zip(vector, entry["vector"]))
+                if similarity >= best_similarity:
+                    best_id, best_similarity = entry_id, similarity
+            if best_id is None:
+                return None
+            self._entries.move_to_end(best_id)
+            return self._entries[best_id]["response"]
+
+    def put(self, key: str, query_embedding: list[float], response: str, source_ids: set[str]):
+        """Stores a response. source_ids are the sources it depends on, for invalidation."""
+        with self._lock:
+            entry_id = self._next_entry_id
+            self._next_entry_id += 1
+            self._entries[entry_id] = {
+                "key": key, "vector": _normalize(query_embedding), "response": response,
+                "created_at": time.time(), "source_ids": set(source_ids),
+            }
+            self._entries_by_key.setdefault(key, set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_source(self, source_id: str):
+        """Drops every response that was built from, or restricted to, this source."""
+        with self._lock:
+            for entry_id in [entry_id for entry_id, entry in self._entries.items() if source_id in entry["source_ids"]]:
+                self._remove(entry_id)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._entries_by_key.clear()
+
+response_cache = ResponseCache(
+    RESPONSE_CACHE_SIMILARITY, RESPONSE_CACHE_TTL_SECONDS, RESPONSE_CACHE_MAX_ENTRIES
+) if RESPONSE_CACHE_ENABLED else None
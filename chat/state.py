@@ -1,7 +1,10 @@
 # chat/state.py
 
-# This dictionary will be shared across the application to track background task progress.
-task_statuses = {}
-
 # This will be the single, authoritative instance of the AI client for the entire app.
 ai_client = None
+
+# The async counterpart of ai_client, used by the async chat endpoints.
+async_ai_client = None
+
+# A shared, pooled httpx.AsyncClient (keep-alive, HTTP/2) that every async_ai_client reuses.
+async_http_client = None
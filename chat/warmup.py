@@ -0,0 +1,56 @@
+# chat/warmup.py
+
+import os
+import threading
+import time
+from chat.ai_services import warm_up_embedding_model
+from memory.memory_store import warm_up_memory, get_embedding_status
+
+# Load and exercise the embedding model and Chroma in the background right after startup,
+# so the first real request does not pay for it. /ready reports when this has finished.
+WARMUP_ON_STARTUP = os.getenv("WARMUP_ON_STARTUP", "1") == "1"
+
+# Each heavy subsystem is "cold", "warming", "ready" or "error".
+readiness = {"embedding_model": "cold", "vector_store": "cold"}
+
+def _warm_up():
+    started_at = time.perf_counter()
+    query_embedding = None
+    try:
+        readiness["embedding_model"] = "warming"
+        query_embedding = warm_up_embedding_model()
+        readiness["embedding_model"] = "ready"
+    except Exception as e:
+        print(f"Warm-up of the embedding model failed: {e}")
+        readiness["embedding_model"] = "error"
+    try:
+        readiness["vector_store"] = "warming"
+        warm_up_memory(query_embedding)
+        readiness["vector_store"] = "ready"
+    except Exception as e:
+        print(f"Warm-up of the vector store failed: {e}")
+        readiness["vector_store"] = "error"
+    if readiness["vector_store"] == "ready":
+        _check_embedding_model()
+    print(f"Warm-up finished in {time.perf_counter() - started_at:.2f}s: {readiness}")
+
+def _check_embedding_model():
+    """Warns when stored vectors come from another embedding model, since they rank poorly against new queries."""
+    try:
+        status = get_embedding_status()
+    except Exception as e:
+        print(f"Could not check which model embedded unified memory: {e}")
+        return
+    if status["stale"]:
+        print(f"⚠️ {status['stale']} of {status['total']} documents in memory were not embedded with "
+              f"{status['embedding_model']}. Run POST /memory/reindex to re-embed them.")
+
+def start_warmup():
+    """Starts the warm-up on a daemon thread, so it never delays startup itself."""
+    threading.Thread(target=_warm_up, name="warmup", daemon=True).start()
+
+def is_ready() -> bool:
+    """True once every subsystem is warm. Without warm-up, subsystems load on first use and the app is always ready."""
+    if not WARMUP_ON_STARTUP:
+        return True
+    return all(state == "ready" for state in readiness.values())
@@ -111,6 +111,7 @@ function replaceCitationPlaceholders(htmlContent, citations) {
  * The main exported function. It takes message data and renders it into the message area.
  * @param {Object} messageData The message object from the backend or local state.
  * @param {HTMLElement} messageArea The DOM element to append the message to.
+ * @returns {HTMLElement|undefined} The rendered message wrapper, if anything was rendered.
  */
 export function renderMessage(messageData, messageArea) {
     if (!messageArea) return;
@@ -190,4 +191,17 @@ export function renderMessage(messageData, messageArea) {
 
     messageWrapper.appendChild(messageDiv);
     messageArea.appendChild(messageWrapper);
-}
\ No newline at end of file
+    return messageWrapper;
+}
+
+/**
+ * Updates the text of a message that is still being streamed in.
+ * @param {HTMLElement} messageWrapper The wrapper returned by renderMessage.
+ * @param {string} text The full text received so far.
+ */
+export function updateStreamingMessage(messageWrapper, text) {
+    if (!messageWrapper) return;
+    const messageDiv = messageWrapper.querySelector('.message');
+    if (!messageDiv) return;
+    messageDiv.innerHTML = marked.parse(text, { gfm: true, breaks: true });
+}
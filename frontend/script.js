@@ -1,4 +1,4 @@
-import { renderMessage } from './messageRenderer.js';
+import { renderMessage, updateStreamingMessage } from './messageRenderer.js';
 
 document.addEventListener('DOMContentLoaded', () => {
     // DOM Element Constants
@@ -50,7 +50,8 @@ document.addEventListener('DOMContentLoaded', () => {
     let globalModel = null;
     let availableModels = [];
     let allSources = [];
-    let currentPage = 1;
+    let nextMessageCursor = null;
+    const MESSAGE_PAGE_SIZE = 50;
     let selectedSourceIDs = null;
     let promptHistory = [];
     let historyIndex = -1;
@@ -141,42 +142,54 @@ const handleApiKeyVerification = async (isSilent = false, keyFromState = null) =
     }
 };
 
-    const pollImportStatus = (taskId) => {
-        const interval = setInterval(async () => {
-            try {
-                const response = await fetch(`/upload-status/${taskId}`);
-                if (!response.ok) throw new Error('Failed to get status');
-                const status = await response.json();
-                if (importProgressPercent) importProgressPercent.textContent = `${status.progress}%`;
-                if (importProgressFill) importProgressFill.style.width = `${status.progress}%`;
-                if (importProgressBox) {
-                    const detailRegex = /Processing (\d+) of (\d+): (.*)/;
-                    const matches = status.message.match(detailRegex);
-                    if (matches) {
-                        const tooltipText = `${matches[1]} / ${matches[2]}\n${matches[3]}`;
-                        importProgressBox.title = tooltipText;
-                    } else {
-                        importProgressBox.title = status.message;
-                    }
-                }
-                if (status.status === 'completed' || status.status === 'error') {
-                    clearInterval(interval);
-                    if (status.status === 'completed') {
-                        if (importProgressPercent) importProgressPercent.textContent = '✅';
-                        loadChatHistory();
-                    } else {
-                        if (importProgressPercent) importProgressPercent.textContent = '❌';
-                    }
-                    setTimeout(() => {
-                        if (importDropArea) importDropArea.style.display = 'block';
-                        if (importProgressBox) importProgressBox.style.display = 'none';
-                    }, 5000);
+    // Follows a background job over Server-Sent Events until it finishes.
+    // Resolves with the final status ('completed', 'error' or 'cancelled').
+    const watchJob = (taskId, onProgress) => new Promise((resolve, reject) => {
+        const source = new EventSource(`/jobs/${taskId}/events`);
+        source.onmessage = (event) => {
+            const status = JSON.parse(event.data);
+            if (onProgress) onProgress(status);
+            if (['completed', 'error', 'cancelled'].includes(status.status)) {
+                source.close();
+                resolve(status);
+            }
+        };
+        source.onerror = () => {
+            source.close();
+            reject(new Error('Lost connection to the task status stream'));
+        };
+    });
+
+    const pollImportStatus = async (taskId) => {
+        const showProgress = (status) => {
+            if (importProgressPercent) importProgressPercent.textContent = `${status.progress}%`;
+            if (importProgressFill) importProgressFill.style.width = `${status.progress}%`;
+            if (importProgressBox) {
+                const detailRegex = /Processing conversation (\d+): (.*)/;
+                const matches = status.message.match(detailRegex);
+                if (matches) {
+                    const tooltipText = `#${matches[1]}\n${matches[2]}`;
+                    importProgressBox.title = tooltipText;
+                } else {
+                    importProgressBox.title = status.message;
                 }
-            } catch (error) {
-                if (importProgressPercent) importProgressPercent.textContent = '⚠️';
-                clearInterval(interval);
             }
-        }, 1500);
+        };
+        try {
+            const status = await watchJob(taskId, showProgress);
+            if (status.status === 'completed') {
+                if (importProgressPercent) importProgressPercent.textContent = '✅';
+                loadChatHistory();
+            } else {
+                if (importProgressPercent) importProgressPercent.textContent = '❌';
+            }
+            setTimeout(() => {
+                if (importDropArea) importDropArea.style.display = 'block';
+                if (importProgressBox) importProgressBox.style.display = 'none';
+            }, 5000);
+        } catch (error) {
+            if (importProgressPercent) importProgressPercent.textContent = '⚠️';
+        }
     };
 
     const handleRealFileImport = async (file) => {
@@ -239,26 +252,32 @@ const handleApiKeyVerification = async (isSilent = false, keyFromState = null) =
 
     const handleKnowledgeUpload = async (files) => {
         if (!files.length) return;
-        const formData = new FormData();
+        const results = [];
+        // Files are sent one at a time; each is processed as its own background task.
         for (const file of files) {
+            const formData = new FormData();
             formData.append('file', file);
-        }
-
-        try {
-            const response = await fetch('/sources/upload', {
-                method: 'POST',
-                body: formData,
-            });
-            if (!response.ok) {
-                const err = await response.json();
-                throw new Error(err.detail || 'Upload failed');
+            try {
+                const response = await fetch('/sources/upload', {
+                    method: 'POST',
+                    body: formData,
+                });
+                if (!response.ok) {
+                    const err = await response.json();
+                    throw new Error(err.detail || 'Upload failed');
+                }
+                const result = await response.json();
+                const status = await watchJob(result.task_id, (progress) => {
+                    if (sourcesBadge && progress.status === 'processing') sourcesBadge.textContent = `${progress.progress ?? 0}%`;
+                });
+                results.push(status.message);
+            } catch (error) {
+                results.push(`Error uploading '${file.name}': ${error.message}`);
             }
-            const result = await response.json();
-            alert(result.message);
-            loadSources(); // Refresh the sources list
-        } catch (error) {
-            alert(`Error uploading files: ${error.message}`);
         }
+        updateSourcesBadge();
+        alert(results.join('\n'));
+        loadSources(); // Refresh the sources list
     };
 
     const updateSourcesBadge = () => {
@@ -440,13 +459,13 @@ const loadChat = async (chatId) => {
     // --- NEW PAGINATION LOGIC STARTS HERE ---
     mainChatArea.classList.remove('is-temporary');
     currentChatId = chatId;
-    currentPage = 1; // Reset to page 1 for any new chat load
+    nextMessageCursor = null; // Start again from the newest messages for any new chat load
     updateHistoryActiveState();
     mainChatArea.classList.toggle('is-archived', isShowingArchived);
 
     try {
-        // Fetch the first page (most recent 50 messages)
-        const response = await fetch(`/chat/${chatId}?page=${currentPage}`);
+        // Fetch the most recent messages
+        const response = await fetch(`/chat/${chatId}?limit=${MESSAGE_PAGE_SIZE}`);
         if (!response.ok) throw new Error(`Chat not found`);
         const chatData = await response.json();
 
@@ -456,9 +475,8 @@ const loadChat = async (chatId) => {
         currentModelBtn.textContent = modelName.split('/').pop();
 
         // Check if there are more messages to load
-        const totalMessages = chatData.messages_page.total_messages_in_chat;
-        const pageSize = 50; // Must match the backend default
-        if (totalMessages > pageSize) {
+        nextMessageCursor = chatData.messages_page.next_cursor;
+        if (chatData.messages_page.has_more) {
             const loadMoreBtn = document.createElement('button');
             loadMoreBtn.textContent = 'Load More Messages';
             loadMoreBtn.id = 'load-more-btn';
@@ -487,10 +505,9 @@ const handleLoadMoreMessages = async () => {
 
     loadMoreBtn.textContent = 'Loading...';
     loadMoreBtn.disabled = true;
-    currentPage++; // Go to the next page
 
     try {
-        const response = await fetch(`/chat/${currentChatId}?page=${currentPage}`);
+        const response = await fetch(`/chat/${currentChatId}?limit=${MESSAGE_PAGE_SIZE}&before=${nextMessageCursor}`);
         if (!response.ok) throw new Error('Failed to fetch more messages');
         const chatData = await response.json();
         const newMessages = chatData.messages_page.messages;
@@ -516,9 +533,8 @@ const handleLoadMoreMessages = async () => {
         messageArea.scrollTop = messageArea.scrollHeight - oldScrollHeight;
 
         // Check if we need to show the button again
-        const totalMessages = chatData.messages_page.total_messages_in_chat;
-        const messagesLoaded = currentPage * 50;
-        if (totalMessages > messagesLoaded) {
+        nextMessageCursor = chatData.messages_page.next_cursor;
+        if (chatData.messages_page.has_more) {
             const newLoadMoreBtn = document.createElement('button');
             newLoadMoreBtn.textContent = 'Load More Messages';
             newLoadMoreBtn.id = 'load-more-btn';
@@ -564,6 +580,28 @@ const handleLoadMoreMessages = async () => {
         updateHistoryActiveState();
     };
 
+    // Reads a text/event-stream response body and calls onEvent with each parsed event.
+    const readEventStream = async (response, onEvent) => {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const rawEvent = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+                const data = rawEvent.split('\n')
+                    .filter(line => line.startsWith('data: '))
+                    .map(line => line.slice(6))
+                    .join('\n');
+                if (data) onEvent(JSON.parse(data));
+            }
+        }
+    };
+
     const handleSendMessage = async () => {
         if (!messageInput || !messageArea) return;
         const text = messageInput.value.trim();
@@ -610,14 +648,34 @@ const handleLoadMoreMessages = async () => {
             const response = await fetch(endpoint, {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify(messageRequest)
+                body: JSON.stringify({ ...messageRequest, stream: true })
             });
 
-            const aiMessage = await response.json();
             if (!response.ok) {
-                throw new Error(aiMessage.text || aiMessage.detail || 'Failed to get AI response.');
+                const errorBody = await response.json();
+                throw new Error(errorBody.text || errorBody.detail || 'Failed to get AI response.');
             }
 
+            // Render the reply as the tokens arrive, then swap in the final message.
+            let streamedText = '';
+            let streamingWrapper = null;
+            let aiMessage = null;
+            await readEventStream(response, (event) => {
+                if (event.type === 'delta') {
+                    streamedText += event.text;
+                    if (!streamingWrapper) {
+                        streamingWrapper = renderMessage({ role: 'assistant', text: streamedText }, messageArea);
+                    } else {
+                        updateStreamingMessage(streamingWrapper, streamedText);
+                    }
+                    scrollToBottom();
+                } else if (event.type === 'done') {
+                    aiMessage = { role: event.role, text: streamedText, content_type: event.content_type, model_slug: event.model_slug };
+                }
+            });
+            if (streamingWrapper) streamingWrapper.remove();
+            if (!aiMessage) throw new Error(streamedText || 'The response stream ended unexpectedly.');
+
             if (isCurrentChatTemporary) {
                 temporaryChats[chatToUpdateId].messages.push(userMessage);
                 temporaryChats[chatToUpdateId].messages.push(aiMessage);
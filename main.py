@@ -3,19 +3,19 @@
 # --- STEP 1: Standard library imports needed ONLY for the installer ---
 import sys
 import os
+import re
 import subprocess
+import time
+import importlib.metadata
+
+# Measured from here to the end of the lifespan startup and compared with STARTUP_TIME_BUDGET_SECONDS.
+BOOT_STARTED_AT = time.perf_counter()
+
+# "production" skips the dependency check below and runs without auto-reload.
+NEUROCHAT_ENV = os.getenv("NEUROCHAT_ENV", "development")
 
 # --- STEP 2: The installer logic and execution ---
 # This block MUST come before any third-party imports like fastapi, dotenv, etc.
-try:
-    import pkg_resources
-except ImportError:
-    # This is a fallback for very minimal python environments that might not have setuptools
-    print("Missing 'setuptools' which is required for checking packages. Attempting to install...")
-    subprocess.check_call([sys.executable, '-m', 'pip', 'install', 'setuptools'])
-    print("\n✅ 'setuptools' installed. Please restart the script.")
-    sys.exit(0)
-
 def read_requirements():
     """Reads the requirements from requirements.txt and returns them as a list."""
     # Get the absolute path to the directory containing main.py
@@ -34,15 +34,17 @@ def read_requirements():
 def check_and_install_packages():
     """
     Checks if all required packages from requirements.txt are installed.
+    Each requirement is looked up directly, instead of scanning every installed distribution.
     """
     required_packages = read_requirements()
     
-    installed = {pkg.key for pkg in pkg_resources.working_set}
     missing = []
     for req in required_packages:
         # Handles package names with versions (e.g., fastapi==0.100.0) or extras (e.g., uvicorn[standard])
-        base_req = req.split('[')[0].split('==')[0].split('>=')[0].split('<=')[0].strip()
-        if base_req not in installed:
+        base_req = re.split(r"[\[<>=!~;\s]", req, maxsplit=1)[0]
+        try:
+            importlib.metadata.version(base_req)
+        except importlib.metadata.PackageNotFoundError:
             missing.append(req)
 
     if missing:
@@ -58,45 +60,77 @@ def check_and_install_packages():
             print(f"pip install -r requirements.txt")
             sys.exit(1)
 
-# Run the check before the application tries to import anything
-check_and_install_packages()
+# Run the check before the application tries to import anything.
+# Production deployments install dependencies ahead of time, so they skip it.
+if NEUROCHAT_ENV != "production":
+    check_and_install_packages()
 
 
 # --- STEP 3: Now, all other imports can safely run ---
-from fastapi import FastAPI, UploadFile, File, HTTPException, BackgroundTasks, Response
+from fastapi import FastAPI, UploadFile, File, HTTPException, BackgroundTasks, Response, Query
 from dotenv import load_dotenv
 load_dotenv()
 from contextlib import asynccontextmanager
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from typing import List, Optional
 from datetime import datetime
 import uuid
+import json
+import asyncio
 import uvicorn
 
-from chat.importer import router as import_router
+from chat.importer import router as import_router, spool_upload_to_disk, UPLOAD_SPOOL_DIR
 from chat import state
-from chat.state import task_statuses
 from chat.chat_manager import (
-    list_chats, get_chat_by_id, create_chat_session, 
+    list_chats, get_chat_by_id, get_chat_metadata, create_chat_session, 
     generate_chat_id, rename_chat_session, delete_chat_session,
     archive_chat_session, list_archived_chats, set_chat_model,
     list_all_sources, unarchive_chat_session
 )
-from memory.memory_store import query_unified_memory, save_to_memory
-from chat.ai_services import initialize_client, get_available_models, get_ai_response
-from chat.data_processor import process_and_store_file
+from memory.memory_store import (
+    query_unified_memory, save_to_memory, get_message_count, keyword_search_memory, rebuild_keyword_index,
+    get_embedding_status, reindex_memory_embeddings
+)
+from chat.ai_services import (
+    initialize_client, get_available_models, get_ai_response_async,
+    stream_ai_response, close_async_client, is_error_response, embed_texts
+)
+from chat.response_cache import response_cache, make_cache_key, RESPONSE_CACHE_IGNORE_HISTORY
+from chat.relevance import filter_relevant_chunks
+from chat.context_builder import build_history, count_tokens
+from chat.jobs import job_manager, Job, FINAL_STATUSES
+from chat.warmup import WARMUP_ON_STARTUP, start_warmup, is_ready, readiness
+import chat.data_processor  # registers the file upload job handler
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    print("Application startup complete. Waiting for frontend configuration.")
+    # Handlers are registered on import, so unfinished jobs can be resumed now.
+    job_manager.start()
+    if WARMUP_ON_STARTUP:
+        start_warmup()
+    boot_seconds = time.perf_counter() - BOOT_STARTED_AT
+    print(f"Application startup complete in {boot_seconds:.2f}s. Waiting for frontend configuration.")
+    if boot_seconds > STARTUP_TIME_BUDGET_SECONDS:
+        print(f"⚠️ Startup took longer than the {STARTUP_TIME_BUDGET_SECONDS:.1f}s budget. "
+              "Check for heavy imports (torch, chromadb) on the startup path.")
     yield
+    await asyncio.to_thread(job_manager.shutdown)
+    await close_async_client()
     print("Application shutdown.")
 
 app = FastAPI(lifespan=lifespan) # <-- THIS LINE IS NOW CORRECTED
 
+# Startup should stay within this many seconds: heavy subsystems (Chroma, torch,
+# sentence-transformers) are loaded on first use, not during boot.
+STARTUP_TIME_BUDGET_SECONDS = float(os.getenv("STARTUP_TIME_BUDGET_SECONDS", "3.0"))
+
+# How often the job events stream checks a job for changes.
+JOB_EVENTS_INTERVAL_SECONDS = 0.5
+
 # --- Pydantic Models ---
 class ApiKeyRequest(BaseModel):
     api_key: str
@@ -105,6 +139,7 @@ class MessageRequest(BaseModel):
     text: str
     model: str
     source_ids: Optional[List[str]] = None
+    stream: bool = False
 
 class RenameRequest(BaseModel):
     new_title: str
@@ -124,29 +159,120 @@ def index():
     with open("frontend/index.html", "r", encoding='utf-8') as f:
         return f.read()
 
+@app.get("/ready")
+def readiness_check():
+    """For load balancers: 503 until the embedding model and vector store have been warmed up."""
+    body = {"ready": is_ready(), "warmup_enabled": WARMUP_ON_STARTUP, "components": dict(readiness)}
+    return JSONResponse(content=body, status_code=200 if body["ready"] else 503)
+
 @app.get("/upload-status/{task_id}")
 async def get_upload_status(task_id: str):
-    status = task_statuses.get(task_id)
+    status = await run_in_threadpool(job_manager.get, task_id)
     if not status:
         raise HTTPException(status_code=404, detail="Task not found")
     return JSONResponse(content=status)
 
+# --- Background Job Endpoints ---
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    return await get_upload_status(job_id)
+
+@app.get("/jobs/{job_id}/events")
+async def stream_job_events(job_id: str):
+    """Pushes a job's status as Server-Sent Events whenever it changes, until the job has finished."""
+    if not await run_in_threadpool(job_manager.get, job_id):
+        raise HTTPException(status_code=404, detail="Task not found")
+
+    async def events():
+        last_status = None
+        while True:
+            status = await run_in_threadpool(job_manager.get, job_id)
+            if status is None:
+                yield _sse_event({"id": job_id, "status": "error", "message": "Task not found"})
+                return
+            if status != last_status:
+                yield _sse_event(status)
+                last_status = status
+            if status["status"] in FINAL_STATUSES:
+                return
+            await asyncio.sleep(JOB_EVENTS_INTERVAL_SECONDS)
+
+    return streaming_response(events())
+
+@app.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    status = await run_in_threadpool(job_manager.cancel, job_id)
+    if not status:
+        raise HTTPException(status_code=404, detail="Task not found")
+    return status
+
 @app.post("/sources/upload")
-async def upload_knowledge_file(file: UploadFile = File(...), background_tasks: BackgroundTasks = None):
+async def upload_knowledge_file(file: UploadFile = File(...)):
     if not file.filename.lower().endswith(('.txt', '.md')):
         raise HTTPException(status_code=400, detail="Only .txt and .md files are supported.")
+    file_path = os.path.join(UPLOAD_SPOOL_DIR, f"{uuid.uuid4().hex}.txt")
     try:
-        content_bytes = await file.read()
-        content = content_bytes.decode('utf-8')
-        background_tasks.add_task(process_and_store_file, content, file.filename)
-        return JSONResponse(content={"message": f"File '{file.filename}' received and will be processed."}, status_code=202)
+        await spool_upload_to_disk(file, file_path)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to process file: {str(e)}")
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        raise HTTPException(status_code=500, detail=f"Failed to receive file: {str(e)}")
+
+    # The job owns the spooled file from here on, so the upload survives a restart.
+    task_id = await run_in_threadpool(
+        job_manager.submit, "file_upload", {"spool_path": file_path, "filename": file.filename},
+        f"'{file.filename}' received, preparing to process."
+    )
+    return JSONResponse(content={"task_id": task_id, "message": f"File '{file.filename}' received and will be processed."}, status_code=202)
 
 @app.get("/sources")
 def get_all_sources():
     return list_all_sources()
 
+# --- Memory Search Endpoints ---
+@app.get("/memory/search")
+def search_memory_keywords(q: str, source_ids: Optional[List[str]] = Query(None), limit: int = 10):
+    """Exact-term (BM25) search over all stored chats and files. Does not run the embedding model."""
+    limit = max(1, min(limit, 100))
+    return {"query": q, "results": keyword_search_memory(q, source_ids=source_ids, n_results=limit)}
+
+def run_keyword_index_rebuild_job(job: Job) -> str:
+    def report(indexed: int, total: int):
+        job.report(min(int(indexed * 100 / total), 99) if total else 99, f"Indexed {indexed} of {total} documents.")
+    indexed = rebuild_keyword_index(progress_callback=report)
+    return f"✅ Keyword index rebuilt ({indexed} documents)."
+
+job_manager.register("keyword_index_rebuild", run_keyword_index_rebuild_job)
+
+@app.post("/memory/keyword-index/rebuild", status_code=202)
+def rebuild_memory_keyword_index():
+    task_id = job_manager.submit("keyword_index_rebuild", {}, "Rebuilding keyword index.")
+    return {"task_id": task_id, "message": "Keyword index rebuild started in the background."}
+
+@app.get("/memory/embedding-status")
+def memory_embedding_status():
+    """How many stored documents were embedded by a model other than the current one."""
+    return get_embedding_status()
+
+def run_memory_reindex_job(job: Job) -> str:
+    # The checkpoint is the number of documents already written back, so a restart resumes there.
+    start_offset = job.checkpoint["offset"] if job.checkpoint else 0
+    def report(offset: int, total: int):
+        job.save_checkpoint({"offset": offset})
+        job.report(min(int(offset * 100 / total), 99) if total else 99, f"Re-embedded {offset} of {total} documents.")
+    reembedded = reindex_memory_embeddings(
+        start_offset=start_offset, force=job.payload.get("force", False), progress_callback=report
+    )
+    return f"✅ Re-embedded {reembedded} documents with the local embedding model."
+
+job_manager.register("memory_reindex", run_memory_reindex_job)
+
+@app.post("/memory/reindex", status_code=202)
+def reindex_memory(force: bool = False):
+    """Re-embeds stored documents with the local model. Only documents from other models unless force is set."""
+    task_id = job_manager.submit("memory_reindex", {"force": force}, "Re-embedding memory.")
+    return {"task_id": task_id, "message": "Memory reindex started in the background."}
+
 # --- AI Configuration Endpoints ---
 @app.post("/config/api-key")
 def verify_api_key(request: ApiKeyRequest):
@@ -191,7 +317,50 @@ def save_conversation_turn_in_background(
         print(f"Background task: Finished saving turn for chat {chat_id}")
     except Exception as e:
         print(f"!!! Background task FAILED for chat {chat_id}: {e}")
-        
+
+def save_streamed_turn_in_background(
+    chat_id: str,
+    user_text: str,
+    stream_state: dict,
+    is_first_turn: bool,
+    model_used: str
+):
+    """
+    Runs after a streamed response has been sent and saves the turn,
+    but only if the stream ran to completion without an error.
+    """
+    assistant_text = "".join(stream_state["parts"])
+    if not stream_state["completed"]:
+        print(f"Stream for chat {chat_id} did not complete. Not saving turn.")
+        return
+    if is_error_response(assistant_text):
+        return
+    save_conversation_turn_in_background(chat_id, user_text, assistant_text, is_first_turn, model_used)
+
+def _sse_event(payload: dict) -> str:
+    """Formats a payload as a single Server-Sent Event."""
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+async def stream_response_events(messages: list[dict], model: str, stream_state: dict | None = None):
+    """
+    Yields SSE events for a streamed AI response: one 'delta' event per token chunk,
+    followed by a final 'done' event. Collects the text into stream_state if given.
+    """
+    async for delta in stream_ai_response(messages, model):
+        if stream_state is not None:
+            stream_state["parts"].append(delta)
+        yield _sse_event({"type": "delta", "text": delta})
+    if stream_state is not None:
+        stream_state["completed"] = True
+    yield _sse_event({"type": "done", "role": "assistant", "content_type": "text", "model_slug": model})
+
+def streaming_response(events) -> StreamingResponse:
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 def is_query_search_worthy(text: str) -> bool:
     """
     Determines if a query is meaningful enough to warrant a memory search.
@@ -206,59 +375,87 @@ def is_query_search_worthy(text: str) -> bool:
             return True
     return False
 
-def filter_relevant_chunks(query: str, chunks: list[dict]) -> list[dict]:
+def lookup_cached_response(text: str, model: str, source_ids: list[str] | None, context_chunks: list[dict]) -> tuple[str | None, dict]:
     """
-    Uses a fast LLM to screen chunks for relevance before final generation.
+    Looks the question up in the semantic response cache. Returns the cached answer (or None)
+    and the cache entry details needed to store a fresh answer later.
     """
-    if not chunks:
-        return []
-
-    print(f"Screening {len(chunks)} retrieved chunks for relevance...")
-    relevant_chunks = []
-    screening_model = "llama3-8b-8192" # Use a fast, cheap model
-
-    for chunk in chunks:
-        screening_prompt = (
-            f"The user wants to know about: '{query}'.\n\n"
-            f"Is the following text snippet relevant to answering that question? "
-            f"Answer with a single word: YES or NO.\n\n"
-            f"SNIPPET:\n---\n{chunk['document']}\n---"
-        )
-        try:
-            response = get_ai_response(
-                messages=[{"role": "user", "content": screening_prompt}],
-                model=screening_model
-            )
-            if "yes" in response.lower():
-                print(f"  -> Chunk from '{chunk['metadata'].get('source_name', 'N/A')}' is RELEVANT.")
-                relevant_chunks.append(chunk)
-            else:
-                print(f"  -> Chunk from '{chunk['metadata'].get('source_name', 'N/A')}' is IRRELEVANT. Discarding.")
-        except Exception as e:
-            print(f"  -> Error during relevance screening: {e}")
-            continue
-            
-    return relevant_chunks
+    query_embedding = embed_texts([text])[0]
+    cache_entry = {
+        "key": make_cache_key(model, source_ids, context_chunks),
+        "query_embedding": query_embedding,
+        "source_ids": set(source_ids or []) | {chunk["metadata"].get("source_id", "") for chunk in context_chunks},
+    }
+    return response_cache.get(cache_entry["key"], query_embedding), cache_entry
+
+def store_cached_response(cache_entry: dict | None, response_text: str):
+    if cache_entry is None or is_error_response(response_text):
+        return
+    response_cache.put(cache_entry["key"], cache_entry["query_embedding"], response_text, cache_entry["source_ids"])
+
+def cached_stream_events(text: str, model: str):
+    """Replays a cached answer as the same SSE events a live stream would send."""
+    yield _sse_event({"type": "delta", "text": text})
+    yield _sse_event({"type": "done", "role": "assistant", "content_type": "text", "model_slug": model})
+
+def cache_streamed_response_in_background(cache_entry: dict | None, stream_state: dict):
+    """Caches a streamed answer once the stream has run to completion."""
+    if stream_state["completed"]:
+        store_cached_response(cache_entry, "".join(stream_state["parts"]))
 
 @app.post("/chat/{chat_id}/message")
-def post_message(chat_id: str, message: MessageRequest, background_tasks: BackgroundTasks):
+async def post_message(chat_id: str, message: MessageRequest, background_tasks: BackgroundTasks):
+    chat_meta = await run_in_threadpool(get_chat_metadata, chat_id)
+    if not chat_meta:
+        return JSONResponse(status_code=404, content={"detail": "Chat not found"})
+
+    model_to_use = chat_meta.get("model") or message.model
     context = ""
+    retrieved_chunks = []
     
     if is_query_search_worthy(message.text):
         print(f"Search-worthy query detected. Searching memory for: '{message.text}'")
         try:
-            retrieved_chunks = query_unified_memory(message.text, source_ids=message.source_ids)
-            
-            if retrieved_chunks:
-                final_chunks = filter_relevant_chunks(message.text, retrieved_chunks)
-                if final_chunks:
-                    context = "\n---\n".join([chunk['document'] for chunk in final_chunks])
-                    
+            # Embedding and the Chroma query are blocking, so keep them off the event loop.
+            retrieved_chunks = await run_in_threadpool(
+                query_unified_memory, message.text,
+                source_ids=message.source_ids, include_distances=True
+            )
         except Exception as e:
             print(f"Error during memory query: {e}")
     else:
         print(f"Conversational query detected. Skipping memory search for: '{message.text}'")
 
+    # The semantic cache is consulted before screening, so a hit skips screening and the AI call.
+    cache_entry = None
+    if response_cache is not None:
+        is_standalone_turn = await run_in_threadpool(get_message_count, chat_id) == 0
+        if is_standalone_turn or RESPONSE_CACHE_IGNORE_HISTORY:
+            cached_text, cache_entry = await run_in_threadpool(
+                lookup_cached_response, message.text, model_to_use, message.source_ids, retrieved_chunks
+            )
+            if cached_text is not None:
+                print(f"Response cache hit for chat {chat_id}.")
+                background_tasks.add_task(
+                    save_conversation_turn_in_background,
+                    chat_id=chat_id,
+                    user_text=message.text,
+                    assistant_text=cached_text,
+                    is_first_turn=is_standalone_turn,
+                    model_used=model_to_use
+                )
+                if message.stream:
+                    return streaming_response(cached_stream_events(cached_text, model_to_use))
+                return {"role": "assistant", "text": cached_text, "content_type": "text", "model_slug": model_to_use}
+
+    if retrieved_chunks:
+        try:
+            final_chunks = await filter_relevant_chunks(message.text, retrieved_chunks)
+            if final_chunks:
+                context = "\n---\n".join([chunk['document'] for chunk in final_chunks])
+        except Exception as e:
+            print(f"Error during memory query: {e}")
+
     if context:
         augmented_prompt = (
             "You are a helpful AI assistant. Your task is to answer the user's question using the provided context. "
@@ -271,20 +468,31 @@ def post_message(chat_id: str, message: MessageRequest, background_tasks: Backgr
     else:
         augmented_prompt = message.text
 
-    chat_data = get_chat_by_id(chat_id, page=1, page_size=10)
-    if not chat_data:
-        return JSONResponse(status_code=404, content={"detail": "Chat not found"})
-    
-    history = chat_data['messages_page']['messages']
-    is_first_turn = len(history) < 1
-    
-    formatted_history = [{"role": msg['role'], "content": msg['text']} for msg in reversed(history)]
+    # Most recent messages first, up to the token budget left after the new prompt.
+    formatted_history, is_first_turn = await run_in_threadpool(
+        build_history, chat_id, model_to_use, reserved_tokens=count_tokens(augmented_prompt)
+    )
     formatted_history.append({"role": "user", "content": augmented_prompt})
+
+    if message.stream:
+        # The turn is saved once the stream has finished; FastAPI attaches these
+        # background tasks to the StreamingResponse, which runs them after the last event.
+        stream_state = {"parts": [], "completed": False}
+        background_tasks.add_task(
+            save_streamed_turn_in_background,
+            chat_id=chat_id,
+            user_text=message.text,
+            stream_state=stream_state,
+            is_first_turn=is_first_turn,
+            model_used=model_to_use
+        )
+        background_tasks.add_task(cache_streamed_response_in_background, cache_entry, stream_state)
+        return streaming_response(stream_response_events(formatted_history, model_to_use, stream_state))
+
+    ai_response_text = await get_ai_response_async(formatted_history, model_to_use)
     
-    model_to_use = chat_data.get("model") or message.model
-    ai_response_text = get_ai_response(formatted_history, model_to_use)
-    
-    if "Sorry, I encountered an error" not in ai_response_text and "AI client not initialized" not in ai_response_text:
+    if not is_error_response(ai_response_text):
+        store_cached_response(cache_entry, ai_response_text)
         background_tasks.add_task(
             save_conversation_turn_in_background,
             chat_id=chat_id,
@@ -297,9 +505,21 @@ def post_message(chat_id: str, message: MessageRequest, background_tasks: Backgr
     return {"role": "assistant", "text": ai_response_text, "content_type": "text", "model_slug": model_to_use}
     
 @app.post("/chat/temporary")
-def post_temporary_message(message: MessageRequest):
+async def post_temporary_message(message: MessageRequest, background_tasks: BackgroundTasks):
     formatted_message = [{"role": "user", "content": message.text}]
-    ai_response_text = get_ai_response(formatted_message, message.model)
+    cache_entry = None
+    if response_cache is not None:
+        cached_text, cache_entry = await run_in_threadpool(lookup_cached_response, message.text, message.model, None, [])
+        if cached_text is not None:
+            if message.stream:
+                return streaming_response(cached_stream_events(cached_text, message.model))
+            return {"role": "assistant", "text": cached_text, "content_type": "text"}
+    if message.stream:
+        stream_state = {"parts": [], "completed": False}
+        background_tasks.add_task(cache_streamed_response_in_background, cache_entry, stream_state)
+        return streaming_response(stream_response_events(formatted_message, message.model, stream_state))
+    ai_response_text = await get_ai_response_async(formatted_message, message.model)
+    store_cached_response(cache_entry, ai_response_text)
     return {"role": "assistant", "text": ai_response_text, "content_type": "text"}
 
 # --- Chat Management Endpoints (Unchanged) ---
@@ -352,8 +572,8 @@ def get_archived_chats():
     return list_archived_chats()
 
 @app.get("/chat/{chat_id}")
-def load_chat(chat_id: str, page: int = 1, page_size: int = 50):
-    chat_data = get_chat_by_id(chat_id, page=page, page_size=page_size)
+def load_chat(chat_id: str, page: int = 1, page_size: int = 50, limit: Optional[int] = None, before: Optional[int] = None):
+    chat_data = get_chat_by_id(chat_id, page=page, page_size=page_size, limit=limit, before=before)
     if not chat_data:
         raise HTTPException(status_code=404, detail=f"Chat with ID {chat_id} not found.")
     return chat_data
@@ -362,4 +582,4 @@ def load_chat(chat_id: str, page: int = 1, page_size: int = 50):
 if __name__ == "__main__":
     os.makedirs("storage/chroma", exist_ok=True)
     os.makedirs("storage/media", exist_ok=True)
-    uvicorn.run("main:app", host="0.0.0.0", port=7860, reload=True)
+    uvicorn.run("main:app", host="0.0.0.0", port=7860, reload=NEUROCHAT_ENV != "production")
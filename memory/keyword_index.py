@@ -0,0 +1,142 @@
+# memory/keyword_index.py
+
+import os
+import re
+import sqlite3
+import threading
+
+KEYWORD_INDEX_FILE = "storage/keyword_index.sqlite"
+# Set to "0" to stop maintaining the index. Keyword search and hybrid retrieval then return nothing extra.
+KEYWORD_INDEX_ENABLED = os.getenv("KEYWORD_INDEX_ENABLED", "1") == "1"
+
+# Query terms: runs of letters/digits, keeping identifier punctuation such as "E_1234" or "node.js" together.
+_TERM_PATTERN = re.compile(r"\w+(?:[.\-:/]\w+)*")
+
+def _to_match_expression(query: str) -> str | None:
+    """Turns free text into an FTS5 query that ORs the quoted terms, so BM25 ranks partial matches too."""
+    terms = _TERM_PATTERN.findall(query)
+    if not terms:
+        return None
+    return " OR ".join('"' + term.replace('"', '""') + '"' for term in dict.fromkeys(terms))
+
+class KeywordIndex:
+    """
+    A BM25 inverted index over everything stored in unified_memory, kept in SQLite FTS5.
+    Documents are indexed by their Chroma ID and source_id, so they can be removed per source
+    and restricted to the same source_ids as vector queries.
+    """
+
+    def __init__(self, db_file: str = KEYWORD_INDEX_FILE):
+        self.db_file = db_file
+        os.makedirs(os.path.dirname(db_file), exist_ok=True)
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._create_schema()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, isolation_level=None, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _create_schema(self):
+        self._connection().executescript("""
+            CREATE TABLE IF NOT EXISTS documents (
+                rowid INTEGER PRIMARY KEY,
+                doc_id TEXT NOT NULL UNIQUE,
+                source_id TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_documents_source ON documents(source_id);
+            CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(
+                text, tokenize = 'unicode61 remove_diacritics 2'
+            );
+        """)
+
+    def add(self, ids: list[str], documents: list[str], metadatas: list[dict]):
+        """Indexes documents under their IDs. Re-adding an ID replaces its text."""
+        if not ids:
+            return
+        conn = self._connection()
+        with self._write_lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for doc_id, text, metadata in zip(ids, documents, metadatas):
+                    existing = conn.execute("SELECT rowid FROM documents WHERE doc_id = ?", (doc_id,)).fetchone()
+                    if existing:
+                        conn.execute("DELETE FROM documents_fts WHERE rowid = ?", (existing[0],))
+                        conn.execute("DELETE FROM documents WHERE rowid = ?", (existing[0],))
+                    cursor = conn.execute(
+                        "INSERT INTO documents (doc_id, source_id) VALUES (?, ?)",
+                        (doc_id, metadata.get("source_id", ""))
+                    )
+                    conn.execute("INSERT INTO documents_fts (rowid, text) VALUES (?, ?)", (cursor.lastrowid, text or ""))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def delete_source(self, source_id: str):
+        """Removes every document of a source from the index."""
+        conn = self._connection()
+        with self._write_lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    "DELETE FROM documents_fts WHERE rowid IN (SELECT rowid FROM documents WHERE source_id = ?)",
+                    (source_id,)
+                )
+                conn.execute("DELETE FROM documents WHERE source_id = ?", (source_id,))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def clear(self):
+        conn = self._connection()
+        with self._write_lock:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM documents_fts")
+            conn.execute("DELETE FROM documents")
+            conn.execute("COMMIT")
+
+    def count(self) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+    def search(self, query: str, source_ids: list[str] | None = None, limit: int = 10) -> list[dict]:
+        """
+        Returns the best BM25 matches as dicts with id, source_id, score (higher is better)
+        and a short snippet around the matched terms.
+        """
+        expression = _to_match_expression(query)
+        if not expression:
+            return []
+        sql = """
+            SELECT d.doc_id, d.source_id, bm25(documents_fts) AS rank,
+                   snippet(documents_fts, 0, '', '', ' … ', 24)
+            FROM documents_fts JOIN documents d ON d.rowid = documents_fts.rowid
+            WHERE documents_fts MATCH ?
+        """
+        params = [expression]
+        if source_ids:
+            sql += f" AND d.source_id IN ({','.join('?' * len(source_ids))})"
+            params.extend(source_ids)
+        sql += " ORDER BY rank LIMIT ?"
+        params.append(limit)
+        rows = self._connection().execute(sql, params).fetchall()
+        # FTS5's bm25() is negative, with more negative meaning more relevant.
+        return [{"id": row[0], "source_id": row[1], "score": -row[2], "snippet": row[3]} for row in rows]
+
+def _create_keyword_index() -> KeywordIndex | None:
+    if not KEYWORD_INDEX_ENABLED:
+        return None
+    try:
+        return KeywordIndex()
+    except sqlite3.OperationalError as e:
+        # Raised when this Python's SQLite was built without FTS5.
+        print(f"Keyword index unavailable, keyword search is disabled: {e}")
+        return None
+
+keyword_index = _create_keyword_index()
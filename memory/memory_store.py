@@ -1,23 +1,156 @@
 # memory/memory_store.py
 
-import chromadb
+import os
 import uuid
 import json
 import re
+import threading
+from collections import OrderedDict, deque
+from contextlib import ExitStack
 from datetime import datetime
-from chat.ai_services import embed_texts
+from chat.ai_services import embed_texts, warm_up_embedding_model, EMBEDDING_MODEL_NAME, EMBEDDING_MODEL_VERSION
+from chat.embedding_backends import EmbeddingProcessPool
+from chat.metadata_store import metadata_store
+from memory.keyword_index import keyword_index
+from chat.response_cache import response_cache
+from memory.vector_store import VectorStore, create_vector_store, VECTOR_STORE_BACKEND
 
-chroma_client = chromadb.PersistentClient(path="storage/chroma")
+# The vector store (Chroma by default, see memory/vector_store.py) is opened on first use instead
+# of at import time, so the server can start without waiting for it.
+_vector_store = None
+_vector_store_lock = threading.Lock()
 
-try:
-    unified_memory_collection = chroma_client.get_or_create_collection(name="unified_memory")
-    print("Successfully connected to ChromaDB and got 'unified_memory' collection.")
-except Exception as e:
-    print(f"FATAL: Could not connect to ChromaDB. Error: {e}")
-    unified_memory_collection = None
+def _get_collection() -> VectorStore | None:
+    """Returns the vector store holding unified memory, opening it on the first call. None if that fails."""
+    global _vector_store
+    if _vector_store is None:
+        with _vector_store_lock:
+            if _vector_store is None:
+                try:
+                    _vector_store = create_vector_store()
+                    print(f"Successfully opened the '{VECTOR_STORE_BACKEND}' vector store for unified memory.")
+                except Exception as e:
+                    print(f"FATAL: Could not open the vector store. Error: {e}")
+    return _vector_store
 
-def save_imported_message(chat_id: str, message_obj: dict, order_index: int):
-    if not unified_memory_collection: return
+# Upper bound on documents per collection.add call during bulk ingestion.
+IMPORT_WRITE_BATCH_SIZE = 5000
+
+# Bump when the rendered message format changes, so old render caches are ignored.
+RENDER_CACHE_FORMAT = 1
+# Cached messages read at a time while looking for the last user message to re-render from.
+RENDER_TAIL_SCAN_SIZE = 16
+
+# Hybrid retrieval: fuse vector and BM25 keyword rankings with reciprocal rank fusion.
+RETRIEVAL_HYBRID_ENABLED = os.getenv("RETRIEVAL_HYBRID_ENABLED", "0") == "1"
+RRF_K = 60
+# Each ranking contributes this many times n_results candidates to the fusion.
+HYBRID_CANDIDATE_MULTIPLIER = 4
+# Documents read from Chroma at a time when rebuilding the keyword index.
+KEYWORD_REINDEX_BATCH_SIZE = 2000
+
+# Re-embedding unified_memory with the local model: documents per batch, and worker processes
+# embedding batches in parallel (each loads its own copy of the model).
+REINDEX_BATCH_SIZE = int(os.getenv("REINDEX_BATCH_SIZE", "512"))
+REINDEX_WORKERS = int(os.getenv("REINDEX_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+
+# LRU cache of query_unified_memory results. Entries are tagged with the memory version
+# they were computed at; every add or delete bumps the version, so stale results are never served.
+RETRIEVAL_CACHE_MAX_ENTRIES = int(os.getenv("RETRIEVAL_CACHE_MAX_ENTRIES", "1000"))
+_memory_version = 0
+_retrieval_cache = OrderedDict()
+_retrieval_cache_lock = threading.Lock()
+
+# In-memory cache of each chat's next free order_index, backed by the metadata store.
+_next_order_index = {}
+# One lock per chat guards its order_index sequence, so a slow first-use scan of one chat
+# never holds up writes to the others. Storing a chat's messages (allocation and write) and
+# building or updating its render cache also hold it, so a cache is never built from a scan
+# that misses a message whose order_index was already counted.
+_chat_locks = {}
+_chat_locks_guard = threading.Lock()
+
+def _bump_memory_version():
+    """Marks unified_memory as changed. Called after every write to the collection."""
+    global _memory_version
+    with _retrieval_cache_lock:
+        _memory_version += 1
+        _retrieval_cache.clear()
+
+def _index_keywords(ids: list, documents: list, metadatas: list):
+    """Adds documents to the keyword index. Failures are logged; the vector write has already succeeded."""
+    if keyword_index is None: return
+    try:
+        keyword_index.add(ids, documents, metadatas)
+    except Exception as e:
+        print(f"Error updating keyword index: {e}")
+
+def _unindex_keywords(source_id: str):
+    if keyword_index is None: return
+    try:
+        keyword_index.delete_source(source_id)
+    except Exception as e:
+        print(f"Error removing '{source_id}' from keyword index: {e}")
+
+def _invalidate_cached_responses(source_id: str):
+    if response_cache is not None:
+        response_cache.invalidate_source(source_id)
+
+def _chat_lock(chat_id: str) -> threading.RLock:
+    with _chat_locks_guard:
+        lock = _chat_locks.get(chat_id)
+        if lock is None:
+            lock = _chat_locks[chat_id] = threading.RLock()
+        return lock
+
+def _seed_next_order_index(chat_id: str) -> int:
+    """One-time scan for chats saved before the sequence was persisted."""
+    existing_messages = _get_collection().get(where={"source_id": chat_id}, include=["metadatas"])
+    indices = [meta.get("order_index", -1) for meta in existing_messages.get("metadatas") or []]
+    return max(indices, default=-1) + 1
+
+def _load_next_order_index(chat_id: str) -> int:
+    """
+    The chat's next free order_index, from memory, the metadata store or, for chats saved before
+    the sequence was persisted, a one-time scan whose result is persisted. The caller holds the chat's lock.
+    """
+    next_index = _next_order_index.get(chat_id)
+    if next_index is None:
+        next_index = metadata_store.get_next_order_index(chat_id)
+        if next_index is None:
+            next_index = _seed_next_order_index(chat_id)
+            metadata_store.set_next_order_index(chat_id, next_index)
+        _next_order_index[chat_id] = next_index
+    return next_index
+
+def allocate_order_indices(chat_id: str, count: int = 1) -> int:
+    """
+    Atomically reserves count consecutive order_index values for a chat and returns the first.
+    The counter is cached in memory and persisted, so appending costs the same for any chat length.
+    """
+    with _chat_lock(chat_id):
+        next_index = _load_next_order_index(chat_id)
+        _next_order_index[chat_id] = next_index + count
+        metadata_store.set_next_order_index(chat_id, next_index + count)
+    return next_index
+
+def get_message_count(chat_id: str) -> int:
+    """Returns how many order_index values a chat has used, i.e. its stored message count."""
+    if not _get_collection():
+        return 0
+    with _chat_lock(chat_id):
+        return _load_next_order_index(chat_id)
+
+def _reset_order_indices(chat_id: str):
+    with _chat_lock(chat_id):
+        _next_order_index.pop(chat_id, None)
+        metadata_store.delete_next_order_index(chat_id)
+
+def _build_imported_message_record(chat_id: str, message_obj: dict) -> tuple[str, str, dict] | None:
+    """
+    Builds the (id, document, metadata) triple for an imported message, or None if it has no content.
+    order_index is filled in when the batch is saved.
+    """
     message_id = f"msg_{uuid.uuid4().hex}"
     role = message_obj.get("role", "unknown")
     text = message_obj.get("text", "")
@@ -42,41 +175,115 @@ def save_imported_message(chat_id: str, message_obj: dict, order_index: int):
         "citations": json.dumps(message_obj.get("citations", [])),
         "details_title": message_obj.get("details_title") or "",
         "details_content": message_obj.get("details_content") or "",
-        "order_index": order_index
+        "order_index": -1,
+        "embedding_model": EMBEDDING_MODEL_VERSION
     }
     
     if message_obj.get("custom_instructions"):
         metadata["custom_instructions"] = message_obj["custom_instructions"]
 
     if not text.strip() and not message_obj.get("custom_instructions"):
-        return
-        
-    unified_memory_collection.add(ids=[message_id], documents=[text], metadatas=[metadata])
+        return None
+
+    return message_id, text, metadata
+
+def save_imported_messages_bulk(entries: list[tuple[str, dict]]):
+    """
+    Saves many imported messages at once. Each entry is (chat_id, message_obj), in chat order.
+    Each chat gets one block of order_index values from the allocator. Embeddings are created
+    locally in one embed_texts call and written with as few collection.add calls as the
+    Chroma batch limit allows.
+    """
+    collection = _get_collection()
+    if not collection: return
+    records = [record for record in (_build_imported_message_record(*entry) for entry in entries) if record]
+    if not records: return
+
+    records_by_chat = {}
+    for record in records:
+        records_by_chat.setdefault(record[2]["source_id"], []).append(record)
+
+    ids = [record[0] for record in records]
+    documents = [record[1] for record in records]
+    metadatas = [record[2] for record in records]
+    # Embedding is the slow part, so it happens before the chats' locks are taken.
+    embeddings = embed_texts(documents, background=True)
+
+    with ExitStack() as chat_locks:
+        # Always taken in sorted order, so two imports cannot deadlock on each other's chats.
+        for chat_id in sorted(records_by_chat):
+            chat_locks.enter_context(_chat_lock(chat_id))
+        complete_chats = []
+        for chat_id, chat_records in records_by_chat.items():
+            start_index = allocate_order_indices(chat_id, len(chat_records))
+            for offset, record in enumerate(chat_records):
+                record[2]["order_index"] = start_index + offset
+            if start_index == 0:
+                complete_chats.append(chat_id)
+
+        batch_size = min(IMPORT_WRITE_BATCH_SIZE, collection.get_max_batch_size())
+        for start in range(0, len(ids), batch_size):
+            end = start + batch_size
+            collection.add(
+                ids=ids[start:end], documents=documents[start:end],
+                embeddings=embeddings[start:end], metadatas=metadatas[start:end]
+            )
+            _index_keywords(ids[start:end], documents[start:end], metadatas[start:end])
+        _bump_memory_version()
+
+        # Imported history never changes, so render chats that are fully contained
+        # in this batch right away from what we just wrote.
+        for chat_id in complete_chats:
+            chat_records = records_by_chat[chat_id]
+            sorted_messages = _messages_from_results({
+                "ids": [record[0] for record in chat_records],
+                "documents": [record[1] for record in chat_records],
+                "metadatas": [record[2] for record in chat_records]
+            })
+            _store_render_cache(chat_id, len(chat_records), _render_messages(sorted_messages))
 
 def save_chunks_to_memory(ids: list, chunks: list, embeddings: list, metadatas: list):
-    if not unified_memory_collection: return
-    unified_memory_collection.add(ids=ids, documents=chunks, embeddings=embeddings, metadatas=metadatas)
+    collection = _get_collection()
+    if not collection: return
+    for metadata in metadatas:
+        metadata["embedding_model"] = EMBEDDING_MODEL_VERSION
+    collection.add(ids=ids, documents=chunks, embeddings=embeddings, metadatas=metadatas)
+    _index_keywords(ids, chunks, metadatas)
+    _bump_memory_version()
+
+def delete_chunks_for_source(source_id: str):
+    """Removes every chunk stored for a file source, e.g. to roll back a failed upload."""
+    collection = _get_collection()
+    if not collection: return
+    collection.delete(where={"source_id": source_id})
+    _unindex_keywords(source_id)
+    _invalidate_cached_responses(source_id)
+    _bump_memory_version()
 
 def save_to_memory(text: str, chat_id: str, role: str, content_type: str = "text", media_url: str = None, message_timestamp: float = None, model_slug: str = None):
-    if not unified_memory_collection: return
+    collection = _get_collection()
+    if not collection: return
     
     message_id = f"msg_{uuid.uuid4().hex}"
     timestamp = message_timestamp if message_timestamp is not None else datetime.now().timestamp()
-    
-    existing_messages = unified_memory_collection.get(where={"source_id": chat_id}, include=[])
-    order_index = len(existing_messages.get("ids", []))
-
-    metadata = {
-        "source_id": chat_id, "source_type": "chat_message", "role": role, "timestamp": timestamp,
-        "content_type": content_type or "text", "media_url": media_url or "",
-        "is_hidden": False,
-        "model_slug": model_slug or "",
-        "citations": "[]",
-        "order_index": order_index
-    }
-    
+    # Embedded before taking the chat's lock, so readers of this chat do not wait for the model.
     embedding = embed_texts([text])[0]
-    unified_memory_collection.add(ids=[message_id], documents=[text], embeddings=[embedding], metadatas=[metadata])
+
+    with _chat_lock(chat_id):
+        order_index = allocate_order_indices(chat_id)
+        metadata = {
+            "source_id": chat_id, "source_type": "chat_message", "role": role, "timestamp": timestamp,
+            "content_type": content_type or "text", "media_url": media_url or "",
+            "is_hidden": False,
+            "model_slug": model_slug or "",
+            "citations": "[]",
+            "order_index": order_index,
+            "embedding_model": EMBEDDING_MODEL_VERSION
+        }
+        collection.add(ids=[message_id], documents=[text], embeddings=[embedding], metadatas=[metadata])
+        _append_to_render_cache(chat_id, order_index)
+    _index_keywords([message_id], [text], [metadata])
+    _bump_memory_version()
 
 def _process_citations_in_text(text: str, citations: list) -> str:
     """
@@ -106,11 +313,8 @@ def _process_citations_in_text(text: str, citations: list) -> str:
     
     return final_text
 
-def get_messages_for_chat(chat_id: str, page: int = 1, page_size: int = 40) -> dict:
-    if not unified_memory_collection:
-        return {"messages": [], "total_messages_in_chat": 0, "page": page, "page_size": page_size}
-    
-    results = unified_memory_collection.get(where={"source_id": chat_id}, include=["metadatas", "documents"])
+def _messages_from_results(results: dict) -> list[dict]:
+    """Turns a collection.get result into message dicts, sorted into chat order."""
     all_messages = []
     if results and results['ids']:
         for doc, meta in zip(results.get("documents", []), results.get("metadatas", [])):
@@ -128,20 +332,27 @@ def get_messages_for_chat(chat_id: str, page: int = 1, page_size: int = 40) -> d
                     message["custom_instructions"] = meta.get("custom_instructions")
                 all_messages.append(message)
 
-    all_sorted_messages = sorted(all_messages, key=lambda x: (x.get('order_index', -1), x.get('timestamp', 0)))
-    
+    return sorted(all_messages, key=lambda x: (x.get('order_index', -1), x.get('timestamp', 0)))
+
+def _render_messages(sorted_messages: list[dict]) -> list[tuple[int, dict]]:
+    """
+    Merges assistant/hidden/assistant sequences into single messages with content_parts
+    and rewrites citation markers, producing the list the frontend renders.
+    Returns (start_index, message) pairs, where start_index is the order_index of the
+    first stored message the rendered message was built from.
+    """
     grouped_messages = []
     i = 0
-    while i < len(all_sorted_messages):
-        current_msg = all_sorted_messages[i]
+    while i < len(sorted_messages):
+        current_msg = sorted_messages[i]
         if current_msg.get("role") == "assistant" and not current_msg.get("is_hidden"):
             sequence = [current_msg]
             j = i + 1
-            while j < len(all_sorted_messages) and all_sorted_messages[j].get("is_hidden"):
-                sequence.append(all_sorted_messages[j])
+            while j < len(sorted_messages) and sorted_messages[j].get("is_hidden"):
+                sequence.append(sorted_messages[j])
                 j += 1
-            if j < len(all_sorted_messages) and all_sorted_messages[j].get("role") == "assistant" and not all_sorted_messages[j].get("is_hidden"):
-                final_answer_msg = all_sorted_messages[j]
+            if j < len(sorted_messages) and sorted_messages[j].get("role") == "assistant" and not sorted_messages[j].get("is_hidden"):
+                final_answer_msg = sorted_messages[j]
                 sequence.append(final_answer_msg)
                 intro_msg = sequence[0]
                 intro_text = intro_msg['text']
@@ -169,15 +380,15 @@ def get_messages_for_chat(chat_id: str, page: int = 1, page_size: int = 40) -> d
                     'content_parts': content_parts,
                     'text': None
                 }
-                grouped_messages.append(merged_msg)
+                grouped_messages.append((intro_msg.get("order_index", -1), merged_msg))
                 i = j + 1
                 continue
         if not current_msg.get("is_hidden"):
-            grouped_messages.append(current_msg)
+            grouped_messages.append((current_msg.get("order_index", -1), current_msg))
         i += 1
 
     final_processed_messages = []
-    for msg in grouped_messages:
+    for start_index, msg in grouped_messages:
         citations = msg.get("citations", [])
         if citations:
             if msg.get('is_merged_message'):
@@ -186,7 +397,75 @@ def get_messages_for_chat(chat_id: str, page: int = 1, page_size: int = 40) -> d
                         part['content'] = _process_citations_in_text(part['content'], citations)
             elif msg.get('text'):
                 msg['text'] = _process_citations_in_text(msg['text'], citations)
-        final_processed_messages.append(msg)
+        final_processed_messages.append((start_index, msg))
+    return final_processed_messages
+
+def _render_cache_version(message_count: int) -> str:
+    return f"{RENDER_CACHE_FORMAT}:{message_count}"
+
+def _has_valid_render_cache(chat_id: str, message_count: int) -> bool:
+    return metadata_store.get_render_cache_version(chat_id) == _render_cache_version(message_count)
+
+def _store_render_cache(chat_id: str, message_count: int, rendered: list[tuple[int, dict]]):
+    try:
+        metadata_store.put_render_cache(chat_id, _render_cache_version(message_count), rendered)
+    except Exception as e:
+        print(f"Could not store render cache for chat {chat_id}: {e}")
+
+def _rebuild_render_cache(chat_id: str) -> list[tuple[int, dict]]:
+    """Renders the whole chat from the collection and stores it as its render cache. Returns the rendered list."""
+    # Under the chat's lock no message can be allocated or written between the count and the scan.
+    with _chat_lock(chat_id):
+        message_count = get_message_count(chat_id)
+        results = _get_collection().get(where={"source_id": chat_id}, include=["metadatas", "documents"])
+        rendered = _render_messages(_messages_from_results(results))
+        _store_render_cache(chat_id, message_count, rendered)
+    return rendered
+
+def _last_rendered_turn_start(chat_id: str) -> int:
+    """order_index of the newest user message in the chat's render cache, or 0 if it has none."""
+    before = None
+    while True:
+        rendered = metadata_store.get_rendered_before(chat_id, before, RENDER_TAIL_SCAN_SIZE)
+        for start_index, message in reversed(rendered):
+            if _is_turn_start(message):
+                return start_index
+        if len(rendered) < RENDER_TAIL_SCAN_SIZE:
+            return 0
+        before = rendered[0][0]
+
+def _append_to_render_cache(chat_id: str, order_index: int):
+    """
+    Adds the message just stored at order_index to a chat's valid render cache instead of dropping
+    the cache. A new assistant message can merge with the ones before it, so the messages from the
+    last user message on are rendered again. The caller holds the chat's lock.
+    """
+    if not _has_valid_render_cache(chat_id, order_index):
+        return  # No cache, or already stale: the next read rebuilds it.
+    try:
+        turn_start = _last_rendered_turn_start(chat_id)
+        tail = _render_messages(_get_messages_in_range(chat_id, turn_start, order_index + 1))
+        metadata_store.replace_rendered_tail(chat_id, turn_start, _render_cache_version(order_index + 1), tail)
+    except Exception as e:
+        print(f"Could not update render cache for chat {chat_id}: {e}")
+        metadata_store.delete_render_cache(chat_id)
+
+def get_messages_for_chat(chat_id: str, page: int = 1, page_size: int = 40) -> dict:
+    collection = _get_collection()
+    if not collection:
+        return {"messages": [], "total_messages_in_chat": 0, "page": page, "page_size": page_size}
+
+    if _has_valid_render_cache(chat_id, get_message_count(chat_id)):
+        paginated_messages, total_messages_in_chat = metadata_store.get_rendered_page(chat_id, (page - 1) * page_size, page_size)
+        return {
+            "messages": paginated_messages,
+            "total_messages_in_chat": total_messages_in_chat,
+            "page": page, "page_size": page_size
+        }
+    
+    # We process the whole chat anyway, so keep the result for the next read.
+    rendered = _rebuild_render_cache(chat_id)
+    final_processed_messages = [msg for _, msg in rendered]
     
     total_messages_in_chat = len(final_processed_messages)
     start_index = (page - 1) * page_size
@@ -199,26 +478,263 @@ def get_messages_for_chat(chat_id: str, page: int = 1, page_size: int = 40) -> d
         "page": page, "page_size": page_size
     }
 
+def _get_messages_in_range(chat_id: str, start: int, end: int) -> list[dict]:
+    """Fetches only the messages with start <= order_index < end."""
+    results = _get_collection().get(
+        where={"$and": [
+            {"source_id": chat_id},
+            {"order_index": {"$gte": start}},
+            {"order_index": {"$lt": end}}
+        ]},
+        include=["metadatas", "documents"]
+    )
+    return _messages_from_results(results)
+
+def _is_turn_start(message: dict) -> bool:
+    """A visible user message never belongs to an assistant/hidden group, so windows can start there."""
+    return message.get("role") == "user" and not message.get("is_hidden")
+
+def _render_window(chat_id: str, message_count: int, limit: int, before: int | None) -> list[tuple[int, dict]]:
+    """
+    Renders the messages before the `before` cursor straight from Chroma, for metadata stores
+    without a render cache. Stored rows are read backwards `limit` at a time until the rows from
+    the earliest user message on render to more than `limit` messages, or the chat's start is
+    reached. Rows before that user message are left for the next page, so assistant sequences
+    are never split. Returns up to limit + 1 (start_index, message) pairs, like the cache.
+    """
+    end = message_count if before is None else min(before, message_count)
+    start = end
+    window_messages = []
+    while start > 0:
+        new_start = max(0, start - max(limit, 1))
+        window_messages = _get_messages_in_range(chat_id, new_start, start) + window_messages
+        start = new_start
+        turn_start = next((i for i, message in enumerate(window_messages) if _is_turn_start(message)), None)
+        if start > 0 and turn_start is not None and len(_render_messages(window_messages[turn_start:])) > limit:
+            window_messages = window_messages[turn_start:]
+            break
+    return _render_messages(window_messages)[-(limit + 1):]
+
+def get_message_window(chat_id: str, limit: int = 50, before: int | None = None) -> dict:
+    """
+    Cursor-based pagination on order_index. Returns the latest `limit` rendered messages, or the
+    `limit` before the `before` cursor. When the metadata store keeps render caches, a missing or
+    stale cache is rebuilt once and every page is read from it; otherwise the window is rendered
+    from Chroma (see _render_window). next_cursor is passed as `before` for the next (older) page.
+    """
+    total_messages_in_chat = get_message_count(chat_id)
+    if not _get_collection():
+        return {"messages": [], "total_messages_in_chat": 0, "limit": limit, "next_cursor": None, "has_more": False}
+
+    # One extra message is fetched to know whether older messages exist.
+    if not metadata_store.has_render_cache:
+        rendered = _render_window(chat_id, total_messages_in_chat, limit, before)
+    elif _has_valid_render_cache(chat_id, total_messages_in_chat):
+        # Served from the precomputed render cache: no Chroma read and no regex work.
+        rendered = metadata_store.get_rendered_before(chat_id, before, limit + 1)
+    else:
+        rendered = [item for item in _rebuild_render_cache(chat_id) if before is None or item[0] < before][-(limit + 1):]
+    has_more = len(rendered) > limit
+    rendered = rendered[-limit:]
+    return {
+        "messages": [msg for _, msg in rendered],
+        "total_messages_in_chat": total_messages_in_chat,
+        "limit": limit,
+        "next_cursor": rendered[0][0] if has_more and rendered else None,
+        "has_more": has_more
+    }
+
 def delete_messages_for_chat(chat_id: str):
-    if not unified_memory_collection: return
-    unified_memory_collection.delete(where={"source_id": chat_id})
+    collection = _get_collection()
+    if not collection: return
+    with _chat_lock(chat_id):
+        collection.delete(where={"source_id": chat_id})
+        _reset_order_indices(chat_id)
+        metadata_store.delete_render_cache(chat_id)
+    _unindex_keywords(chat_id)
+    _invalidate_cached_responses(chat_id)
+    _bump_memory_version()
+
+def warm_up_memory(query_embedding: list[float] | None = None):
+    """Opens the collection and, given an embedding, runs one query so the vector index is loaded."""
+    collection = _get_collection()
+    if not collection:
+        raise RuntimeError("Could not open the 'unified_memory' collection.")
+    if query_embedding is not None and collection.count():
+        collection.query(query_embeddings=[query_embedding], n_results=1, include=[])
+
+def _copy_results(results: list[dict]) -> list[dict]:
+    return [{**result, "metadata": dict(result["metadata"])} for result in results]
+
+def query_unified_memory(query_text: str, source_ids: list[str] | None = None, n_results: int = 5, include_distances: bool = False, hybrid: bool | None = None) -> list[dict]:
+    """
+    Vector search over unified_memory. With hybrid (default: RETRIEVAL_HYBRID_ENABLED), the vector
+    ranking is fused with a BM25 keyword ranking, so exact terms such as error codes and names are found
+    even when they are not close in embedding space. Keyword-only results carry no distance.
+    Identical lookups are answered from the retrieval cache until memory changes.
+    """
+    if not _get_collection(): return []
+    use_keywords = (RETRIEVAL_HYBRID_ENABLED if hybrid is None else hybrid) and keyword_index is not None
+    cache_key = (query_text, tuple(sorted(source_ids)) if source_ids else None, n_results, include_distances, use_keywords)
+    with _retrieval_cache_lock:
+        version = _memory_version
+        cached = _retrieval_cache.get(cache_key)
+        if cached is not None:
+            _retrieval_cache.move_to_end(cache_key)
+            return _copy_results(cached)
+
+    results = _query_unified_memory_uncached(query_text, source_ids, n_results, include_distances, use_keywords)
 
-def query_unified_memory(query_text: str, source_ids: list[str] | None = None, n_results: int = 5) -> list[dict]:
-    if not unified_memory_collection: return []
+    with _retrieval_cache_lock:
+        # Results computed while memory was being written are not cached.
+        if version == _memory_version and RETRIEVAL_CACHE_MAX_ENTRIES > 0:
+            _retrieval_cache[cache_key] = _copy_results(results)
+            while len(_retrieval_cache) > RETRIEVAL_CACHE_MAX_ENTRIES:
+                _retrieval_cache.popitem(last=False)
+    return results
+
+def _query_unified_memory_uncached(query_text: str, source_ids: list[str] | None, n_results: int, include_distances: bool, use_keywords: bool) -> list[dict]:
+    n_candidates = n_results * HYBRID_CANDIDATE_MULTIPLIER if use_keywords else n_results
     
     query_embedding = embed_texts([query_text])[0]
     filter_metadata = {"source_id": {"$in": source_ids}} if source_ids else None
+    include = ["documents", "metadatas", "distances"] if include_distances else ["documents", "metadatas"]
     
-    results = unified_memory_collection.query(
-        query_embeddings=[query_embedding], n_results=n_results,
-        where=filter_metadata, include=["documents", "metadatas"]
+    results = _get_collection().query(
+        query_embeddings=[query_embedding], n_results=n_candidates,
+        where=filter_metadata, include=include
     )
     
     combined_results = []
     if results and results.get('ids') and results['ids'][0]:
         for i, doc_id in enumerate(results['ids'][0]):
-            combined_results.append({
+            result = {
                 "id": doc_id, "document": results['documents'][0][i],
                 "metadata": results['metadatas'][0][i]
-            })
-    return combined_results
+            }
+            if include_distances:
+                result["distance"] = results['distances'][0][i]
+            combined_results.append(result)
+    if not use_keywords:
+        return combined_results
+    return _fuse_with_keyword_results(query_text, source_ids, combined_results, n_results, n_candidates, include_distances)
+
+def _fuse_with_keyword_results(query_text: str, source_ids: list[str] | None, vector_results: list[dict], n_results: int, n_candidates: int, include_distances: bool) -> list[dict]:
+    """Reciprocal rank fusion of the vector results with the keyword index's results."""
+    try:
+        keyword_hits = keyword_index.search(query_text, source_ids=source_ids, limit=n_candidates)
+    except Exception as e:
+        print(f"Error during keyword search, using vector results only: {e}")
+        return vector_results[:n_results]
+
+    fused_scores = {}
+    for rank, result in enumerate(vector_results):
+        fused_scores[result["id"]] = fused_scores.get(result["id"], 0.0) + 1.0 / (RRF_K + rank + 1)
+    for rank, hit in enumerate(keyword_hits):
+        fused_scores[hit["id"]] = fused_scores.get(hit["id"], 0.0) + 1.0 / (RRF_K + rank + 1)
+
+    top_ids = sorted(fused_scores, key=fused_scores.get, reverse=True)[:n_results]
+    results_by_id = {result["id"]: result for result in vector_results}
+    missing_ids = [doc_id for doc_id in top_ids if doc_id not in results_by_id]
+    if missing_ids:
+        fetched = _get_collection().get(ids=missing_ids, include=["documents", "metadatas"])
+        for i, doc_id in enumerate(fetched["ids"]):
+            result = {"id": doc_id, "document": fetched["documents"][i], "metadata": fetched["metadatas"][i]}
+            if include_distances:
+                result["distance"] = None
+            results_by_id[doc_id] = result
+    return [results_by_id[doc_id] for doc_id in top_ids if doc_id in results_by_id]
+
+def keyword_search_memory(query_text: str, source_ids: list[str] | None = None, n_results: int = 10) -> list[dict]:
+    """BM25 keyword search over unified_memory. Does not run the embedding model."""
+    if keyword_index is None: return []
+    return keyword_index.search(query_text, source_ids=source_ids, limit=n_results)
+
+def rebuild_keyword_index(progress_callback=None) -> int:
+    """
+    Rebuilds the keyword index from everything in unified_memory, e.g. for data stored before
+    the index existed. Documents are read in batches. Returns the number of documents indexed.
+    """
+    collection = _get_collection()
+    if not collection or keyword_index is None: return 0
+    keyword_index.clear()
+    total = collection.count()
+    indexed = 0
+    while indexed < total:
+        batch = collection.get(
+            limit=KEYWORD_REINDEX_BATCH_SIZE, offset=indexed, include=["documents", "metadatas"]
+        )
+        if not batch["ids"]:
+            break
+        keyword_index.add(batch["ids"], batch["documents"], batch["metadatas"])
+        indexed += len(batch["ids"])
+        if progress_callback:
+            progress_callback(indexed, total)
+    return indexed
+
+def get_embedding_status() -> dict:
+    """
+    Counts the documents whose vectors were not made by the current embedding model, including
+    ones stored before vectors were tagged with their model. Those need reindex_memory_embeddings.
+    """
+    collection = _get_collection()
+    if not collection:
+        return {"embedding_model": EMBEDDING_MODEL_VERSION, "total": 0, "current": 0, "stale": 0}
+    total = collection.count()
+    current = len(collection.get(where={"embedding_model": EMBEDDING_MODEL_VERSION}, include=[])["ids"])
+    return {"embedding_model": EMBEDDING_MODEL_VERSION, "total": total, "current": current, "stale": total - current}
+
+def reindex_memory_embeddings(start_offset: int = 0, force: bool = False, progress_callback=None) -> int:
+    """
+    Re-embeds unified_memory with the local model, e.g. history imported while Chroma still made
+    the embeddings, so every vector lives in the same space. Documents are streamed out in batches
+    of REINDEX_BATCH_SIZE, embedded on REINDEX_WORKERS processes and written back in bulk, in order,
+    tagged with EMBEDDING_MODEL_VERSION. Documents already tagged with it are skipped unless force is set.
+
+    progress_callback(offset, total) runs after each batch is written; a later call with
+    start_offset=offset continues the pass from there. Returns the number of documents re-embedded.
+    """
+    collection = _get_collection()
+    if not collection: return 0
+    total = collection.count()
+    if start_offset >= total: return 0
+    # Load (and for ONNX, export) the model once here, before the workers all try to at the same time.
+    warm_up_embedding_model()
+    pool = EmbeddingProcessPool(EMBEDDING_MODEL_NAME, workers=REINDEX_WORKERS)
+    # Batches read but not yet written: (offset after the batch, ids, future of their embeddings).
+    # Two per worker keeps every worker busy while the oldest batch is written.
+    pending = deque()
+    read_offset = start_offset
+    reembedded = 0
+    try:
+        while read_offset < total or pending:
+            while read_offset < total and len(pending) < 2 * REINDEX_WORKERS:
+                batch = collection.get(
+                    limit=REINDEX_BATCH_SIZE, offset=read_offset, include=["documents", "metadatas"]
+                )
+                if not batch["ids"]:
+                    total = read_offset
+                    break
+                read_offset += len(batch["ids"])
+                stale = [
+                    i for i, metadata in enumerate(batch["metadatas"])
+                    if force or (metadata or {}).get("embedding_model") != EMBEDDING_MODEL_VERSION
+                ]
+                ids = [batch["ids"][i] for i in stale]
+                future = pool.submit([batch["documents"][i] or "" for i in stale]) if ids else None
+                pending.append((read_offset, ids, future))
+            if not pending:
+                break
+            end_offset, ids, future = pending.popleft()
+            if ids:
+                collection.update(
+                    ids=ids, embeddings=future.result(),
+                    metadatas=[{"embedding_model": EMBEDDING_MODEL_VERSION} for _ in ids]
+                )
+                _bump_memory_version()
+                reembedded += len(ids)
+            if progress_callback:
+                progress_callback(end_offset, total)
+    finally:
+        pool.shutdown()
+    return reembedded
@@ -0,0 +1,481 @@
+# memory/vector_store.py
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+
+# "chroma" keeps everything in a Chroma collection (HNSW index). "numpy" keeps embeddings in
+# memory-mapped NumPy files, one per source_id, with exact search and metadata in SQLite.
+VECTOR_STORE_BACKEND = os.getenv("VECTOR_STORE_BACKEND", "chroma")
+CHROMA_PATH = "storage/chroma"
+NUMPY_STORE_DIR = "storage/vectors"
+# Storage precision of the NumPy backend. float16 halves disk and page-cache use; scoring is done in float32.
+NUMPY_STORE_DTYPE = os.getenv("NUMPY_STORE_DTYPE", "float32")
+NUMPY_STORE_MAX_BATCH_SIZE = 10000
+
+class VectorStore:
+    """
+    The subset of the Chroma collection API that memory_store uses. Results have Chroma's shape:
+    get() returns {"ids", "documents", "metadatas"}, query() returns the same keys plus "distances",
+    each wrapped in one list per query embedding. Distances are squared L2, as in Chroma's default space.
+    `where` supports equality, $in, $gte, $gt, $lt, $lte and $and.
+    """
+
+    def add(self, ids: list, documents: list, embeddings: list, metadatas: list):
+        raise NotImplementedError
+
+    def update(self, ids: list, embeddings: list = None, metadatas: list = None):
+        raise NotImplementedError
+
+    def get(self, ids: list = None, where: dict = None, include: list = None, limit: int = None, offset: int = None) -> dict:
+        raise NotImplementedError
+
+    def query(self, query_embeddings: list, n_results: int = 10, where: dict = None, include: list = None) -> dict:
+        raise NotImplementedError
+
+    def delete(self, ids: list = None, where: dict = None):
+        raise NotImplementedError
+
+    def count(self) -> int:
+        raise NotImplementedError
+
+    def get_max_batch_size(self) -> int:
+        raise NotImplementedError
+
+class ChromaVectorStore(VectorStore):
+    """The 'unified_memory' Chroma collection."""
+
+    def __init__(self, path: str = CHROMA_PATH, collection_name: str = "unified_memory"):
+        import chromadb
+        self.client = chromadb.PersistentClient(path=path)
+        self.collection = self.client.get_or_create_collection(name=collection_name)
+
+    def add(self, ids, documents, embeddings, metadatas):
+        self.collection.add(ids=ids, documents=documents, embeddings=embeddings, metadatas=metadatas)
+
+    def update(self, ids, embeddings=None, metadatas=None):
+        self.collection.update(ids=ids, embeddings=embeddings, metadatas=metadatas)
+
+    def get(self, ids=None, where=None, include=None, limit=None, offset=None):
+        return self.collection.get(
+            ids=ids, where=where, include=include if include is not None else ["metadatas", "documents"],
+            limit=limit, offset=offset
+        )
+
+    def query(self, query_embeddings, n_results=10, where=None, include=None):
+        return self.collection.query(
+            query_embeddings=query_embeddings, n_results=n_results, where=where,
+            include=include if include is not None else ["metadatas", "documents", "distances"]
+        )
+
+    def delete(self, ids=None, where=None):
+        self.collection.delete(ids=ids, where=where)
+
+    def count(self):
+        return self.collection.count()
+
+    def get_max_batch_size(self):
+        return self.client.get_max_batch_size()
+
+# --- NumPy backend ---
+_COMPARISONS = {"$gte": ">=", "$gt": ">", "$lt": "<", "$lte": "<="}
+
+def _matches(metadata: dict, where: dict | None) -> bool:
+    """Evaluates a Chroma-style where filter against one metadata dict."""
+    if not where:
+        return True
+    for key, condition in where.items():
+        if key == "$and":
+            if not all(_matches(metadata, sub_where) for sub_where in condition):
+                return False
+            continue
+        value = metadata.get(key)
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        for op, operand in condition.items():
+            if op == "$eq" and value != operand: return False
+            if op == "$ne" and value == operand: return False
+            if op == "$in" and value not in operand: return False
+            if op in _COMPARISONS and (value is None or not {
+                "$gte": value >= operand, "$gt": value > operand, "$lt": value < operand, "$lte": value <= operand
+            }[op]):
+                return False
+    return True
+
+def _source_ids_in(where: dict | None) -> list[str] | None:
+    """The source_ids a filter is restricted to, or None if it can match any source."""
+    if not where:
+        return None
+    for key, condition in where.items():
+        if key == "$and":
+            for sub_where in condition:
+                source_ids = _source_ids_in(sub_where)
+                if source_ids is not None:
+                    return source_ids
+        elif key == "source_id":
+            if isinstance(condition, dict):
+                if "$in" in condition:
+                    return list(condition["$in"])
+                if "$eq" in condition:
+                    return [condition["$eq"]]
+            else:
+                return [condition]
+    return None
+
+def _is_source_filter_only(where: dict | None) -> bool:
+    """True if a filter only restricts source_id, so choosing partitions is enough."""
+    if not where:
+        return True
+    if list(where) != ["source_id"]:
+        return False
+    condition = where["source_id"]
+    return not isinstance(condition, dict) or set(condition) <= {"$in", "$eq"}
+
+def _order_index_sql(where: dict | None) -> tuple[list[str], list]:
+    """SQL clauses for order_index range conditions, so ranged reads use the index."""
+    clauses, params = [], []
+    if not where:
+        return clauses, params
+    for key, condition in where.items():
+        if key == "$and":
+            for sub_where in condition:
+                sub_clauses, sub_params = _order_index_sql(sub_where)
+                clauses += sub_clauses
+                params += sub_params
+        elif key == "order_index" and isinstance(condition, dict):
+            for op, operand in condition.items():
+                if op in _COMPARISONS:
+                    clauses.append(f"order_index {_COMPARISONS[op]} ?")
+                    params.append(operand)
+    return clauses, params
+
+class NumpyVectorStore(VectorStore):
+    """
+    Embeddings are appended to one file per source_id and read through np.memmap. Queries are exact:
+    squared L2 distances for every row of the candidate partitions, computed with one matrix-vector
+    product per partition. Restricting a query to source_ids only touches those partitions.
+    Documents and metadata live in an SQLite side table indexed by source_id and order_index.
+    """
+
+    def __init__(self, directory: str = NUMPY_STORE_DIR, dtype: str = NUMPY_STORE_DTYPE):
+        import numpy
+        self._np = numpy
+        self.directory = directory
+        self.dtype = numpy.dtype(dtype)
+        os.makedirs(directory, exist_ok=True)
+        self.db_file = os.path.join(directory, "metadata.sqlite")
+        self._local = threading.local()
+        self._lock = threading.RLock()
+        self._partitions = {}  # source_id -> (memmap or None, rows array, ids list)
+        self._connection().executescript("""
+            CREATE TABLE IF NOT EXISTS vectors (
+                id TEXT PRIMARY KEY,
+                source_id TEXT NOT NULL,
+                row INTEGER NOT NULL,
+                order_index INTEGER,
+                document TEXT,
+                metadata TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_vectors_source_order ON vectors(source_id, order_index);
+            CREATE TABLE IF NOT EXISTS partitions (
+                source_id TEXT PRIMARY KEY,
+                file_name TEXT NOT NULL,
+                row_count INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS store_meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+        row = self._connection().execute("SELECT value FROM store_meta WHERE key = 'dimension'").fetchone()
+        self.dimension = int(row[0]) if row else None
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, isolation_level=None, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # --- Partitions ---
+    def _file_name(self, source_id: str) -> str:
+        safe_name = re.sub(r"[^A-Za-z0-9_.-]", "_", source_id)[:80]
+        return f"{safe_name}-{hashlib.sha1(source_id.encode('utf-8')).hexdigest()[:10]}.vec"
+
+    def _partition(self, source_id: str):
+        """
+        Returns (vectors, squared norms, ids) for a source's live rows, cached until the source is written.
+        When no rows were deleted, vectors is the memmap itself and nothing is copied into memory.
+        """
+        np = self._np
+        with self._lock:
+            cached = self._partitions.get(source_id)
+            if cached is not None:
+                return cached
+            conn = self._connection()
+            partition = conn.execute(
+                "SELECT file_name, row_count FROM partitions WHERE source_id = ?", (source_id,)
+            ).fetchone()
+            rows = conn.execute("SELECT row, id FROM vectors WHERE source_id = ? ORDER BY row", (source_id,)).fetchall()
+            if not partition or not rows:
+                cached = (None, None, [])
+            else:
+                vectors = np.memmap(
+                    os.path.join(self.directory, partition[0]), dtype=self.dtype, mode="r",
+                    shape=(partition[1], self.dimension)
+                )
+                if len(rows) < partition[1]:
+                    vectors = vectors[np.array([row[0] for row in rows], dtype=np.int64)]
+                squared_norms = np.einsum("ij,ij->i", vectors, vectors, dtype=np.float32)
+                cached = (vectors, squared_norms, [row[1] for row in rows])
+            self._partitions[source_id] = cached
+            return cached
+
+    def _dot(self, vectors, query):
+        """vectors @ query in float32. float16 rows are converted in blocks, since NumPy has no BLAS for float16."""
+        np = self._np
+        if vectors.dtype == np.float32:
+            return vectors @ query
+        block = 8192
+        return np.concatenate([
+            np.asarray(vectors[start:start + block], dtype=np.float32) @ query
+            for start in range(0, vectors.shape[0], block)
+        ])
+
+    def _trim_partition_file(self, path: str, row_count: int):
+        """Cuts a partition file back to row_count rows, dropping vectors whose metadata was never committed."""
+        committed_size = row_count * self.dimension * self.dtype.itemsize
+        if os.path.exists(path) and os.path.getsize(path) > committed_size:
+            os.truncate(path, committed_size)
+
+    def _all_source_ids(self) -> list[str]:
+        return [row[0] for row in self._connection().execute("SELECT source_id FROM partitions")]
+
+    # --- Writes ---
+    def add(self, ids, documents, embeddings, metadatas):
+        np = self._np
+        if not ids:
+            return
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        with self._lock:
+            conn = self._connection()
+            if self.dimension is None:
+                self.dimension = vectors.shape[1]
+                conn.execute("INSERT OR REPLACE INTO store_meta (key, value) VALUES ('dimension', ?)", (str(self.dimension),))
+            if vectors.shape[1] != self.dimension:
+                raise ValueError(f"Embedding dimension {vectors.shape[1]} does not match the store's {self.dimension}.")
+            existing = conn.execute(
+                f"SELECT id FROM vectors WHERE id IN ({','.join('?' * len(ids))})", ids
+            ).fetchall()
+            if existing:
+                raise ValueError(f"IDs already exist in the vector store: {[row[0] for row in existing][:5]}")
+
+            positions_by_source = {}
+            for position, metadata in enumerate(metadatas):
+                positions_by_source.setdefault(metadata.get("source_id", ""), []).append(position)
+
+            # Vectors are appended before the rows that point at them are committed. Each file is first
+            # cut back to its committed row_count, so rows left by a failed or interrupted add are
+            # overwritten instead of shifting every later row out of line with the metadata.
+            appended = []
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for source_id, positions in positions_by_source.items():
+                    partition = conn.execute(
+                        "SELECT file_name, row_count FROM partitions WHERE source_id = ?", (source_id,)
+                    ).fetchone()
+                    file_name, row_count = partition if partition else (self._file_name(source_id), 0)
+                    path = os.path.join(self.directory, file_name)
+                    self._trim_partition_file(path, row_count)
+                    appended.append((path, row_count))
+                    with open(path, "ab") as f:
+                        f.write(vectors[positions].astype(self.dtype).tobytes())
+                    conn.executemany(
+                        "INSERT INTO vectors (id, source_id, row, order_index, document, metadata) VALUES (?, ?, ?, ?, ?, ?)",
+                        [
+                            (ids[p], source_id, row_count + offset, metadatas[p].get("order_index"),
+                             documents[p], json.dumps(metadatas[p]))
+                            for offset, p in enumerate(positions)
+                        ]
+                    )
+                    conn.execute(
+                        "INSERT OR REPLACE INTO partitions (source_id, file_name, row_count) VALUES (?, ?, ?)",
+                        (source_id, file_name, row_count + len(positions))
+                    )
+                    self._partitions.pop(source_id, None)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                for path, row_count in appended:
+                    self._trim_partition_file(path, row_count)
+                raise
+
+    def update(self, ids, embeddings=None, metadatas=None):
+        np = self._np
+        with self._lock:
+            conn = self._connection()
+            rows = {
+                row[0]: (row[1], row[2], row[3]) for row in conn.execute(
+                    f"SELECT id, source_id, row, metadata FROM vectors WHERE id IN ({','.join('?' * len(ids))})", ids
+                )
+            }
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if embeddings is not None:
+                    # Each partition file is opened once, however many of its rows change.
+                    positions_by_source = {}
+                    for position, doc_id in enumerate(ids):
+                        if doc_id in rows:
+                            positions_by_source.setdefault(rows[doc_id][0], []).append(position)
+                    for source_id, positions in positions_by_source.items():
+                        file_name, row_count = conn.execute(
+                            "SELECT file_name, row_count FROM partitions WHERE source_id = ?", (source_id,)
+                        ).fetchone()
+                        vectors = np.memmap(
+                            os.path.join(self.directory, file_name), dtype=self.dtype, mode="r+",
+                            shape=(row_count, self.dimension)
+                        )
+                        vectors[[rows[ids[position]][1] for position in positions]] = np.asarray(
+                            [embeddings[position] for position in positions], dtype=np.float32
+                        ).astype(self.dtype)
+                        vectors.flush()
+                        self._partitions.pop(source_id, None)
+                if metadatas is not None:
+                    for position, doc_id in enumerate(ids):
+                        if doc_id not in rows:
+                            continue
+                        current = json.loads(rows[doc_id][2])
+                        current.update(metadatas[position])
+                        conn.execute(
+                            "UPDATE vectors SET metadata = ?, order_index = ? WHERE id = ?",
+                            (json.dumps(current), current.get("order_index"), doc_id)
+                        )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def delete(self, ids=None, where=None):
+        with self._lock:
+            matched = self.get(ids=ids, where=where, include=[])["ids"]
+            if not matched:
+                return
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                affected_sources = set()
+                for start in range(0, len(matched), 500):
+                    batch = matched[start:start + 500]
+                    placeholders = ",".join("?" * len(batch))
+                    affected_sources.update(row[0] for row in conn.execute(
+                        f"SELECT DISTINCT source_id FROM vectors WHERE id IN ({placeholders})", batch
+                    ))
+                    conn.execute(f"DELETE FROM vectors WHERE id IN ({placeholders})", batch)
+                # Rows of deleted documents stay in the file until their whole source is removed.
+                emptied = []
+                for source_id in affected_sources:
+                    self._partitions.pop(source_id, None)
+                    if not conn.execute("SELECT 1 FROM vectors WHERE source_id = ? LIMIT 1", (source_id,)).fetchone():
+                        file_name = conn.execute("SELECT file_name FROM partitions WHERE source_id = ?", (source_id,)).fetchone()[0]
+                        conn.execute("DELETE FROM partitions WHERE source_id = ?", (source_id,))
+                        emptied.append(file_name)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            for file_name in emptied:
+                path = os.path.join(self.directory, file_name)
+                if os.path.exists(path):
+                    os.remove(path)
+
+    # --- Reads ---
+    def _rows_to_result(self, rows, include) -> dict:
+        result = {"ids": [row[0] for row in rows]}
+        include = ["metadatas", "documents"] if include is None else include
+        if "documents" in include:
+            result["documents"] = [row[1] for row in rows]
+        if "metadatas" in include:
+            result["metadatas"] = [json.loads(row[2]) for row in rows]
+        return result
+
+    def get(self, ids=None, where=None, include=None, limit=None, offset=None):
+        clauses, params = _order_index_sql(where)
+        source_ids = _source_ids_in(where)
+        if source_ids is not None:
+            clauses.append(f"source_id IN ({','.join('?' * len(source_ids))})")
+            params += source_ids
+        if ids is not None:
+            if not ids:
+                return self._rows_to_result([], include)
+            clauses.append(f"id IN ({','.join('?' * len(ids))})")
+            params += list(ids)
+        sql = "SELECT id, document, metadata FROM vectors"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY rowid"
+        if not where:
+            # Nothing to check per row, so SQLite can page directly (e.g. a full scan in batches).
+            if limit is not None or offset:
+                sql += " LIMIT ? OFFSET ?"
+                params += [-1 if limit is None else limit, offset or 0]
+            return self._rows_to_result(self._connection().execute(sql, params).fetchall(), include)
+        rows = [row for row in self._connection().execute(sql, params) if _matches(json.loads(row[2]), where)]
+        start = offset or 0
+        rows = rows[start:start + limit] if limit is not None else rows[start:]
+        return self._rows_to_result(rows, include)
+
+    def query(self, query_embeddings, n_results=10, where=None, include=None):
+        np = self._np
+        include = ["metadatas", "documents", "distances"] if include is None else include
+        source_ids = _source_ids_in(where)
+        if source_ids is None:
+            source_ids = self._all_source_ids()
+        # Conditions beyond source_id are checked per row against the metadata table.
+        allowed_ids = None if _is_source_filter_only(where) else set(self.get(where=where, include=[])["ids"])
+
+        results = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        for query_embedding in query_embeddings:
+            query = np.asarray(query_embedding, dtype=np.float32)
+            candidate_ids, candidate_distances = [], []
+            for source_id in source_ids:
+                vectors, squared_norms, row_ids = self._partition(source_id)
+                if vectors is None:
+                    continue
+                # Squared L2: |x|^2 - 2 x.q + |q|^2, as one matrix-vector product.
+                distances = squared_norms - 2.0 * self._dot(vectors, query) + float(query @ query)
+                if allowed_ids is not None:
+                    keep = np.array([doc_id in allowed_ids for doc_id in row_ids], dtype=bool)
+                    distances = np.where(keep, distances, np.inf)
+                k = min(n_results, len(distances))
+                top = np.argpartition(distances, k - 1)[:k]
+                for i in top:
+                    if np.isfinite(distances[i]):
+                        candidate_ids.append(row_ids[i])
+                        candidate_distances.append(float(max(distances[i], 0.0)))
+            order = sorted(range(len(candidate_ids)), key=candidate_distances.__getitem__)[:n_results]
+            top_ids = [candidate_ids[i] for i in order]
+            fetched = self.get(ids=top_ids, include=["documents", "metadatas"])
+            by_id = {doc_id: i for i, doc_id in enumerate(fetched["ids"])}
+            results["ids"].append(top_ids)
+            results["documents"].append([fetched["documents"][by_id[doc_id]] for doc_id in top_ids])
+            results["metadatas"].append([fetched["metadatas"][by_id[doc_id]] for doc_id in top_ids])
+            results["distances"].append([candidate_distances[i] for i in order])
+        return {key: value for key, value in results.items() if key == "ids" or key in include}
+
+    def count(self):
+        return self._connection().execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
+
+    def get_max_batch_size(self):
+        return NUMPY_STORE_MAX_BATCH_SIZE
+
+def create_vector_store() -> VectorStore:
+    if VECTOR_STORE_BACKEND == "chroma":
+        return ChromaVectorStore()
+    if VECTOR_STORE_BACKEND == "numpy":
+        return NumpyVectorStore()
+    raise ValueError(f"Unknown VECTOR_STORE_BACKEND '{VECTOR_STORE_BACKEND}'. Use 'chroma' or 'numpy'.")